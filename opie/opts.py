@@ -14,7 +14,10 @@
 # under the License.
 
 import opie.scheduler.filter_scheduler
+import opie.scheduler.host_manager
+import opie.scheduler.metrics
 import opie.scheduler.weights.preemptible
+import opie.scheduler.weights.victims
 
 
 def list_opts():
@@ -22,5 +25,8 @@ def list_opts():
         ('DEFAULT',
          opie.scheduler.weights.preemptible.preemptible_weight_opts),
         ('preemptible_instances_scheduler',
-         opie.scheduler.filter_scheduler.opts),
+         opie.scheduler.filter_scheduler.opts +
+         opie.scheduler.host_manager.opts +
+         opie.scheduler.metrics.metrics_opts +
+         opie.scheduler.weights.victims.victim_weight_opts),
     ]
@@ -0,0 +1,97 @@
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Database queries needed by the scheduler that nova does not provide.
+"""
+
+from sqlalchemy import and_
+from sqlalchemy import or_
+
+from nova.db.sqlalchemy import api as db_api
+from nova.db.sqlalchemy import models
+from nova import objects
+from nova.objects import base as obj_base
+
+
+@db_api.main_context_manager.reader
+def _compute_node_get_all_changed_since(context, since):
+    query = db_api.model_query(context, models.ComputeNode,
+                               read_deleted="no")
+    if since is not None:
+        query = query.filter(or_(models.ComputeNode.updated_at >= since,
+                                 models.ComputeNode.created_at >= since))
+    return query.order_by(models.ComputeNode.id).all()
+
+
+@db_api.main_context_manager.reader
+def _compute_node_get_all_ids(context):
+    query = db_api.model_query(context, models.ComputeNode,
+                               (models.ComputeNode.id,), read_deleted="no")
+    return [row[0] for row in query.all()]
+
+
+@db_api.main_context_manager.reader
+def _instance_get_all_summaries_by_host(context, hosts):
+    columns = (models.Instance.uuid,
+               models.Instance.host,
+               models.Instance.memory_mb,
+               models.Instance.root_gb,
+               models.Instance.ephemeral_gb,
+               models.Instance.vcpus,
+               models.Instance.created_at,
+               models.Instance.project_id,
+               models.Instance.instance_type_id,
+               models.InstanceSystemMetadata.value.label("preemptible"))
+    preemptible = and_(
+        models.InstanceSystemMetadata.instance_uuid == models.Instance.uuid,
+        models.InstanceSystemMetadata.key == "preemptible",
+        models.InstanceSystemMetadata.deleted == 0)
+    query = db_api.model_query(context, models.Instance, columns,
+                               read_deleted="no")
+    query = query.outerjoin(models.InstanceSystemMetadata, preemptible)
+    return query.filter(models.Instance.host.in_(hosts)).all()
+
+
+def get_compute_nodes_changed_since(context, since):
+    """Return the compute nodes created or updated since a given time.
+
+    :param since: a naive UTC datetime, or None to get all the nodes.
+    :returns: a ComputeNodeList, sorted by id.
+    """
+    db_computes = _compute_node_get_all_changed_since(context, since)
+    return obj_base.obj_make_list(context, objects.ComputeNodeList(context),
+                                  objects.ComputeNode, db_computes)
+
+
+def get_compute_node_ids(context):
+    """Return a set with the ids of all the (non deleted) compute nodes."""
+    return set(_compute_node_get_all_ids(context))
+
+
+def get_instance_summaries_by_host(context, hosts):
+    """Return the data needed by the scheduler for the instances of hosts.
+
+    Only the needed columns (and the "preemptible" system metadata key) are
+    fetched, in a single query, instead of the whole instances.
+
+    :returns: a list of rows with the uuid, host, memory_mb, root_gb,
+              ephemeral_gb, vcpus, created_at, project_id, instance_type_id
+              and preemptible (the system metadata value, or None) of the
+              instances.
+    """
+    if not hosts:
+        return []
+    return _instance_get_all_summaries_by_host(context, list(hosts))
@@ -19,6 +19,7 @@
 The FilterScheduler taking into account preemptible instances.
 """
 
+import collections
 import random
 
 from oslo_config import cfg
@@ -26,18 +27,114 @@ from oslo_log import log as logging
 
 from nova import compute
 from nova import exception
-from nova.i18n import _, _LI
+from nova.i18n import _, _LW  # noqa
 from nova import rpc
 from nova.scheduler import filter_scheduler as nova_filter_scheduler
 from nova.scheduler import scheduler_options
+from nova import utils
+
+from opie.scheduler import host_manager
+from opie.scheduler import metrics
+from opie.scheduler import preemption
+from opie.scheduler import reaper
+from opie.scheduler import sampling
+from opie.scheduler import selection
+from opie.scheduler import weights
+from opie.scheduler.weights import victims
 
 CONF = cfg.CONF
 
 opts = [
     cfg.ListOpt('weight_classes',
-                default=['nova.scheduler.weights.all_preemptible_weighers'],
+                default=['opie.scheduler.weights.all_victim_weighers'],
                 help='Which weight class names to use for weighing the '
-                    'selection of preemptible instances for termination'),
+                     'preemptible instances of a host, in order to select '
+                     'the ones to terminate. The instances with higher '
+                     'weights are terminated first.'),
+    cfg.IntOpt('victim_selection_max_nodes',
+               default=preemption.DEFAULT_MAX_NODES,
+               min=0,
+               help='Maximum number of nodes explored by the branch and '
+                    'bound search used to select the preemptible instances '
+                    'to terminate. When it is reached, the best selection '
+                    'found so far is used.'),
+    cfg.IntOpt('termination_pool_size',
+               default=8,
+               min=1,
+               help='Maximum number of preemptible instances that are '
+                    'terminated concurrently.'),
+    cfg.BoolOpt('async_termination',
+                default=False,
+                help='Terminate the preemptible instances in a background '
+                     'green thread, instead of waiting for their termination '
+                     'before returning the selected destinations.'),
+    cfg.IntOpt('termination_queue_size',
+               default=100,
+               min=1,
+               help='Maximum number of pending termination orders when '
+                    'async_termination is enabled.'),
+    cfg.IntOpt('termination_enqueue_timeout',
+               default=10,
+               min=0,
+               help='Number of seconds to wait for room in the termination '
+                    'queue when it is full. After that, the instances are '
+                    'terminated synchronously.'),
+    cfg.IntOpt('termination_max_retries',
+               default=3,
+               min=0,
+               help='Number of times that the termination of a preemptible '
+                    'instance is retried when async_termination is '
+                    'enabled.'),
+    cfg.IntOpt('termination_retry_interval',
+               default=5,
+               min=0,
+               help='Number of seconds to wait before retrying the '
+                    'termination of a preemptible instance.'),
+    cfg.BoolOpt('two_phase_preemption',
+                default=False,
+                help='When preemptible instances are terminated to make room '
+                     'for a normal instance, wait until they are actually '
+                     'deleted before returning the selected destination, so '
+                     'that the build does not reach the compute node before '
+                     'the resources are freed, fail its resource claim and '
+                     'be rescheduled. Meanwhile the victims and the resources '
+                     'of the new instance are reserved on the host for '
+                     'preemption_reservation_ttl seconds, or at least '
+                     'preemption_drain_timeout seconds.'),
+    cfg.IntOpt('preemption_drain_timeout',
+               default=30,
+               min=0,
+               help='Maximum number of seconds to wait for the deletion of '
+                    'the terminated preemptible instances when '
+                    'two_phase_preemption is enabled. After that, the '
+                    'destinations are returned anyway. It must be lower '
+                    'than the RPC timeout (rpc_response_timeout).'),
+    cfg.FloatOpt('preemption_drain_poll_interval',
+                 default=1.0,
+                 min=0.1,
+                 help='Number of seconds between two checks of the deletion '
+                      'of the terminated preemptible instances when '
+                      'two_phase_preemption is enabled.'),
+    cfg.BoolOpt('incremental_weighing',
+                default=False,
+                help='Instead of weighing and sorting all the hosts for each '
+                     'instance of a request, only weigh again the host that '
+                     'was selected for the previous instance and keep the '
+                     'best scheduler_host_subset_size hosts.'),
+    cfg.IntOpt('sampling_size',
+               default=0,
+               min=0,
+               help='Number of hosts randomly sampled, filtered and weighed '
+                    'for each instance, instead of all of them. The sample '
+                    'is doubled each time none of the sampled hosts passes '
+                    'the filters, until all the hosts are evaluated. With 0 '
+                    'all the hosts are always evaluated.'),
+    cfg.FloatOpt('sampling_reclaimable_bias',
+                 default=2.0,
+                 min=1.0,
+                 help='When sampling_size is set, how many times more likely '
+                      'a host with preemptible instances is sampled for a '
+                      'normal request than a host without them.'),
 ]
 
 CONF.register_opts(opts, group="preemptible_instances_scheduler")
@@ -53,11 +150,32 @@ class FilterScheduler(nova_filter_scheduler.FilterScheduler):
         self.notifier = rpc.get_notifier('scheduler')
 
         self.compute_api = compute.API()
-
-#        self.weight_handler = weights.SpotWeightHandler()
-#        weigher_classes = self.weight_handler.get_matching_classes(
-#                CONF.preemptible.weight_classes)
-#        self.weighers = [cls() for cls in weigher_classes]
+        self.metrics = metrics.get_registry()
+
+        opts = CONF.preemptible_instances_scheduler
+        self.reaper = reaper.PreemptionReaper(
+            self.compute_api,
+            queue_size=opts.termination_queue_size,
+            pool_size=opts.termination_pool_size,
+            max_retries=opts.termination_max_retries,
+            retry_interval=opts.termination_retry_interval,
+            enqueue_timeout=opts.termination_enqueue_timeout,
+            registry=self.metrics)
+
+        self.victim_weight_handler = weights.VictimWeightHandler()
+        weigher_classes = self.victim_weight_handler.get_matching_classes(
+            opts.weight_classes)
+        self.victim_weighers = [cls() for cls in weigher_classes]
+
+        if opts.single_host_list:
+            plain = set(["RamFilter", "DiskFilter", "CoreFilter"])
+            plain.intersection_update(CONF.scheduler_default_filters)
+            if plain:
+                LOG.warning(_LW("single_host_list is enabled, but the "
+                                "%(filters)s filters do not consider the "
+                                "preemptible instances as reclaimable, use "
+                                "their Reclaimable versions instead."),
+                            {"filters": ", ".join(sorted(plain))})
 
     def select_destinations(self, context, spec_obj):
         """Selects a filtered set of hosts and nodes."""
@@ -65,64 +183,216 @@ class FilterScheduler(nova_filter_scheduler.FilterScheduler):
             context, 'scheduler.select_destinations.start',
             dict(request_spec=spec_obj.to_legacy_request_spec_dict()))
 
-        num_instances = spec_obj.num_instances
-        selected_hosts = self._schedule(context, spec_obj)
-
-        # Couldn't fulfill the request_spec
-        if len(selected_hosts) < num_instances:
-            # NOTE(Rui Chen): If multiple creates failed, set the updated time
-            # of selected HostState to None so that these HostStates are
-            # refreshed according to database in next schedule, and release
-            # the resource consumed by instance in the process of selecting
-            # host.
+        preemptible_request = self._is_preemptible_request(spec_obj)
+        request_type = self._get_request_type(spec_obj)
+        timer = self.metrics.timer("select_destinations",
+                                   request=request_type)
+
+        # The outcome and number of victims are recorded even if the
+        # request cannot be fulfilled
+        outcome = "error"
+        num_victims = 0
+        try:
+            num_instances = spec_obj.num_instances
+            selected_hosts = self._schedule(context, spec_obj)
+
+            # Couldn't fulfill the request_spec
+            if len(selected_hosts) < num_instances:
+                # NOTE(Rui Chen): If multiple creates failed, set the updated
+                # time of selected HostState to None so that these HostStates
+                # are refreshed according to database in next schedule, and
+                # release the resource consumed by instance in the process of
+                # selecting host.
+                for host in selected_hosts:
+                    self.host_manager.invalidate(host.obj)
+
+                # Log the details but don't put those into the reason since
+                # we don't want to give away too much information about our
+                # actual environment.
+                LOG.debug('There are %(hosts)d hosts available but '
+                          '%(num_instances)d instances requested to build.',
+                          {'hosts': len(selected_hosts),
+                           'num_instances': num_instances})
+
+                outcome = "no_valid_host"
+                reason = _('There are not enough hosts available.')
+                raise exception.NoValidHost(reason=reason)
+
+            # NOTE(aloga): Detect if we are overcomitting here. If so, we need
+            # to delete some preemptible instances
+            dests = []
+            draining = []
+            # The instances of a request may be placed several times on the
+            # same host, and the victims are selected to make room for all of
+            # them. Only the UUID of the first instance of the request is
+            # known.
+            placements = collections.Counter((h.obj.host, h.obj.nodename)
+                                             for h in selected_hosts)
+            first_instance = {}
+            if (selected_hosts and
+                    spec_obj.obj_attr_is_set("instance_uuid") and
+                    spec_obj.instance_uuid):
+                first = selected_hosts[0].obj
+                first_instance[first.host, first.nodename] = [
+                    spec_obj.instance_uuid]
             for host in selected_hosts:
-                host.obj.updated = None
-
-            # Log the details but don't put those into the reason since
-            # we don't want to give away too much information about our
-            # actual environment.
-            LOG.debug('There are %(hosts)d hosts available but '
-                      '%(num_instances)d instances requested to build.',
-                      {'hosts': len(selected_hosts),
-                       'num_instances': num_instances})
-
-            reason = _('There are not enough hosts available.')
-            raise exception.NoValidHost(reason=reason)
-
-        # NOTE(aloga): Detect if we are overcomitting here. If so, we need to
-        # delete some preemptible instances
-        dests = []
-        for host in selected_hosts:
-            if (self.detect_overcommit(host.obj) and
-                not self._is_preemptible_request(spec_obj)):
-                preemptibles = self.select_preemptibles_from_host(host.obj,
-                                                                  spec_obj)
-                self.terminate_preemptible_instances(context, preemptibles)
-
-            dests.append(dict(host=host.obj.host, nodename=host.obj.nodename,
-                              limits=host.obj.limits))
+                state_key = (host.obj.host, host.obj.nodename)
+                preemptibles = self._preempt_from_host(
+                    host.obj, spec_obj, request_type, preemptible_request,
+                    placements=placements[state_key],
+                    instances=first_instance.get(state_key, ()))
+                if preemptibles:
+                    num_victims += len(preemptibles)
+                    with self.metrics.timer("termination",
+                                            request=request_type,
+                                            victims=len(preemptibles)):
+                        failed = self.terminate_preemptible_instances(
+                            context, preemptibles)
+                    # If some victim could not be deleted the build will not
+                    # fit on the host anyway, so there is no point in waiting
+                    # for it.
+                    if not failed:
+                        draining.append((host.obj,
+                                         [i["uuid"] for i in preemptibles]))
+
+                dests.append(dict(host=host.obj.host,
+                                  nodename=host.obj.nodename,
+                                  limits=host.obj.limits))
+
+            opts = CONF.preemptible_instances_scheduler
+            if draining and opts.two_phase_preemption:
+                self.wait_for_victims(context, draining, request_type)
+            outcome = "success"
+        finally:
+            timer.stop(outcome=outcome, victims=num_victims)
+            self.metrics.flush()
 
         self.notifier.info(
             context, 'scheduler.select_destinations.end',
             dict(request_spec=spec_obj.to_legacy_request_spec_dict()))
         return dests
 
+    def _preempt_from_host(self, host, spec_obj, request_type,
+                           preemptible_request, placements=1, instances=()):
+        """Select and reserve the preemptible instances to terminate.
+
+        The overcommit detection, the selection of the victims and their
+        reservation in the preemption ledger are done holding a per host
+        lock, so that concurrent requests on the same host see the victims
+        selected by each other.
+
+        :param placements: the number of instances of the request placed on
+                           the host, whose resources are reserved.
+        :param instances: the UUIDs of those instances, if known.
+
+        :returns: a list with the selected preemptible instances, empty if
+                  the host is not overcommitted.
+        """
+        state_key = (host.host, host.nodename)
+        ledger = self.host_manager.preemption_ledger
+        opts = CONF.preemptible_instances_scheduler
+        ttl = None
+        if opts.two_phase_preemption:
+            # The capacity freed by the victims must not be handed over to
+            # other requests while they drain, even if the reservations are
+            # not enabled otherwise.
+            ttl = max(ledger.ttl, opts.preemption_drain_timeout)
+
+        @utils.synchronized(ledger.lock_name(state_key))
+        def _locked():
+            with self.metrics.timer("overcommit", request=request_type):
+                overcommitted = self.detect_overcommit(host)
+            if not overcommitted or preemptible_request:
+                return []
+            with self.metrics.timer("victim_selection",
+                                    request=request_type):
+                preemptibles = self.select_preemptibles_from_host(host,
+                                                                  spec_obj)
+            uuids = [i.uuid for i in preemptibles]
+            host.remove_preemptible_instances(uuids)
+            resources = (
+                spec_obj.memory_mb * placements,
+                (spec_obj.root_gb + spec_obj.ephemeral_gb) * 1024 * placements,
+                spec_obj.vcpus * placements)
+            ledger.reserve(state_key, uuids, resources, instances=instances,
+                           placements=placements, baseline=host.instances,
+                           ttl=ttl)
+            return preemptibles
+
+        return _locked()
+
     def terminate_preemptible_instances(self, context, instances):
-        """Terminate the selected preemptible instances."""
+        """Terminate the selected preemptible instances.
+
+        If async_termination is enabled the instances are handed over to the
+        preemption reaper, otherwise we wait for them to be deleted.
+
+        :returns: a list with the UUIDs of the instances whose deletion
+                  failed, always empty if async_termination is enabled.
+        """
         # NOTE(aloga): we should not delete them directly, but probably send
         # them a signal so that the user is able to save her work.
+        if not instances:
+            return []
         elevated = context.elevated()
-        for instance in instances:
-            LOG.info(_LI("Deleting %(uuid)s") % {"uuid": instance["uuid"]})
-            instance = self.compute_api.get(elevated,
-                                            instance["uuid"],
-                                            want_objects=True)
-            self.compute_api.delete(elevated, instance)
+        uuids = [instance["uuid"] for instance in instances]
+        opts = CONF.preemptible_instances_scheduler
+        if opts.async_termination:
+            self.reaper.enqueue(elevated, uuids)
+            return []
+        return reaper.terminate_instances(self.compute_api, elevated, uuids,
+                                          opts.termination_pool_size)
+
+    def wait_for_victims(self, context, draining, request_type):
+        """Wait until the terminated preemptible instances are deleted.
+
+        This is the second phase of the preemption: the capacity of the new
+        instances is already reserved on their hosts in the preemption
+        ledger (for at least preemption_drain_timeout seconds), and the
+        destinations are only released once the victims are deleted, or when
+        preemption_drain_timeout expires.
+
+        :param draining: a list of (host state, victim UUIDs) tuples.
+        :returns: a set with the UUIDs of the victims that were not deleted
+                  in time.
+        """
+        opts = CONF.preemptible_instances_scheduler
+        victims = set()
+        for _host, uuids in draining:
+            victims.update(uuids)
+
+        timer = self.metrics.timer("victim_drain", request=request_type)
+        pending = reaper.wait_for_deletion(
+            context.elevated(), victims, opts.preemption_drain_timeout,
+            opts.preemption_drain_poll_interval)
+        timer.stop(outcome="timeout" if pending else "drained")
+
+        # Every destination whose victims are gone is a build that would
+        # otherwise have raced the deletion and probably been rescheduled.
+        late = [host.host for host, uuids in draining
+                if not pending.isdisjoint(uuids)]
+        self.metrics.increment("retries_avoided", len(draining) - len(late),
+                               request=request_type)
+        if pending:
+            LOG.warning(_LW("The preemptible instances %(uuids)s were not "
+                            "deleted after %(timeout)s seconds, the builds "
+                            "on %(hosts)s may need to be rescheduled."),
+                        {"uuids": sorted(pending),
+                         "timeout": opts.preemption_drain_timeout,
+                         "hosts": ", ".join(sorted(set(late)))})
+        return pending
 
     def select_preemptibles_from_host(self, host, request):
-        """Select preemptible instances to be killed for the request."""
-        preemptibles = [i for i in host.instances.values()
-                 if i.system_metadata.get("preemptible")]
+        """Select preemptible instances to be killed for the request.
+
+        The preemptible instances are ranked by the configured victim
+        weighers. The selected instances are the minimum cost set of
+        preemptible instances whose resources cover the overcommit of the
+        host, where the cost of terminating an instance is one (so that we
+        kill as few instances as possible) plus the difference between its
+        weight and the weight of the best ranked instance.
+        """
+        preemptibles = victims.get_victim_features(host)
         if not preemptibles:
             # Log the details but don't put those into the reason since
             # we don't want to give away too much information about our
@@ -134,30 +404,83 @@ class FilterScheduler(nova_filter_scheduler.FilterScheduler):
             reason = _('Cannot terminate enough preemptible instances.')
             raise exception.NoValidHost(reason=reason)
 
-        # FIXME(aloga): This needs to be fixed, as we are assuming that killing
-        # one instance will free enough resources
-        return [preemptibles.pop()]
+        needed = self._get_overcommit(host)
+        if not self._can_free(host, needed):
+            LOG.debug('Need to terminate preemptible instances, but the '
+                      'preemptible instances on %(host)s do not free enough '
+                      'resources' % {'host': host})
 
-    def detect_overcommit(self, host):
-        """Detect overcommit of resources, according to configured ratios."""
+            reason = _('Cannot terminate enough preemptible instances.')
+            raise exception.NoValidHost(reason=reason)
+
+        weighed = self.get_weighed_preemptibles(host, preemptibles, request)
+        best = weighed[0].weight
+        candidates = [preemption.Candidate(w.obj, w.obj.resources,
+                                           1 + best - w.weight)
+                      for w in weighed]
+
+        selected = preemption.select_victims(
+            candidates, needed,
+            max_nodes=CONF.preemptible_instances_scheduler.
+            victim_selection_max_nodes)
+        if selected is None:
+            LOG.debug('Need to terminate preemptible instances, but the '
+                      'preemptible instances on %(host)s do not free enough '
+                      'resources' % {'host': host})
+
+            reason = _('Cannot terminate enough preemptible instances.')
+            raise exception.NoValidHost(reason=reason)
+
+        return [c.key.instance for c in selected]
+
+    def get_weighed_preemptibles(self, host, preemptibles, request):
+        """Return the preemptible instances of a host, ranked by weight.
+
+        :param preemptibles: a list of VictimFeatures objects.
+        :returns: a list of WeighedVictim objects, sorted by descending
+                  weight.
+        """
+        weight_properties = {"host_state": host, "spec_obj": request}
+        return self.victim_weight_handler.get_weighed_objects(
+            self.victim_weighers, preemptibles, weight_properties)
+
+    @staticmethod
+    def _can_free(host, needed):
+        """Check if the preemptible instances can free the needed resources.
+
+        This uses the running totals of the host state, if available. It is
+        only a shortcut, as the victim selection will check it anyway.
+        """
+        reclaimable = (getattr(host, "preemptible_ram_mb", None),
+                       getattr(host, "preemptible_disk_mb", None),
+                       getattr(host, "preemptible_vcpus", None))
+        return all(r is None or r >= n for r, n in zip(reclaimable, needed))
+
+    def _get_overcommit(self, host):
+        """Get the overcommitted resources, according to configured ratios.
+
+        :returns: a (ram_mb, disk_mb, vcpus) tuple with the amount of each
+                  resource that is used above its limit. Resources that are
+                  not overcommitted have a value lower or equal to zero.
+        """
         ratio = host.ram_allocation_ratio or 1
         ram_limit = host.total_usable_ram_mb * ratio
         used_ram = host.total_usable_ram_mb - host.free_ram_mb
-        if used_ram > ram_limit:
-            return True
 
         ratio = host.disk_allocation_ratio or 1
         disk_limit = host.total_usable_disk_gb * ratio
         used_disk = host.total_usable_disk_gb - host.free_disk_mb / 1024.
-        if used_disk > disk_limit:
-            return True
 
         ratio = host.cpu_allocation_ratio or 1
         cpus_limit = host.vcpus_total * ratio
-        if host.vcpus_used > cpus_limit:
-            return True
 
-        return False
+        return (used_ram - ram_limit,
+                (used_disk - disk_limit) * 1024,
+                host.vcpus_used - cpus_limit)
+
+    def detect_overcommit(self, host):
+        """Detect overcommit of resources, according to configured ratios."""
+        return any(i > 0 for i in self._get_overcommit(host))
 
     def _schedule(self, context, spec_obj):
         """Returns a list of hosts that meet the required specs,
@@ -180,19 +503,50 @@ class FilterScheduler(nova_filter_scheduler.FilterScheduler):
         # way we can schedule normal requests even when there is no room for
         # them without doing a retry cycle.
 
-        if self._is_preemptible_request(spec_obj):
-            hosts = self._get_all_host_states(elevated, partial=False)
+        # Both views are obtained from a single refresh of the host states,
+        # so that they are consistent and we only hit the database once.
+        # With single_host_list both kind of requests use the full states,
+        # and the reclaimable filters consider the resources of the
+        # preemptible instances as free for the normal requests.
+        preemptible_request = self._is_preemptible_request(spec_obj)
+        request_type = self._get_request_type(spec_obj)
+        partial = not (preemptible_request or
+                       CONF.preemptible_instances_scheduler.single_host_list)
+        with self.metrics.timer("host_states", request=request_type):
+            hosts_full_state, hosts = self._get_host_state_snapshot(
+                elevated, partial=partial)
+        if partial:
+            # Index both views by (host, node) only once per request, so that
+            # each iteration only walks the filtered hosts
+            full_by_key = {(h.host, h.nodename): h for h in hosts_full_state}
+            partial_by_key = {(h.host, h.nodename): h for h in hosts}
         else:
-            hosts = self._get_all_host_states(elevated, partial=True)
+            hosts = hosts_full_state
+
+        selector = None
+        if CONF.preemptible_instances_scheduler.incremental_weighing:
+            selector = selection.TopHostsSelector(self.host_manager.weighers)
 
-        hosts_full_state = self._get_all_host_states(elevated, partial=False)
+        sampler = None
+        if CONF.preemptible_instances_scheduler.sampling_size:
+            sampler = self._get_sampler(hosts, preemptible_request,
+                                        full_by_key if partial else None)
 
         selected_hosts = []
         num_instances = spec_obj.num_instances
         for num in range(num_instances):
             # Filter local hosts based on requirements ...
-            hosts = self.host_manager.get_filtered_hosts(hosts,
-                                                         spec_obj, index=num)
+            with self.metrics.timer("filtering", request=request_type):
+                if sampler is not None:
+                    # Each instance is sampled from all the hosts of the
+                    # request, not only from those that passed the filters
+                    # for the previous instance, so every sample has to go
+                    # through all the filters, including those that are only
+                    # run for the first instance of a request.
+                    hosts = self._get_filtered_sample(sampler, spec_obj)
+                else:
+                    hosts = self.host_manager.get_filtered_hosts(
+                        hosts, spec_obj, index=num)
             if not hosts:
                 # Can't get any more locally.
                 break
@@ -200,16 +554,20 @@ class FilterScheduler(nova_filter_scheduler.FilterScheduler):
             LOG.debug("Filtered %(hosts)s", {'hosts': hosts})
 
             # Get the full host states for weighing. The filtered list of
-            # hosts does not take into account preemptible instances, but we
-            # need them for weighing
-
-            hosts_full_state = list(hosts_full_state)
-
-            filtered_hosts = {(h.host, h.nodename): h for h in hosts}
-            hosts_aux = [h for h in hosts_full_state
-                         if (h.host, h.nodename) in filtered_hosts]
-            weighed_hosts = self.host_manager.get_weighed_hosts(hosts_aux,
-                                                                spec_obj)
+            # partial hosts does not take into account preemptible instances,
+            # but we need them for weighing
+            if partial:
+                hosts_aux = [full_by_key[h.host, h.nodename] for h in hosts]
+            else:
+                hosts_aux = hosts
+            with self.metrics.timer("weighing", request=request_type):
+                if selector is not None:
+                    weighed_hosts = selector.get_top_weighed_hosts(
+                        hosts_aux, spec_obj,
+                        max(1, CONF.scheduler_host_subset_size))
+                else:
+                    weighed_hosts = self.host_manager.get_weighed_hosts(
+                        hosts_aux, spec_obj)
 
             LOG.debug("Weighed %(hosts)s", {'hosts': weighed_hosts})
 
@@ -229,12 +587,13 @@ class FilterScheduler(nova_filter_scheduler.FilterScheduler):
 
             # First update the chosen host, that is from the full state list
             chosen_host.obj.consume_from_request(spec_obj)
+            if selector is not None:
+                selector.invalidate(chosen_host.obj)
 
-            # Now consume from the partial state list
-            host = chosen_host.obj.host
-            node = chosen_host.obj.nodename
-            state_key = (host, node)
-            filtered_hosts[state_key].consume_from_request(spec_obj)
+            # Now consume from the partial state list, if we are using it
+            if partial:
+                state_key = (chosen_host.obj.host, chosen_host.obj.nodename)
+                partial_by_key[state_key].consume_from_request(spec_obj)
 
             # Now continue with the rest of the scheduling function
             if spec_obj.instance_group is not None:
@@ -244,15 +603,62 @@ class FilterScheduler(nova_filter_scheduler.FilterScheduler):
 
         return selected_hosts
 
+    def _get_sampler(self, hosts, preemptible_request, full_by_key=None):
+        """Return a HostSampler over the hosts of a request.
+
+        For the normal requests the hosts with preemptible instances, whose
+        resources can be reclaimed, are favoured.
+        """
+        if preemptible_request:
+            return sampling.HostSampler(hosts)
+
+        def _reclaimable(host):
+            if full_by_key is not None:
+                host = full_by_key[host.host, host.nodename]
+            return getattr(host, "num_preemptible_instances", 0) > 0
+
+        bias = CONF.preemptible_instances_scheduler.sampling_reclaimable_bias
+        return sampling.HostSampler(hosts, favoured=_reclaimable, bias=bias)
+
+    def _get_filtered_sample(self, sampler, spec_obj):
+        """Filter a random sample of the hosts, enlarging it on failure.
+
+        The sample is filtered as the first instance of the request, as the
+        filters that run once per request have not seen its hosts yet.
+        """
+        size = CONF.preemptible_instances_scheduler.sampling_size
+        while True:
+            sample = sampler.sample(size)
+            hosts = self.host_manager.get_filtered_hosts(sample, spec_obj,
+                                                         index=0)
+            # None means that a filter said to stop filtering
+            if hosts or hosts is None or len(sample) >= len(sampler):
+                return hosts
+            LOG.debug("None of the %(size)d sampled hosts passed the "
+                      "filters, sampling more hosts", {"size": len(sample)})
+            size *= 2
+
     def _get_all_host_states(self, context, partial=False):
         """Template method, so a subclass can implement caching."""
         if partial:
             return self.host_manager.get_all_host_partial_states(context)
         return self.host_manager.get_all_host_states(context)
 
+    def _get_host_state_snapshot(self, context, partial=True):
+        """Template method, so a subclass can implement caching.
+
+        Returns a tuple with the full host states and the partial ones (or
+        None if partial is False), obtained from a single refresh. The host
+        manager serves them from memory if host_state_cache_ttl is set.
+        """
+        return self.host_manager.get_host_state_snapshot(context,
+                                                         partial=partial)
+
+    def _get_request_type(self, spec_obj):
+        """Return the request type, used for tagging the metrics."""
+        if self._is_preemptible_request(spec_obj):
+            return "preemptible"
+        return "normal"
+
     def _is_preemptible_request(self, spec_obj):
-        # NOTE(aloga): this is not lazy loadable
-        if not hasattr(spec_obj, "scheduler_hints"):
-                spec_obj.scheduler_hints = {}
-        hints = spec_obj.scheduler_hints.get("preemptible", [False])
-        return all([h == "True" for h in hints])
+        return host_manager.is_preemptible_request(spec_obj)
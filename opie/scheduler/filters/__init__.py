@@ -0,0 +1,33 @@
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Host filters aware of the preemptible instances.
+
+They can be made available to the scheduler adding
+"opie.scheduler.filters.all_filters" to the scheduler_available_filters
+option.
+"""
+
+from nova.scheduler import filters
+
+
+class HostFilterHandler(filters.HostFilterHandler):
+    pass
+
+
+def all_filters():
+    """Return a list of the host filter classes found in this directory."""
+    return HostFilterHandler().get_all_classes()
@@ -0,0 +1,78 @@
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+RAM, disk and core filters where the preemptible instances are reclaimable.
+
+For a normal request, the resources used by the preemptible instances of a
+host are considered as free, as they can be reclaimed terminating those
+instances. For a preemptible request, they behave like the nova filters.
+This way both kind of requests can be filtered over the full host states,
+without a second list of host states (see the single_host_list option).
+"""
+
+from nova.scheduler.filters import core_filter
+from nova.scheduler.filters import disk_filter
+from nova.scheduler.filters import ram_filter
+
+from opie.scheduler import host_manager
+
+
+class ReclaimableView(object):
+    """View of a host state where the reclaimable resources are free.
+
+    Everything but the used resources is read from (and written to, like
+    the limits dict) the host state itself.
+    """
+
+    def __init__(self, host_state):
+        self.__dict__["_host_state"] = host_state
+        self.__dict__["free_ram_mb"] = (host_state.free_ram_mb +
+                                        host_state.preemptible_ram_mb)
+        self.__dict__["free_disk_mb"] = (host_state.free_disk_mb +
+                                         host_state.preemptible_disk_mb)
+        self.__dict__["vcpus_used"] = (host_state.vcpus_used -
+                                       host_state.preemptible_vcpus)
+
+    def __getattr__(self, name):
+        return getattr(self._host_state, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._host_state, name, value)
+
+    def __repr__(self):
+        return repr(self._host_state)
+
+
+class ReclaimableFilterMixin(object):
+    """Run the filter over a ReclaimableView for the normal requests."""
+
+    def host_passes(self, host_state, spec_obj):
+        if not host_manager.is_preemptible_request(spec_obj):
+            host_state = ReclaimableView(host_state)
+        return super(ReclaimableFilterMixin, self).host_passes(host_state,
+                                                               spec_obj)
+
+
+class ReclaimableRamFilter(ReclaimableFilterMixin, ram_filter.RamFilter):
+    """RamFilter where the preemptible instances are reclaimable."""
+
+
+class ReclaimableDiskFilter(ReclaimableFilterMixin, disk_filter.DiskFilter):
+    """DiskFilter where the preemptible instances are reclaimable."""
+
+
+class ReclaimableCoreFilter(ReclaimableFilterMixin, core_filter.CoreFilter):
+    """CoreFilter where the preemptible instances are reclaimable."""
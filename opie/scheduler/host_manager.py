@@ -19,18 +19,81 @@
 Manage hosts in the current zone taking into account spot instances.
 """
 
+import copy
+import datetime
+
+from eventlet import event
 import iso8601
 from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_utils import timeutils
 
+from nova import exception
 from nova.i18n import _LI, _LW  # noqa
 from nova import objects
 from nova.scheduler import host_manager as nova_host_manager
 from nova import utils
 import six
 
+from opie.scheduler import db
+from opie.scheduler import ledger
+from opie.scheduler import metrics
+
+opts = [
+    cfg.IntOpt('host_state_cache_ttl',
+               default=0,
+               min=0,
+               help='Number of seconds during which the host states are '
+                    'served from memory, instead of being refreshed from the '
+                    'database for each request. Within that time the '
+                    'scheduler relies on its own bookkeeping of the '
+                    'resources consumed by the requests. 0 disables the '
+                    'cache.'),
+    cfg.BoolOpt('delta_refresh',
+                default=False,
+                help='Only fetch and update the compute nodes that were '
+                     'created or updated since the previous refresh of the '
+                     'host states, instead of all of them.'),
+    cfg.BoolOpt('bulk_instance_load',
+                default=False,
+                help='Load the instances of all the refreshed compute nodes '
+                     'that are not tracked by the scheduler with a single '
+                     'query, fetching only the fields needed by opie, '
+                     'instead of one query per host.'),
+    cfg.BoolOpt('single_host_list',
+                default=False,
+                help='Filter and weigh the full host states for all the '
+                     'requests, instead of keeping a second list of host '
+                     'states where the resources of the preemptible '
+                     'instances are free for the normal requests. The '
+                     'ReclaimableRamFilter, ReclaimableDiskFilter and '
+                     'ReclaimableCoreFilter must be used instead of the '
+                     'RamFilter, DiskFilter and CoreFilter.'),
+    cfg.BoolOpt('coalesce_refreshes',
+                default=False,
+                help='Requests arriving while the host states are being '
+                     'refreshed from the database wait for that refresh and '
+                     'share its result, instead of refreshing them again.'),
+    cfg.IntOpt('preemption_reservation_ttl',
+               default=0,
+               min=0,
+               help='Maximum number of seconds during which the preemptible '
+                    'instances selected for termination, and the resources '
+                    'promised to the instances replacing them, are reserved '
+                    'on the host. Until the new instances are running or '
+                    'the time expires, the victims are not selected again '
+                    'by other requests, even if the host states are '
+                    'refreshed before they are deleted. 0 disables the '
+                    'reservations.'),
+    cfg.IntOpt('dead_node_check_interval',
+               default=60,
+               min=0,
+               help='When delta_refresh is enabled, number of seconds '
+                    'between two checks for deleted compute nodes.'),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(opts, group="preemptible_instances_scheduler")
 CONF.import_opt('scheduler_tracks_instance_changes',
                 'nova.scheduler.host_manager')
 CONF.import_opt('scheduler_weight_classes', 'nova.scheduler.host_manager')
@@ -39,13 +102,169 @@ CONF.import_opt('scheduler_available_filters', 'nova.scheduler.host_manager')
 
 LOG = logging.getLogger(__name__)
 
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Compute nodes updated this number of seconds before the last refresh are
+# fetched again, in case their transaction was committed late.
+DELTA_REFRESH_MARGIN = datetime.timedelta(seconds=5)
+
+
+def is_preemptible_instance(instance):
+    """Check if an instance (or an InstanceSummary) is a preemptible one."""
+    if isinstance(instance, InstanceSummary):
+        return instance.preemptible
+    return bool(instance.system_metadata.get("preemptible"))
+
+
+def is_preemptible_request(spec_obj):
+    """Check if a request spec is for preemptible instances."""
+    # NOTE(aloga): this is not lazy loadable
+    if not hasattr(spec_obj, "scheduler_hints"):
+        spec_obj.scheduler_hints = {}
+    hints = spec_obj.scheduler_hints.get("preemptible", [False])
+    return all([h == "True" for h in hints])
+
+
+def get_preemptible_instances(host_state):
+    """Return the InstanceSummary of the preemptible instances of a host."""
+    preemptibles = getattr(host_state, "preemptible_instances", None)
+    if preemptibles is not None:
+        return list(preemptibles.values())
+    return [InstanceSummary.from_instance(i)
+            for i in host_state.instances.values()
+            if is_preemptible_instance(i)]
+
+
+def to_timestamp(dt):
+    """Return a datetime as seconds since the epoch (now if it is None)."""
+    if dt is None:
+        dt = timeutils.utcnow()
+    return timeutils.delta_seconds(EPOCH, dt.replace(tzinfo=None))
+
+
+def _get_loaded_attr(instance, name):
+    """Return an attribute of an instance, or None if it is not loaded."""
+    if (hasattr(instance, "obj_attr_is_set") and
+            not instance.obj_attr_is_set(name)):
+        return None
+    return getattr(instance, name, None)
+
+
+class InstanceSummary(object):
+    """Compact record with the data of an instance used by the scheduler.
+
+    The host states keep these records instead of the Instance objects,
+    whose fields, metadata and flavor take several KB per instance. The
+    records can also be read as dicts (i.e. summary["uuid"]), like the
+    Instance objects.
+    """
+
+    __slots__ = ('uuid', 'memory_mb', 'disk_mb', 'vcpus', 'preemptible',
+                 'created_at', 'project_id', 'instance_type_id')
+
+    def __init__(self, uuid, memory_mb, disk_mb, vcpus, preemptible,
+                 created_at, project_id=None, instance_type_id=None):
+        self.uuid = uuid
+        self.memory_mb = memory_mb
+        self.disk_mb = disk_mb
+        self.vcpus = vcpus
+        self.preemptible = preemptible
+        # Seconds since the epoch
+        self.created_at = created_at
+        self.project_id = project_id
+        # Needed by the TypeAffinityFilter
+        self.instance_type_id = instance_type_id
+
+    @classmethod
+    def from_instance(cls, instance):
+        """Return the summary of an Instance object."""
+        if isinstance(instance, cls):
+            return instance
+        return cls(instance.uuid,
+                   instance.memory_mb,
+                   (instance.root_gb + instance.ephemeral_gb) * 1024,
+                   instance.vcpus,
+                   is_preemptible_instance(instance),
+                   to_timestamp(instance.created_at),
+                   project_id=_get_loaded_attr(instance, "project_id"),
+                   instance_type_id=_get_loaded_attr(instance,
+                                                     "instance_type_id"))
+
+    @classmethod
+    def from_db_row(cls, row):
+        """Return the summary of a db.get_instance_summaries_by_host() row."""
+        return cls(row.uuid,
+                   row.memory_mb or 0,
+                   ((row.root_gb or 0) + (row.ephemeral_gb or 0)) * 1024,
+                   row.vcpus or 0,
+                   bool(row.preemptible),
+                   to_timestamp(row.created_at),
+                   project_id=row.project_id,
+                   instance_type_id=row.instance_type_id)
 
-class HostStatePartial(nova_host_manager.HostState):
+    @property
+    def resources(self):
+        return (self.memory_mb, self.disk_mb, self.vcpus)
+
+    def matches(self, instance):
+        """Check if the summary is still valid for an instance.
+
+        That is, if the instance still has the same resources and it is
+        still preemptible (or not), as they may change (e.g. on a resize).
+        """
+        if instance is self:
+            return True
+        if isinstance(instance, InstanceSummary):
+            return (self.resources == instance.resources and
+                    self.preemptible == instance.preemptible)
+        return (self.memory_mb == instance.memory_mb and
+                self.vcpus == instance.vcpus and
+                self.disk_mb == (instance.root_gb +
+                                 instance.ephemeral_gb) * 1024 and
+                self.preemptible == is_preemptible_instance(instance))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return "<InstanceSummary %s>" % self.uuid
+
+
+def _get_change_time(compute):
+    """Return when a compute node was last changed, as a naive datetime."""
+    for field in ("updated_at", "created_at"):
+        if compute.obj_attr_is_set(field) and getattr(compute, field):
+            return getattr(compute, field).replace(tzinfo=None)
+    return None
+
+
+class HostState(nova_host_manager.HostState):
+    """HostState keeping track of the preemptible instances in the host.
+
+    Besides the preemptible and normal instances (as InstanceSummary
+    records), it keeps running totals of the resources used by the
+    preemptible instances, so that they do not
+    need to be recomputed from the instance list each time they are needed.
+    """
     def __init__(self, *args, **kwargs):
         self.normal_instances = {}
         self.preemptible_instances = {}
         self._instances = {}
-        super(HostStatePartial, self).__init__(*args, **kwargs)
+
+        # Resources used by the preemptible instances, that is, the
+        # resources that can be reclaimed for a normal request
+        self.num_preemptible_instances = 0
+        self.preemptible_ram_mb = 0
+        self.preemptible_disk_mb = 0
+        self.preemptible_vcpus = 0
+
+        # The HostStatePartial overlay of this state, if any
+        self.partial = None
+
+        super(HostState, self).__init__(*args, **kwargs)
 
     @property
     def instances(self):
@@ -53,63 +272,286 @@ class HostStatePartial(nova_host_manager.HostState):
 
     @instances.setter
     def instances(self, instances):
-        for instance in instances.values():
-            if instance.uuid in self._instances:
-                continue
+        # NOTE(aloga): we only keep a summary of each instance. In a single
+        # pass we reuse the summaries of the instances that did not change,
+        # and replace the ones of the new or changed instances. Then, if not
+        # all the previous instances were seen, the missing ones are removed.
+        previous = self._instances
+        summaries = {}
+        added = []
+        removed = []
+        for uuid, instance in six.iteritems(instances):
+            summary = previous.get(uuid)
+            if summary is not None and not summary.matches(instance):
+                removed.append(summary)
+                summary = None
+            if summary is None:
+                summary = InstanceSummary.from_instance(instance)
+                added.append(summary)
+            elif (summary.preemptible and
+                    uuid not in self.preemptible_instances):
+                # NOTE(aloga): it was selected for termination but it is still
+                # there (e.g. its deletion failed), so it can be reclaimed
+                # again. The victims of the preemptions in progress are left
+                # out of the instances by the host manager.
+                added.append(summary)
+            summaries[uuid] = summary
 
-            if instance.system_metadata.get("preemptible"):
-                self.preemptible_instances[instance.uuid] = instance
-                self._unconsume_from_request(instance)
+        if len(summaries) - len(added) + len(removed) != len(previous):
+            removed.extend(summary for uuid, summary in six.iteritems(previous)
+                           if uuid not in summaries)
+
+        self._remove_instances(removed)
+        self._add_instances(added)
+        self._instances = summaries
+
+    def _add_instances(self, summaries):
+        preemptibles = []
+        for summary in summaries:
+            if summary.preemptible:
+                self.preemptible_instances[summary.uuid] = summary
+                preemptibles.append(summary)
             else:
-                self.normal_instances[instance.uuid] = instance
+                self.normal_instances[summary.uuid] = summary
+        self._account_preemptibles(preemptibles, 1)
+
+    def _remove_instances(self, summaries):
+        preemptibles = []
+        for summary in summaries:
+            # NOTE(aloga): the preemptible instance may have been already
+            # removed if it was selected for termination.
+            if self.preemptible_instances.pop(summary.uuid, None) is not None:
+                preemptibles.append(summary)
+            self.normal_instances.pop(summary.uuid, None)
+        self._account_preemptibles(preemptibles, -1)
 
-        self._instances = instances
+    def _account_preemptibles(self, summaries, sign):
+        if not summaries:
+            return
+        ram_mb = disk_mb = vcpus = 0
+        for summary in summaries:
+            ram_mb += summary.memory_mb
+            disk_mb += summary.disk_mb
+            vcpus += summary.vcpus
+        self.num_preemptible_instances += sign * len(summaries)
+        self.preemptible_ram_mb += sign * ram_mb
+        self.preemptible_disk_mb += sign * disk_mb
+        self.preemptible_vcpus += sign * vcpus
 
-    def _unconsume_from_request(self, spec_obj):
-        """Incrementally update host state from an instance."""
+    def unconsume_instances(self, summaries):
+        """Give back to the host the resources used by some instances.
+
+        The resources of all the instances are added up and applied at once,
+        acquiring the host lock and updating the timestamp only once.
+        """
+        if not summaries:
+            return
+        ram_mb = disk_mb = vcpus = 0
+        for summary in summaries:
+            ram_mb += summary.memory_mb
+            disk_mb += summary.disk_mb
+            vcpus += summary.vcpus
+        self._give_back(ram_mb, disk_mb, vcpus, len(summaries))
 
+    def consume_reserved(self, reservations):
+        """Consume the resources promised to instances not built yet.
+
+        :param reservations: a list of ledger.Reservation objects.
+        """
+        if not reservations:
+            return
+        ram_mb = disk_mb = vcpus = num_instances = 0
+        for reservation in reservations:
+            ram_mb += reservation.resources[0]
+            disk_mb += reservation.resources[1]
+            vcpus += reservation.resources[2]
+            num_instances += reservation.placements
+        self._give_back(-ram_mb, -disk_mb, -vcpus, -num_instances)
+
+    def _give_back(self, ram_mb, disk_mb, vcpus, num_instances):
         @utils.synchronized(self._lock_name)
-        @nova_host_manager.set_update_time_on_success
-        def _locked(self, spec_obj):
+        def _locked(self):
             # Scheduler API is inherently multi-threaded as every incoming RPC
             # message will be dispatched in it's own green thread. So the
-            # shared host state should be consumed in a consistent way to make
+            # shared host state should be updated in a consistent way to make
             # sure its data is valid under concurrent write operations.
-            self._locked_unconsume_from_request(spec_obj)
-        return _locked(self, spec_obj)
+            self.free_ram_mb += ram_mb
+            self.free_disk_mb += disk_mb
+            self.vcpus_used -= vcpus
+            self.num_instances -= num_instances
 
-    def _locked_unconsume_from_request(self, spec_obj):
-        disk_mb = (spec_obj.root_gb + spec_obj.ephemeral_gb) * 1024
-        ram_mb = spec_obj.memory_mb
-        vcpus = spec_obj.vcpus
-        self.free_ram_mb += ram_mb
-        self.free_disk_mb += disk_mb
-        self.vcpus_used -= vcpus
+            now = timeutils.utcnow()
+            # NOTE(sbauza): Objects are UTC tz-aware by default
+            self.updated = now.replace(tzinfo=iso8601.iso8601.Utc())
 
-        now = timeutils.utcnow()
-        # NOTE(sbauza): Objects are UTC tz-aware by default
-        self.updated = now.replace(tzinfo=iso8601.iso8601.Utc())
+        return _locked(self)
 
-        # Track number of instances on host
-        self.num_instances -= 1
+    def update(self, *args, **kwargs):
+        super(HostState, self).update(*args, **kwargs)
+        if self.partial is not None:
+            self.partial.reset()
+
+    def consume_from_request(self, spec_obj):
+        # The partial view is derived from our data, so take it before it
+        # changes locally.
+        if self.partial is not None:
+            self.partial.detach()
+        return super(HostState, self).consume_from_request(spec_obj)
+
+    def remove_preemptible_instances(self, uuids):
+        """Stop accounting the given preemptible instances.
+
+        This is used when the instances are selected for termination, so
+        that they are not taken into account anymore, and their resources
+        are given back to the host.
+        """
+        removed = []
+        for uuid in uuids:
+            summary = self.preemptible_instances.pop(uuid, None)
+            if summary is not None:
+                removed.append(summary)
+        self._account_preemptibles(removed, -1)
+        self.unconsume_instances(removed)
 
     def __repr__(self):
         return ("(%s, %s) ram:%s disk:%s io_ops:%s "
                 "instances:%s (preemptible:%s)" %
                 (self.host, self.nodename, self.free_ram_mb, self.free_disk_mb,
                  self.num_io_ops, self.num_instances,
-                 len(self.preemptible_instances)))
+                 self.num_preemptible_instances))
+
+
+class HostStatePartial(HostState):
+    """HostState that considers the preemptible instances as free.
+
+    It is a thin copy-on-write overlay over the full host state, so that the
+    host data and the instances are not stored (nor updated) twice. All the
+    attributes are read from the full state, except the resources used by
+    the preemptible instances (see OVERLAY_FIELDS), that are computed from
+    the preemptible totals of the full state the first time they are read.
+    Any attribute set on the overlay (e.g. when consuming resources for a
+    request) shadows the one of the full state, until the full state is
+    updated again from the database.
+    """
+
+    # Fields adjusted with the resources used by the preemptible instances
+    OVERLAY_FIELDS = ("free_ram_mb", "free_disk_mb", "vcpus_used",
+                      "num_instances")
+    # Fields modified when consuming resources for a request
+    CONSUMED_FIELDS = ("num_io_ops", "numa_topology", "pci_stats", "updated")
+
+    # The overlay does not have an overlay of its own
+    partial = None
+
+    def __init__(self, host_state):
+        self.__dict__["_full"] = host_state
+        self.__dict__["limits"] = {}
+        host_state.partial = self
+
+    def __getattr__(self, name):
+        # NOTE(aloga): this is only called for the attributes that are not
+        # set in the overlay itself.
+        full = self.__dict__.get("_full")
+        if full is None or name.startswith("__"):
+            raise AttributeError(name)
+        if name in self.OVERLAY_FIELDS:
+            self.materialize()
+            return self.__dict__[name]
+        return getattr(full, name)
+
+    @property
+    def instances(self):
+        return self._full.instances
+
+    def materialize(self):
+        """Compute the overlay fields from the full state, if not done yet."""
+        full = self._full
+        values = {
+            "free_ram_mb": full.free_ram_mb + full.preemptible_ram_mb,
+            "free_disk_mb": full.free_disk_mb + full.preemptible_disk_mb,
+            "vcpus_used": full.vcpus_used - full.preemptible_vcpus,
+            "num_instances": (full.num_instances -
+                              full.num_preemptible_instances),
+        }
+        for field, value in six.iteritems(values):
+            self.__dict__.setdefault(field, value)
+
+    def detach(self):
+        """Copy from the full state all the fields changed when consuming.
+
+        This is done before the overlay or the full state consumes resources
+        for a request, so that they do not see each other's changes.
+        """
+        self.materialize()
+        full = self._full
+        for field in self.CONSUMED_FIELDS:
+            if field not in self.__dict__:
+                # NOTE(aloga): the PCI stats are updated in place
+                self.__dict__[field] = copy.deepcopy(getattr(full, field))
+
+    def reset(self):
+        """Drop everything set on the overlay, except the limits."""
+        full = self._full
+        limits = self.limits
+        self.__dict__.clear()
+        self.__dict__.update(_full=full, limits=limits)
+
+    def update(self, *args, **kwargs):
+        """Update the full state (and therefore the overlay)."""
+        self._full.update(*args, **kwargs)
+
+    def consume_from_request(self, spec_obj):
+        self.detach()
+        return super(HostStatePartial, self).consume_from_request(spec_obj)
+
+    def remove_preemptible_instances(self, uuids):
+        self._full.remove_preemptible_instances(uuids)
 
 
 class HostManager(nova_host_manager.HostManager):
 
     # Can be overridden in a subclass
-    def host_state_cls_partial(self, host, node, **kwargs):
-        return HostStatePartial(host, node)
+    def host_state_cls(self, host, node, **kwargs):
+        return HostState(host, node)
+
+    # Can be overridden in a subclass
+    def host_state_cls_partial(self, host_state, **kwargs):
+        return HostStatePartial(host_state)
 
     def __init__(self):
+        # NOTE(aloga): the aggregates of each host are cached, and only
+        # rebuilt for the hosts affected by a change in the aggregates. The
+        # generation is increased on each change. This has to be set before
+        # calling the parent constructor, as it loads the aggregates.
+        self.aggregates_generation = 0
+        self._host_aggregates_info = {}
+        self._refreshed_aggregates_generation = None
+
         super(HostManager, self).__init__()
         self.host_state_map_partial = {}
+        self.metrics = metrics.get_registry()
+        self.preemption_ledger = ledger.PreemptionLedger(
+            CONF.preemptible_instances_scheduler.preemption_reservation_ttl)
+
+        # NOTE(aloga): the generation is increased each time that the host
+        # states are refreshed from the database. Each map records the
+        # generation of its last refresh, so that the cache is only used
+        # when both maps come from the same data.
+        self.generation = 0
+        self._map_generation = {False: None, True: None}
+        self._cached_nodes = []
+        self._cache_watch = None
+        self._stale_hosts = set()
+        # The (partial, event) of the refresh in progress, if any, that
+        # concurrent requests wait for instead of refreshing again.
+        self._inflight_refresh = None
+
+        # Delta refresh: the last updated_at seen, and the (host, node) key
+        # of each compute node, by id.
+        self._watermark = None
+        self._nodes_by_id = {}
+        self._sorted_nodes = None
+        self._dead_node_watch = None
 
     def get_all_host_states(self, context):
         """Returns a list of HostStates that represents all the hosts the
@@ -123,6 +565,29 @@ class HostManager(nova_host_manager.HostManager):
         """
         return self._get_all_host_states(context, partial=True)
 
+    def get_host_state_snapshot(self, context, partial=True):
+        """Returns the full and partial host states from a single refresh.
+
+        Both lists are built from the same database fetch, so they reflect
+        the same moment and contain the same (host, node) pairs in the same
+        order. If partial is False, only the full states are refreshed and
+        the second element of the tuple is None.
+        """
+        seen_nodes = self._get_seen_nodes(context, partial=partial)
+
+        # NOTE(aloga): we return lists instead of iterators over the maps, as
+        # a concurrent request could remove a dead node from them while we
+        # are still iterating.
+        full = [self.host_state_map[state_key] for state_key in seen_nodes
+                if state_key in self.host_state_map]
+        if not partial:
+            return full, None
+        partial_states = [self.host_state_map_partial[h.host, h.nodename]
+                          for h in full
+                          if (h.host, h.nodename) in
+                          self.host_state_map_partial]
+        return full, partial_states
+
     def _get_all_host_states(self, context, partial=False):
         """Returns a list of HostStates that represents all the hosts
         the HostManager knows about. Also, each of the consumable resources
@@ -134,12 +599,260 @@ class HostManager(nova_host_manager.HostManager):
                         preemptible instances will not be taken into account,
                         so their consumed resources will considered as free.
         """
+        self._get_seen_nodes(context, partial=partial)
+        if partial:
+            return six.itervalues(self.host_state_map_partial)
+        else:
+            return six.itervalues(self.host_state_map)
+
+    def _init_aggregates(self):
+        super(HostManager, self)._init_aggregates()
+        self._aggregates_changed()
+
+    def _update_aggregate(self, aggregate):
+        hosts = self._get_aggregate_hosts(aggregate)
+        super(HostManager, self)._update_aggregate(aggregate)
+        self._aggregates_changed(hosts.union(aggregate.hosts))
+
+    def delete_aggregate(self, aggregate):
+        hosts = self._get_aggregate_hosts(aggregate)
+        super(HostManager, self).delete_aggregate(aggregate)
+        self._aggregates_changed(hosts)
+
+    def _get_aggregate_hosts(self, aggregate):
+        """Return the hosts that are currently mapped to an aggregate."""
+        return set(host for host, agg_ids in
+                   six.iteritems(self.host_aggregates_map)
+                   if aggregate.id in agg_ids)
+
+    def _aggregates_changed(self, hosts=None):
+        """Drop the cached aggregates of the hosts, or of all if None."""
+        self.aggregates_generation += 1
+        if hosts is None:
+            self._host_aggregates_info.clear()
+            return
+        for host in hosts:
+            self._host_aggregates_info.pop(host, None)
+
+    def _get_aggregates_info(self, host):
+        """Return the aggregates of a host, building them if not cached."""
+        aggregates = self._host_aggregates_info.get(host)
+        if aggregates is None:
+            aggregates = super(HostManager, self)._get_aggregates_info(host)
+            self._host_aggregates_info[host] = aggregates
+        return aggregates
+
+    def invalidate(self, host_state=None):
+        """Invalidate the cached host states.
+
+        If a host state is given, only that host is refreshed from the
+        database on the next request, otherwise all the hosts are refreshed.
+        This is used when the local bookkeeping of a host cannot be trusted
+        anymore, e.g. when resources were consumed for a request that could
+        not be fulfilled.
+        """
+        if host_state is None:
+            self._cache_watch = None
+            return
+
+        state_key = (host_state.host, host_state.nodename)
+        state = self.host_state_map.get(state_key)
+        if state is not None:
+            # Do not skip the compute node data on the next update
+            state.updated = None
+        self._stale_hosts.add(state_key)
+
+    def _cache_is_valid(self, partial):
+        if (not CONF.preemptible_instances_scheduler.host_state_cache_ttl or
+                self._cache_watch is None or self._cache_watch.expired()):
+            return False
+        if self._map_generation[False] != self.generation:
+            return False
+        return not partial or self._map_generation[True] == self.generation
+
+    def _get_seen_nodes(self, context, partial=False):
+        """Return the (host, node) keys of the active nodes.
+
+        The host states are refreshed from the database, unless the cache is
+        enabled and still valid for the requested maps. In that case only the
+        invalidated hosts (if any) are refreshed. If coalesce_refreshes is
+        enabled, the requests arriving while the maps they need are being
+        refreshed wait for that refresh and get its result.
+        """
+        if self._cache_is_valid(partial):
+            if self._stale_hosts:
+                with self.metrics.timer("refresh_stale_hosts"):
+                    self._refresh_stale_hosts(context)
+            return self._cached_nodes
+
+        if not CONF.preemptible_instances_scheduler.coalesce_refreshes:
+            return self._refresh_seen_nodes(context, partial)
+
+        # Join the refresh in progress, if it refreshes the maps we need
+        if self._inflight_refresh is not None:
+            inflight_partial, done = self._inflight_refresh
+            if inflight_partial or not partial:
+                with self.metrics.timer("refresh_wait", partial=partial):
+                    return done.wait()
+
+        covers_partial = (partial or
+                          CONF.preemptible_instances_scheduler.delta_refresh)
+        done = event.Event()
+        self._inflight_refresh = (covers_partial, done)
+        try:
+            seen_nodes = self._refresh_seen_nodes(context, partial)
+        except Exception as e:
+            done.send_exception(e)
+            raise
+        else:
+            done.send(seen_nodes)
+        finally:
+            if (self._inflight_refresh is not None and
+                    self._inflight_refresh[1] is done):
+                self._inflight_refresh = None
+        return seen_nodes
+
+    def _refresh_seen_nodes(self, context, partial):
+        """Refresh the host states, returning the keys of the active nodes."""
+        with self.metrics.timer("refresh_host_states", partial=partial):
+            seen_nodes = self._refresh_host_states(context, partial=partial)
+
+        self.generation += 1
+        self._map_generation[False] = self.generation
+        if partial or CONF.preemptible_instances_scheduler.delta_refresh:
+            self._map_generation[True] = self.generation
+        self._cached_nodes = seen_nodes
+        self._stale_hosts.clear()
+        ttl = CONF.preemptible_instances_scheduler.host_state_cache_ttl
+        if ttl:
+            self._cache_watch = timeutils.StopWatch(duration=ttl)
+            self._cache_watch.start()
+        return seen_nodes
+
+    def _refresh_stale_hosts(self, context):
+        """Refresh the invalidated hosts from the database, one by one."""
+        stale_hosts, self._stale_hosts = self._stale_hosts, set()
+        for host, node in stale_hosts:
+            try:
+                compute = objects.ComputeNode.get_by_host_and_nodename(
+                    context, host, node)
+                service = objects.Service.get_by_compute_host(context, host)
+            except exception.NotFound:
+                # The node is gone, refresh everything on the next request
+                self.invalidate()
+                continue
+            self._update_host_states(context, compute, service,
+                                     (host, node) in
+                                     self.host_state_map_partial)
+
+        # Both maps have been updated with the same data, so they keep being
+        # coherent with each other.
+        previous = self.generation
+        self.generation += 1
+        for partial, generation in self._map_generation.items():
+            if generation == previous:
+                self._map_generation[partial] = self.generation
+
+    def _update_host_states(self, context, compute, service, partial,
+                            inst_dict=None):
+        """Update the host state of a compute node with the db data.
+
+        If partial is True, the node gets a partial host state too, that is
+        an overlay over the full one and therefore does not need to be
+        updated separately. If inst_dict is None, the instances of the node
+        are obtained with _get_instance_info().
+        """
+        host = compute.host
+        node = compute.hypervisor_hostname
+        state_key = (host, node)
+        host_state = self.host_state_map.get(state_key)
+        if not host_state:
+            host_state = self.host_state_cls(host, node, compute=compute)
+            self.host_state_map[state_key] = host_state
+
+        # The aggregates info is set on each update, as it could have
+        # changed after setting this field for the first time. It is cached,
+        # so this is cheap.
+        if inst_dict is None:
+            inst_dict = self._get_instance_info(context, compute)
+
+        reservations = self.preemption_ledger.get_reservations(state_key)
+        if reservations:
+            inst_dict, pending, built = self._apply_reservations(
+                host_state, compute, inst_dict, reservations)
+            if built:
+                self.preemption_ledger.release(state_key, built)
+        host_state.update(compute,
+                          dict(service),
+                          self._get_aggregates_info(host),
+                          inst_dict)
+        if reservations:
+            host_state.consume_reserved(pending)
+
+        if partial and state_key not in self.host_state_map_partial:
+            self.host_state_map_partial[state_key] = (
+                self.host_state_cls_partial(host_state, compute=compute))
+        return state_key
+
+    @staticmethod
+    def _apply_reservations(host_state, compute, inst_dict, reservations):
+        """Take into account the preemptions in progress on a host.
+
+        The reserved victims are left out of the instances of the host, so
+        that they are not accounted as preemptible instances anymore, but
+        their resources are still used according to the compute node. Once
+        they are gone, the compute node does not account for the resources
+        promised to the instance replacing them until it is built, so the
+        reservations whose victims are gone are returned, in order to
+        consume them again. This is only needed if the compute node data is
+        applied to the host state, that is, if it is newer than the host
+        state (see nova's HostState._update_from_compute_node()). Once the
+        victims are gone and the new instances are running on the host, the
+        compute node accounts for them, and the reservations are returned as
+        built, so that they are released.
+
+        :returns: a tuple with the instances, the pending reservations and
+                  the built reservations.
+        """
+        victims = set()
+        gone = []
+        built = []
+        for reservation in reservations:
+            victims.update(reservation.victims)
+            if not any(uuid in inst_dict for uuid in reservation.victims):
+                if reservation.is_built(inst_dict):
+                    built.append(reservation)
+                else:
+                    gone.append(reservation)
+        filtered = {uuid: instance for uuid, instance in
+                    six.iteritems(inst_dict) if uuid not in victims}
+
+        if (host_state.updated and compute.updated_at and
+                host_state.updated > compute.updated_at):
+            return filtered, [], built
+        return filtered, gone, built
+
+    def _refresh_host_states(self, context, partial=False):
+        """Refresh the host state maps with the data in the db.
+
+        The services, compute nodes and instances are fetched only once, and
+        if partial is True the very same data is used to update both the
+        full and the partial host states.
+
+        :returns: a list with the (host, node) keys of the active nodes, in
+                  the order they were returned by the db.
+        """
+        if CONF.preemptible_instances_scheduler.delta_refresh:
+            return self._refresh_host_states_delta(context)
+
         service_refs = {service.host: service
                         for service in objects.ServiceList.get_by_binary(
                             context, 'nova-compute')}
         # Get resource usage across the available compute nodes:
         compute_nodes = objects.ComputeNodeList.get_all(context)
-        seen_nodes = set()
+        instance_info = self._get_bulk_instance_info(context, compute_nodes,
+                                                     service_refs)
+        seen_nodes = []
         for compute in compute_nodes:
             service = service_refs.get(compute.host)
 
@@ -148,51 +861,167 @@ class HostManager(nova_host_manager.HostManager):
                     "No compute service record found for host %(host)s"),
                     {'host': compute.host})
                 continue
-            host = compute.host
-            node = compute.hypervisor_hostname
-            state_key = (host, node)
-            host_state = self.host_state_map.get(state_key)
-            if not host_state:
-                host_state = self.host_state_cls(host, node, compute=compute)
-                self.host_state_map[state_key] = host_state
-
-            if partial:
-                host_state_partial = self.host_state_map_partial.get(state_key)
-                if not host_state_partial:
-                    host_state_partial = self.host_state_cls_partial(
-                        host, node, compute=compute
-                    )
-                    self.host_state_map_partial[state_key] = host_state_partial
-
-            # We force to update the aggregates info each time a new request
-            # comes in, because some changes on the aggregates could have been
-            # happening after setting this field for the first time
-            if partial:
-                iter_over = (host_state, host_state_partial)
-            else:
-                iter_over = (host_state,)
-            for aux in iter_over:
-                aux.aggregates = [self.aggs_by_id[agg_id] for agg_id in
-                                  self.host_aggregates_map[
-                                      aux.host]]
-                aux.update(compute,
-                           dict(service),
-                           self._get_aggregates_info(host),
-                           self._get_instance_info(context, compute))
-
-            seen_nodes.add(state_key)
+            state_key = self._update_host_states(
+                context, compute, service, partial,
+                instance_info.get(compute.host))
+            seen_nodes.append(state_key)
 
         # remove compute nodes from host_state_map if they are not active
-        dead_nodes = set(self.host_state_map.keys()) - seen_nodes
+        dead_nodes = set(self.host_state_map.keys()) - set(seen_nodes)
         for state_key in dead_nodes:
             host, node = state_key
             LOG.info(_LI("Removing dead compute node %(host)s:%(node)s "
                          "from scheduler"), {'host': host, 'node': node})
             del self.host_state_map[state_key]
-            if partial:
-                del self.host_state_map_partial[state_key]
+            self.host_state_map_partial.pop(state_key, None)
+            self.preemption_ledger.discard(state_key)
 
-        if partial:
-            return six.itervalues(self.host_state_map_partial)
-        else:
-            return six.itervalues(self.host_state_map)
+        return seen_nodes
+
+    def _refresh_host_states_delta(self, context):
+        """Refresh only the compute nodes that changed since the last time.
+
+        The compute nodes created or updated since the last refresh (the
+        watermark) are fetched and applied to the full host states and,
+        unless single_host_list is enabled, to the partial ones. The rest of
+        the host states are kept, only updating their service (so that the
+        liveness of the hosts is up to date) and, if they changed, their
+        aggregates. The invalidated hosts are always read again. Deleted
+        compute nodes are detected every dead_node_check_interval seconds,
+        fetching only their ids.
+
+        :returns: a list with the (host, node) keys of the active nodes,
+                  sorted by compute node id.
+        """
+        service_refs = {service.host: service
+                        for service in objects.ServiceList.get_by_binary(
+                            context, 'nova-compute')}
+
+        since = self._watermark
+        if since is not None:
+            since -= DELTA_REFRESH_MARGIN
+        compute_nodes = db.get_compute_nodes_changed_since(context, since)
+        instance_info = self._get_bulk_instance_info(context, compute_nodes,
+                                                     service_refs)
+        # No partial host states are needed if the scheduler only uses the
+        # full ones
+        partial = not CONF.preemptible_instances_scheduler.single_host_list
+
+        changed = set()
+        for compute in compute_nodes:
+            timestamp = _get_change_time(compute)
+            if timestamp is not None and (self._watermark is None or
+                                          timestamp > self._watermark):
+                self._watermark = timestamp
+
+            service = service_refs.get(compute.host)
+            if not service:
+                LOG.warning(_LW(
+                    "No compute service record found for host %(host)s"),
+                    {'host': compute.host})
+                continue
+            state_key = self._update_host_states(
+                context, compute, service, partial,
+                instance_info.get(compute.host))
+            changed.add(state_key)
+            if self._nodes_by_id.get(compute.id) != state_key:
+                self._nodes_by_id[compute.id] = state_key
+                self._sorted_nodes = None
+
+        # The invalidated hosts are read again even if their compute node has
+        # not changed, as their host state cannot be trusted anymore
+        stale_hosts = [state_key for state_key, state
+                       in six.iteritems(self.host_state_map)
+                       if state_key not in changed and
+                       (state.updated is None or
+                        state_key in self._stale_hosts)]
+        for host, node in stale_hosts:
+            service = service_refs.get(host)
+            if not service:
+                continue
+            try:
+                compute = objects.ComputeNode.get_by_host_and_nodename(
+                    context, host, node)
+            except exception.NotFound:
+                # It is removed once it is detected as a dead node
+                continue
+            changed.add(self._update_host_states(context, compute, service,
+                                                 partial))
+
+        dead_ids = self._find_dead_nodes(context)
+        update_aggregates = (self._refreshed_aggregates_generation !=
+                             self.aggregates_generation)
+        self._refreshed_aggregates_generation = self.aggregates_generation
+        for compute_id, state_key in six.iteritems(self._nodes_by_id):
+            if state_key in changed:
+                continue
+            host = state_key[0]
+            service = service_refs.get(host)
+            if not service:
+                dead_ids.add(compute_id)
+                continue
+            # The partial host states see these through their overlay
+            state = self.host_state_map.get(state_key)
+            if state is not None:
+                state.service = dict(service)
+                if update_aggregates:
+                    state.aggregates = self._get_aggregates_info(host)
+
+        for compute_id in dead_ids:
+            state_key = self._nodes_by_id.pop(compute_id, None)
+            if state_key is None:
+                continue
+            self._sorted_nodes = None
+            host, node = state_key
+            LOG.info(_LI("Removing dead compute node %(host)s:%(node)s "
+                         "from scheduler"), {'host': host, 'node': node})
+            self.host_state_map.pop(state_key, None)
+            self.host_state_map_partial.pop(state_key, None)
+            self.preemption_ledger.discard(state_key)
+
+        if self._sorted_nodes is None:
+            self._sorted_nodes = [self._nodes_by_id[compute_id] for compute_id
+                                  in sorted(self._nodes_by_id)]
+        return self._sorted_nodes
+
+    def _get_bulk_instance_info(self, context, compute_nodes, service_refs):
+        """Return the instances of the compute nodes, grouped by host.
+
+        If bulk_instance_load is disabled an empty dict is returned, so that
+        the instances of each node are obtained with _get_instance_info().
+        Otherwise the hosts whose instances are tracked use the tracked
+        instances, as _get_instance_info() does, and the InstanceSummary of
+        the instances of the rest of the hosts are loaded with a single
+        query. The nodes without a service are ignored.
+        """
+        if not CONF.preemptible_instances_scheduler.bulk_instance_load:
+            return {}
+
+        instance_info = {}
+        untracked = []
+        for compute in compute_nodes:
+            host = compute.host
+            if host in instance_info or host not in service_refs:
+                continue
+            host_info = self._instance_info.get(host)
+            if host_info and host_info.get("updated"):
+                instance_info[host] = host_info["instances"]
+            else:
+                instance_info[host] = {}
+                untracked.append(host)
+
+        for row in db.get_instance_summaries_by_host(context, untracked):
+            instance_info[row.host][row.uuid] = InstanceSummary.from_db_row(
+                row)
+        return instance_info
+
+    def _find_dead_nodes(self, context):
+        """Return the ids of the deleted nodes, if it is time to check."""
+        if (self._dead_node_watch is not None and
+                not self._dead_node_watch.expired()):
+            return set()
+        self._dead_node_watch = timeutils.StopWatch(
+            duration=CONF.preemptible_instances_scheduler.
+            dead_node_check_interval)
+        self._dead_node_watch.start()
+        return set(self._nodes_by_id) - db.get_compute_node_ids(context)
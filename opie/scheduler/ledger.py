@@ -0,0 +1,143 @@
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Ledger of the preemptions in progress.
+
+When a normal instance is scheduled on a host that needs some preemptible
+instances to be terminated, the selected instances (the victims) and the
+resources promised to the new instances are reserved in the ledger, until the
+new instances are running on the host or the reservation expires. The host
+manager takes the reservations into account when the host states are
+refreshed from the database, so that the victims are not selected again by a
+concurrent request while they are being deleted, and the resources they free
+are not promised twice.
+"""
+
+from oslo_utils import timeutils
+
+
+class Reservation(object):
+    """Victims and resources reserved on a host for new instances.
+
+    :param victims: the UUIDs of the instances to terminate.
+    :param resources: a (ram_mb, disk_mb, vcpus) tuple with the resources of
+                      all the new instances.
+    :param expires: the time (as returned by timeutils.now()) when the
+                    reservation expires.
+    :param instances: the UUIDs of the new instances, if known.
+    :param placements: the number of new instances placed on the host.
+    :param baseline: the UUIDs of the instances that were already on the
+                     host, used to detect the new instances whose UUID is
+                     not known.
+    """
+
+    __slots__ = ("victims", "resources", "expires", "instances", "placements",
+                 "baseline")
+
+    def __init__(self, victims, resources, expires, instances=(),
+                 placements=1, baseline=()):
+        self.victims = frozenset(victims)
+        self.resources = resources
+        self.expires = expires
+        self.instances = frozenset(instances)
+        self.placements = placements
+        self.baseline = frozenset(baseline)
+
+    def is_built(self, uuids):
+        """Return whether the new instances are among the given ones.
+
+        If the UUIDs of all the new instances are known they must be there,
+        otherwise there must be as many instances that were not on the host
+        when the reservation was made.
+        """
+        if len(self.instances) >= self.placements:
+            return all(uuid in uuids for uuid in self.instances)
+        arrived = [uuid for uuid in uuids
+                   if uuid not in self.baseline and uuid not in self.victims]
+        return len(arrived) >= self.placements
+
+    def __repr__(self):
+        return "<Reservation victims:%s resources:%s instances:%s>" % (
+            sorted(self.victims), self.resources, sorted(self.instances))
+
+
+class PreemptionLedger(object):
+    """Reservations of the preemptions in progress, by (host, node)."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._reservations = {}
+
+    @staticmethod
+    def lock_name(state_key):
+        """Return the name of the lock for the preemptions on a host."""
+        return "opie-preemption-%s-%s" % state_key
+
+    def reserve(self, state_key, victims, resources, instances=(),
+                placements=1, baseline=(), ttl=None):
+        """Reserve the victims and resources for new instances on a host.
+
+        :param victims: the UUIDs of the instances to terminate.
+        :param resources: a (ram_mb, disk_mb, vcpus) tuple with the resources
+                          of all the new instances.
+        :param instances: the UUIDs of the new instances, if known.
+        :param placements: the number of new instances placed on the host.
+        :param baseline: the UUIDs of the instances already on the host.
+        :param ttl: the number of seconds the reservation lasts at most, by
+                    default the ttl of the ledger. 0 means no reservation.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        if not ttl or not victims:
+            return
+        reservation = Reservation(victims, resources,
+                                  timeutils.now() + ttl,
+                                  instances=instances, placements=placements,
+                                  baseline=baseline)
+        self._reservations.setdefault(state_key, []).append(reservation)
+
+    def get_reservations(self, state_key):
+        """Return the reservations on a host that did not expire yet."""
+        reservations = self._reservations.get(state_key)
+        if not reservations:
+            return []
+        now = timeutils.now()
+        active = [r for r in reservations if r.expires > now]
+        if not active:
+            del self._reservations[state_key]
+        elif len(active) != len(reservations):
+            self._reservations[state_key] = active
+        return active
+
+    def get_victims(self, state_key):
+        """Return the UUIDs of the victims reserved on a host."""
+        victims = set()
+        for reservation in self.get_reservations(state_key):
+            victims.update(reservation.victims)
+        return victims
+
+    def release(self, state_key, reservations):
+        """Drop some reservations on a host, e.g. once they are built."""
+        active = [r for r in self._reservations.get(state_key, [])
+                  if r not in reservations]
+        if active:
+            self._reservations[state_key] = active
+        else:
+            self._reservations.pop(state_key, None)
+
+    def discard(self, state_key):
+        """Drop the reservations on a host, e.g. when the node is gone."""
+        self._reservations.pop(state_key, None)
@@ -0,0 +1,366 @@
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Timing of the scheduler phases.
+
+The timings are recorded in histograms, tagged with a set of key/value pairs
+(e.g. the request type), and exported to a local sink: a Prometheus textfile
+(to be collected by the node exporter) or a statsd daemon over UDP. Events
+that are counted rather than timed are recorded in counters, and values that
+go up and down (e.g. the length of a queue) in gauges. When the metrics are
+disabled a null registry is used, whose timers do nothing.
+"""
+
+import bisect
+import os
+import socket
+import tempfile
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import timeutils
+import six
+
+from nova.i18n import _LW
+
+LOG = logging.getLogger(__name__)
+
+metrics_opts = [
+    cfg.BoolOpt('metrics_enabled',
+                default=False,
+                help='Record the time spent in each phase of the '
+                     'scheduling.'),
+    cfg.StrOpt('metrics_sink',
+               default='textfile',
+               choices=('textfile', 'statsd'),
+               help='Where the timings are exported: a Prometheus textfile '
+                    'or a statsd daemon.'),
+    cfg.StrOpt('metrics_textfile_path',
+               default='/var/lib/prometheus/node-exporter/opie.prom',
+               help='File where the histograms are written, in the '
+                    'Prometheus text format, when the textfile sink is '
+                    'used.'),
+    cfg.IntOpt('metrics_flush_interval',
+               default=15,
+               min=0,
+               help='Minimum number of seconds between two writes of the '
+                    'Prometheus textfile.'),
+    cfg.StrOpt('metrics_statsd_host',
+               default='127.0.0.1',
+               help='Host of the statsd daemon.'),
+    cfg.IntOpt('metrics_statsd_port',
+               default=8125,
+               min=1,
+               max=65535,
+               help='UDP port of the statsd daemon.'),
+    cfg.StrOpt('metrics_prefix',
+               default='opie_scheduler',
+               help='Prefix of the exported metric names.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(metrics_opts, group="preemptible_instances_scheduler")
+
+# Upper bounds (in seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """A histogram of observed values, with fixed buckets."""
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # The last one is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """Return a list of (upper bound, cumulative count) tuples."""
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Timer(object):
+    """Time a block of code, either as a context manager or with stop()."""
+
+    __slots__ = ('registry', 'name', 'tags', '_watch')
+
+    def __init__(self, registry, name, tags):
+        self.registry = registry
+        self.name = name
+        self.tags = tags
+        self._watch = timeutils.StopWatch()
+        self._watch.start()
+
+    def stop(self, **tags):
+        """Record the elapsed time, adding the given tags."""
+        self.tags.update(tags)
+        self.registry.observe(self.name, self._watch.elapsed(), **self.tags)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class _NullTimer(object):
+    def stop(self, **tags):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class NullRegistry(object):
+    """A registry that does not record anything."""
+
+    _timer = _NullTimer()
+
+    def timer(self, name, **tags):
+        return self._timer
+
+    def observe(self, name, value, **tags):
+        pass
+
+    def increment(self, name, value=1, **tags):
+        pass
+
+    def gauge(self, name, value, **tags):
+        pass
+
+    def flush(self):
+        pass
+
+
+class MetricsRegistry(object):
+    """Histograms of the scheduler timings, counters and gauges.
+
+    All of them are keyed by name and tags.
+
+    :param sink: the object the observations are exported to.
+    :param flush_interval: minimum number of seconds between two flushes of
+                           the sink.
+    """
+
+    def __init__(self, sink, flush_interval=0, buckets=DEFAULT_BUCKETS):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.buckets = buckets
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self._last_flush = None
+
+    @staticmethod
+    def _key(name, tags):
+        return (name, tuple(sorted((k, str(v))
+                                   for k, v in six.iteritems(tags))))
+
+    def timer(self, name, **tags):
+        """Return a Timer that records the time under name and tags."""
+        return Timer(self, name, tags)
+
+    def observe(self, name, value, **tags):
+        key = self._key(name, tags)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = Histogram(self.buckets)
+            self.histograms[key] = histogram
+        histogram.observe(value)
+        self.sink.observe(name, value, key[1])
+
+    def increment(self, name, value=1, **tags):
+        """Add value to the counter of name and tags."""
+        key = self._key(name, tags)
+        self.counters[key] = self.counters.get(key, 0) + value
+        self.sink.increment(name, value, key[1])
+
+    def gauge(self, name, value, **tags):
+        """Set the gauge of name and tags to value."""
+        key = self._key(name, tags)
+        self.gauges[key] = value
+        self.sink.gauge(name, value, key[1])
+
+    def flush(self):
+        """Export the metrics, if flush_interval has elapsed."""
+        if (self._last_flush is not None and
+                not self._last_flush.expired()):
+            return
+        self._last_flush = timeutils.StopWatch(duration=self.flush_interval)
+        self._last_flush.start()
+        try:
+            self.sink.flush(self.histograms, self.counters, self.gauges)
+        except Exception as e:
+            LOG.warning(_LW("Cannot export the scheduler metrics: %(error)s"),
+                        {"error": e})
+
+
+class TextfileSink(object):
+    """Write the metrics to a file, in the Prometheus text format.
+
+    The file is written atomically, so that the collector never reads a
+    partial file.
+    """
+
+    def __init__(self, path, prefix):
+        self.path = path
+        self.prefix = prefix
+
+    def observe(self, name, value, tags):
+        pass
+
+    def increment(self, name, value, tags):
+        pass
+
+    def gauge(self, name, value, tags):
+        pass
+
+    @staticmethod
+    def _labels(tags, extra=()):
+        labels = ['%s="%s"' % (k, v) for k, v in tags + extra]
+        return "{%s}" % ",".join(labels) if labels else ""
+
+    def format(self, histograms, counters=None, gauges=None):
+        lines = []
+        current = None
+        for (name, tags) in sorted(histograms):
+            metric = "%s_%s_seconds" % (self.prefix, name)
+            histogram = histograms[name, tags]
+            if name != current:
+                lines.append("# TYPE %s histogram" % metric)
+                current = name
+            for bound, count in histogram.cumulative_counts():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("%s_bucket%s %d" % (
+                    metric, self._labels(tags, (("le", le),)), count))
+            lines.append("%s_sum%s %r" % (metric, self._labels(tags),
+                                          histogram.sum))
+            lines.append("%s_count%s %d" % (metric, self._labels(tags),
+                                            histogram.count))
+        counters = counters or {}
+        current = None
+        for (name, tags) in sorted(counters):
+            metric = "%s_%s_total" % (self.prefix, name)
+            if name != current:
+                lines.append("# TYPE %s counter" % metric)
+                current = name
+            lines.append("%s%s %s" % (metric, self._labels(tags),
+                                      counters[name, tags]))
+        gauges = gauges or {}
+        current = None
+        for (name, tags) in sorted(gauges):
+            metric = "%s_%s" % (self.prefix, name)
+            if name != current:
+                lines.append("# TYPE %s gauge" % metric)
+                current = name
+            lines.append("%s%s %s" % (metric, self._labels(tags),
+                                      gauges[name, tags]))
+        return "\n".join(lines) + "\n"
+
+    def flush(self, histograms, counters, gauges):
+        directory = os.path.dirname(self.path) or "."
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".opie-metrics")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.format(histograms, counters, gauges))
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, self.path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+
+class StatsdSink(object):
+    """Send each observation to a statsd daemon, as a timing in ms.
+
+    The counters and gauges are sent as statsd counters and gauges.
+
+    The tags are appended to the metric name, as statsd does not support
+    them, i.e. "opie_scheduler.filtering.request_normal".
+    """
+
+    def __init__(self, host, port, prefix):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _send(self, name, tags, value):
+        parts = [self.prefix, name] + ["%s_%s" % tag for tag in tags]
+        data = "%s:%s" % (".".join(parts), value)
+        try:
+            self._socket.sendto(data.encode("utf-8"), self.address)
+        except (socket.error, socket.gaierror):
+            # NOTE(aloga): metrics are best effort, do not fail (or block)
+            # the scheduling if the daemon is not there.
+            pass
+
+    def observe(self, name, value, tags):
+        self._send(name, tags, "%.3f|ms" % (value * 1000))
+
+    def increment(self, name, value, tags):
+        self._send(name, tags, "%d|c" % value)
+
+    def gauge(self, name, value, tags):
+        self._send(name, tags, "%s|g" % value)
+
+    def flush(self, histograms, counters, gauges):
+        pass
+
+
+NULL_REGISTRY = NullRegistry()
+
+_REGISTRY = None
+
+
+def get_registry():
+    """Return the metrics registry configured in the scheduler options.
+
+    All the callers share the same registry, so that the histograms of the
+    host manager and the scheduler are exported together.
+    """
+    global _REGISTRY
+    opts = CONF.preemptible_instances_scheduler
+    if not opts.metrics_enabled:
+        return NULL_REGISTRY
+    if _REGISTRY is None:
+        if opts.metrics_sink == "statsd":
+            sink = StatsdSink(opts.metrics_statsd_host,
+                              opts.metrics_statsd_port,
+                              opts.metrics_prefix)
+        else:
+            sink = TextfileSink(opts.metrics_textfile_path,
+                                opts.metrics_prefix)
+        _REGISTRY = MetricsRegistry(sink,
+                                    flush_interval=opts.metrics_flush_interval)
+    return _REGISTRY
@@ -0,0 +1,204 @@
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Selection of the preemptible instances to terminate on a host.
+
+Choosing the cheapest set of preemptible instances whose resources cover the
+overcommit of a host is a (multi-dimensional) covering knapsack problem. It
+is solved here with a greedy heuristic that gives an initial solution, that
+is then improved with a branch and bound search limited to a maximum number
+of explored nodes, so that it stays fast with hundreds of candidates.
+"""
+
+import six
+
+DEFAULT_MAX_NODES = 10000
+
+
+class Candidate(object):
+    """A preemptible instance that can be terminated.
+
+    :param key: an identifier for the candidate (i.e. the instance UUID).
+    :param resources: a tuple with the resources that would be freed.
+    :param cost: the cost of terminating this candidate, must be positive.
+    """
+    __slots__ = ('key', 'resources', 'cost')
+
+    def __init__(self, key, resources, cost):
+        self.key = key
+        self.resources = tuple(resources)
+        self.cost = cost
+
+    def __repr__(self):
+        return "<Candidate %s: %s (cost %s)>" % (self.key, self.resources,
+                                                 self.cost)
+
+
+def _covered(needed):
+    return all(n <= 0 for n in needed)
+
+
+def _subtract(needed, resources):
+    return tuple(n - r for n, r in six.moves.zip(needed, resources))
+
+
+def _useful(candidate, needed):
+    """Return the normalized amount of the needed resources covered."""
+    return sum(min(r, n) / float(n)
+               for r, n in six.moves.zip(candidate.resources, needed)
+               if n > 0 and r > 0)
+
+
+def _covers(solution, needed):
+    """Check if the resources of the solution cover the needed ones."""
+    for d, n in enumerate(needed):
+        if n > 0 and sum(c.resources[d] for c in solution) < n:
+            return False
+    return True
+
+
+def _greedy(candidates, needed):
+    """Return a solution picking the most cost-effective candidate first."""
+    remaining = list(candidates)
+    solution = []
+    left = needed
+    while not _covered(left):
+        best = None
+        best_ratio = 0
+        for candidate in remaining:
+            ratio = _useful(candidate, left) / candidate.cost
+            if ratio > best_ratio:
+                best, best_ratio = candidate, ratio
+        if best is None:
+            return None
+        remaining.remove(best)
+        solution.append(best)
+        left = _subtract(left, best.resources)
+
+    # Drop the redundant candidates, starting from the most expensive ones
+    for candidate in sorted(solution, key=lambda c: c.cost, reverse=True):
+        aux = [c for c in solution if c is not candidate]
+        if _covers(aux, needed):
+            solution = aux
+    return solution
+
+
+def _branch_and_bound(candidates, needed, best_cost, max_nodes):
+    """Search for the minimum cost solution.
+
+    The candidates are explored in order, deciding whether each one of them
+    is included or not in the solution. A branch is pruned when the
+    remaining candidates cannot cover the needed resources, or when a lower
+    bound of its cost is higher than the best solution found so far. The
+    lower bound is the cost of covering the most expensive dimension with the
+    cheapest (per unit) remaining candidate, allowing fractions of it.
+    """
+    n = len(candidates)
+    dims = len(needed)
+
+    # Suffix sums of the resources and suffix minimum of cost per unit, used
+    # for the feasibility test and the lower bound respectively.
+    suffix_sum = [[0] * dims for _ in six.moves.range(n + 1)]
+    suffix_ratio = [[float("inf")] * dims for _ in six.moves.range(n + 1)]
+    for i in six.moves.range(n - 1, -1, -1):
+        candidate = candidates[i]
+        for d in six.moves.range(dims):
+            r = candidate.resources[d]
+            suffix_sum[i][d] = suffix_sum[i + 1][d] + r
+            ratio = candidate.cost / float(r) if r > 0 else float("inf")
+            suffix_ratio[i][d] = min(suffix_ratio[i + 1][d], ratio)
+
+    best = None
+    nodes = 0
+    stack = [(0, needed, 0, ())]
+    while stack and nodes < max_nodes:
+        i, remaining, cost, chosen = stack.pop()
+        nodes += 1
+
+        if _covered(remaining):
+            if cost < best_cost:
+                best_cost, best = cost, chosen
+            continue
+        if i == n:
+            continue
+
+        bound = cost
+        feasible = True
+        for d in six.moves.range(dims):
+            if remaining[d] <= 0:
+                continue
+            if suffix_sum[i][d] < remaining[d]:
+                feasible = False
+                break
+            bound = max(bound, cost + remaining[d] * suffix_ratio[i][d])
+        if not feasible or bound >= best_cost:
+            continue
+
+        candidate = candidates[i]
+        # Push the exclusion first, so that the inclusion is explored first
+        stack.append((i + 1, remaining, cost, chosen))
+        if any(r > 0 and n_ > 0 for r, n_ in six.moves.zip(
+                candidate.resources, remaining)):
+            stack.append((i + 1, _subtract(remaining, candidate.resources),
+                          cost + candidate.cost, chosen + (candidate,)))
+
+    return best
+
+
+def select_victims(candidates, needed, max_nodes=DEFAULT_MAX_NODES):
+    """Select the minimum cost set of candidates covering the needed resources.
+
+    :param candidates: a list of Candidate objects.
+    :param needed: a tuple with the amount of each resource that needs to be
+                   freed, in the same order as the candidate resources.
+                   Dimensions whose value is not positive are ignored.
+    :param max_nodes: the maximum number of nodes explored by the branch and
+                      bound search. If it is reached, the best solution found
+                      so far is returned.
+    :returns: a list with the selected Candidate objects (empty if nothing
+              needs to be freed), or None if the candidates cannot cover the
+              needed resources.
+    """
+    needed = tuple(needed)
+    if _covered(needed):
+        return []
+
+    candidates = [c for c in candidates
+                  if any(r > 0 and n > 0 for r, n in six.moves.zip(
+                      c.resources, needed))]
+
+    if not _covers(candidates, needed):
+        return None
+
+    # Initial upper bound: the cheapest of the best single candidate and the
+    # greedy solution.
+    best = _greedy(candidates, needed)
+    best_cost = sum(c.cost for c in best)
+    for candidate in candidates:
+        if (candidate.cost < best_cost and
+                _covered(_subtract(needed, candidate.resources))):
+            best, best_cost = [candidate], candidate.cost
+
+    # Explore the most cost-effective candidates first, so that good
+    # solutions are found early and the bound prunes more branches.
+    candidates = sorted(candidates,
+                        key=lambda c: (-_useful(c, needed) / c.cost,
+                                       c.cost, str(c.key)))
+    improved = _branch_and_bound(candidates, needed, best_cost, max_nodes)
+    if improved is not None:
+        best = list(improved)
+
+    return best
@@ -0,0 +1,264 @@
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Termination of preemptible instances.
+
+The instances can be terminated synchronously with terminate_instances() or
+handed over to a PreemptionReaper, that terminates them in a background green
+thread so that the scheduler does not wait for them. In both cases the
+deletion is only requested to the compute service: wait_for_deletion() can be
+used to wait until the instances are actually deleted and their resources
+freed.
+"""
+
+import collections
+import time
+
+import eventlet
+from eventlet import queue
+from oslo_log import log as logging
+from oslo_utils import timeutils
+
+from nova.i18n import _LE, _LI, _LW
+from nova import objects
+
+from opie.scheduler import metrics
+
+LOG = logging.getLogger(__name__)
+
+EXPECTED_ATTRS = ['metadata', 'system_metadata', 'security_groups',
+                  'info_cache']
+
+
+def terminate_instances(compute_api, context, uuids, pool_size):
+    """Terminate the instances with the given UUIDs.
+
+    All the instances are loaded from the database at once, and then they are
+    deleted concurrently, using at most pool_size green threads. A failure
+    deleting one of them is logged and does not prevent the deletion of the
+    rest.
+
+    :returns: a list with the UUIDs of the instances that could not be
+              deleted.
+    """
+    if not uuids:
+        return []
+
+    filters = {"uuid": list(uuids), "deleted": False}
+    instances = objects.InstanceList.get_by_filters(
+        context, filters, expected_attrs=EXPECTED_ATTRS)
+
+    missing = set(uuids) - set(instance.uuid for instance in instances)
+    for uuid in missing:
+        LOG.warning(_LW("Cannot terminate %(uuid)s, it was not found"),
+                    {"uuid": uuid})
+
+    failed = []
+
+    def _terminate(instance):
+        LOG.info(_LI("Deleting %(uuid)s") % {"uuid": instance.uuid})
+        try:
+            compute_api.delete(context, instance)
+        except Exception:
+            LOG.exception(_LE("Failed to delete preemptible instance "
+                              "%(uuid)s"), {"uuid": instance.uuid})
+            failed.append(instance.uuid)
+
+    pool = eventlet.GreenPool(pool_size)
+    for instance in instances:
+        pool.spawn_n(_terminate, instance)
+    pool.waitall()
+
+    return failed
+
+
+def wait_for_deletion(context, uuids, timeout, interval=1.0):
+    """Wait until the instances with the given UUIDs are deleted.
+
+    The database is polled every interval seconds, for the instances that
+    are not deleted yet, until all of them are gone or timeout seconds have
+    elapsed.
+
+    :returns: a set with the UUIDs of the instances that were not deleted
+              yet when the timeout expired.
+    """
+    pending = set(uuids)
+    watch = timeutils.StopWatch(duration=timeout)
+    watch.start()
+    while pending:
+        filters = {"uuid": list(pending), "deleted": False}
+        instances = objects.InstanceList.get_by_filters(context, filters)
+        pending = set(instance.uuid for instance in instances)
+        if not pending or watch.expired():
+            break
+        eventlet.sleep(min(interval, watch.leftover()))
+    return pending
+
+
+class PreemptionOrder(object):
+    """An order to terminate a set of preemptible instances."""
+
+    def __init__(self, context, uuids):
+        self.context = context
+        self.uuids = list(uuids)
+        self.enqueued_at = time.time()
+        self.attempts = 0
+        self.queued = False
+
+    def __repr__(self):
+        return "<PreemptionOrder %s (attempts: %s)>" % (self.uuids,
+                                                        self.attempts)
+
+
+class PreemptionReaper(object):
+    """Terminate preemptible instances in a background green thread.
+
+    Orders are stored in a bounded queue. When the queue is full, enqueue()
+    blocks for at most enqueue_timeout seconds (so that the callers are
+    throttled when the reaper cannot keep up) and, if there is still no room,
+    the instances are terminated synchronously. Instances that cannot be
+    deleted are retried up to max_retries times, waiting retry_interval
+    seconds between attempts.
+
+    The depth of the queue is exported in the reaper_queue_depth gauge, and
+    the time since an order is enqueued until it is completed in the
+    reaper_latency histogram, tagged with its outcome.
+
+    :param compute_api: the object used to delete the instances, i.e. a
+                        nova.compute.API instance.
+    :param registry: the metrics registry, by default a null one.
+    """
+
+    def __init__(self, compute_api, queue_size=100, pool_size=8,
+                 max_retries=3, retry_interval=5, enqueue_timeout=10,
+                 registry=None):
+        self.compute_api = compute_api
+        self.metrics = registry or metrics.NULL_REGISTRY
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self.enqueue_timeout = enqueue_timeout
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._worker = None
+
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        # Time (in seconds) since an order was enqueued until it was
+        # completed, for the last orders.
+        self.latencies = collections.deque(maxlen=1000)
+
+    @property
+    def queue_depth(self):
+        """Number of orders waiting to be processed."""
+        return self._queue.qsize()
+
+    def stats(self):
+        """Return a dict with the reaper statistics."""
+        latencies = sorted(self.latencies)
+        if latencies:
+            avg = sum(latencies) / len(latencies)
+            p99 = latencies[int(0.99 * (len(latencies) - 1))]
+            latency_max = latencies[-1]
+        else:
+            avg = p99 = latency_max = 0.0
+        return {
+            "queue_depth": self.queue_depth,
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "latency_avg": avg,
+            "latency_p99": p99,
+            "latency_max": latency_max,
+        }
+
+    def start(self):
+        if self._worker is None:
+            self._worker = eventlet.spawn(self._run)
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.kill()
+            self._worker = None
+
+    def wait(self):
+        """Wait until all the orders (and their retries) are processed."""
+        self._queue.join()
+
+    def enqueue(self, context, uuids):
+        """Enqueue an order to terminate the instances with the given UUIDs.
+
+        :returns: True if the order was enqueued, False if the queue was full
+                  and the instances were terminated synchronously.
+        """
+        order = PreemptionOrder(context, uuids)
+        self.start()
+        try:
+            order.queued = True
+            self._queue.put(order, block=self.enqueue_timeout > 0,
+                            timeout=self.enqueue_timeout)
+            self.metrics.gauge("reaper_queue_depth", self.queue_depth)
+        except queue.Full:
+            order.queued = False
+            LOG.warning(_LW("Preemption queue is full (%(depth)s orders), "
+                            "terminating %(uuids)s synchronously"),
+                        {"depth": self.queue_depth, "uuids": order.uuids})
+            self._process(order)
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            order = self._queue.get()
+            self.metrics.gauge("reaper_queue_depth", self.queue_depth)
+            self._process(order)
+
+    def _process(self, order):
+        order.attempts += 1
+        try:
+            failed = terminate_instances(self.compute_api, order.context,
+                                         order.uuids, self.pool_size)
+        except Exception:
+            LOG.exception(_LE("Unexpected error processing %(order)s"),
+                          {"order": order})
+            failed = order.uuids
+
+        if failed and order.attempts <= self.max_retries:
+            order.uuids = failed
+            self.retried += len(failed)
+            # NOTE(aloga): the order is marked as done only when the retry
+            # is enqueued, so that wait() also waits for the retries.
+            eventlet.spawn_after(self.retry_interval, self._retry, order)
+            return
+
+        self.failed += len(failed)
+        self.completed += 1
+        latency = time.time() - order.enqueued_at
+        self.latencies.append(latency)
+        self.metrics.observe("reaper_latency", latency,
+                             outcome="failed" if failed else "deleted")
+        self.metrics.flush()
+        if order.queued:
+            self._queue.task_done()
+
+    def _retry(self, order):
+        was_queued = order.queued
+        order.queued = True
+        self._queue.put(order)
+        self.metrics.gauge("reaper_queue_depth", self.queue_depth)
+        if was_queued:
+            self._queue.task_done()
@@ -0,0 +1,71 @@
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Random sampling of the hosts.
+
+Instead of filtering and weighing all the hosts for each instance, the
+scheduler can evaluate a random sample of them (the "power of d choices").
+Some hosts (e.g. those with preemptible instances that can be terminated to
+make room for a normal instance) can be favoured, so that they are more
+likely to be sampled than the rest.
+"""
+
+import random
+
+
+class HostSampler(object):
+    """Draw random samples of a list of hosts.
+
+    :param hosts: the host states to sample from.
+    :param favoured: a function returning True for the hosts to favour, or
+                     None to sample all the hosts with the same probability.
+    :param bias: how many times more likely a favoured host is sampled than
+                 any other host.
+    """
+
+    def __init__(self, hosts, favoured=None, bias=1.0, rand=None):
+        self.hosts = list(hosts)
+        self.bias = bias
+        self.rand = rand or random
+        if favoured is None or bias == 1.0:
+            self._favoured = []
+            self._others = self.hosts
+        else:
+            self._favoured = [h for h in self.hosts if favoured(h)]
+            self._others = [h for h in self.hosts if not favoured(h)]
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def sample(self, size):
+        """Return size hosts, drawn without replacement.
+
+        The favoured hosts get a share of the sample proportional to their
+        number times the bias. If size is not lower than the number of hosts
+        all of them are returned, in their original order.
+        """
+        if size >= len(self.hosts):
+            return list(self.hosts)
+
+        weight = self.bias * len(self._favoured)
+        num_favoured = int(round(size * weight /
+                                 (weight + len(self._others))))
+        num_favoured = min(num_favoured, len(self._favoured))
+        num_others = min(size - num_favoured, len(self._others))
+        # Fill up with favoured hosts if there are not enough of the others
+        num_favoured = min(size - num_others, len(self._favoured))
+        return (self.rand.sample(self._favoured, num_favoured) +
+                self.rand.sample(self._others, num_others))
@@ -0,0 +1,102 @@
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Selection of the best weighed hosts.
+"""
+
+import heapq
+
+from nova.scheduler import weights
+from nova import weights as nova_weights
+
+
+def total_weights(weighers, raw_weights, num_hosts):
+    """Return the total weight of each host, from their raw weights.
+
+    The raw weights of each weigher are normalized and multiplied by its
+    multiplier, as in nova.weights.BaseWeightHandler.get_weighed_objects().
+
+    :param weighers: the weighers that gave the raw weights.
+    :param raw_weights: a list with the raw weights of the hosts given by
+                        each weigher, in the same order as the weighers.
+    :param num_hosts: the number of hosts.
+    """
+    totals = [0.0] * num_hosts
+    for weigher, host_weights in zip(weighers, raw_weights):
+        normalized = nova_weights.normalize(host_weights,
+                                            minval=weigher.minval,
+                                            maxval=weigher.maxval)
+        multiplier = weigher.weight_multiplier()
+        for i, weight in enumerate(normalized):
+            totals[i] += multiplier * weight
+    return totals
+
+
+class TopHostsSelector(object):
+    """Select the top weighed hosts, weighing them incrementally.
+
+    The raw weight given by each weigher to each host is kept during the
+    scheduling of a request, so that after consuming resources from a host
+    only that host needs to be weighed again. The weights are normalized and
+    combined as in nova.weights.BaseWeightHandler.get_weighed_objects(), but
+    instead of sorting all the hosts only the top ones are selected, with
+    the same ordering (including ties) as a stable sort.
+
+    This gives the same results as weighing all the hosts as long as the
+    weight of a host only depends on the host itself and the request, which
+    is the case for the nova and opie weighers.
+    """
+
+    def __init__(self, weighers):
+        self.weighers = weighers
+        # Raw weights, keyed by (host, node), one dict per weigher
+        self._raw = [{} for _ in weighers]
+
+    @staticmethod
+    def _key(host_state):
+        return (host_state.host, host_state.nodename)
+
+    def invalidate(self, host_state):
+        """Forget the weights of a host, as its state has changed."""
+        key = self._key(host_state)
+        for raw in self._raw:
+            raw.pop(key, None)
+
+    def get_top_weighed_hosts(self, hosts, weight_properties, size):
+        """Return the best size hosts, as a list of WeighedHost objects.
+
+        :param hosts: the list of (filtered) host states to choose from.
+        :param weight_properties: the request spec object.
+        :param size: the number of hosts to return.
+        """
+        if len(hosts) <= 1:
+            return [weights.WeighedHost(h, 0.0) for h in hosts]
+
+        raw_weights = []
+        for weigher, raw in zip(self.weighers, self._raw):
+            missing = [weights.WeighedHost(h, 0.0) for h in hosts
+                       if self._key(h) not in raw]
+            if missing:
+                new = weigher.weigh_objects(missing, weight_properties)
+                for obj, weight in zip(missing, new):
+                    raw[self._key(obj.obj)] = weight
+            raw_weights.append([raw[self._key(h)] for h in hosts])
+
+        totals = total_weights(self.weighers, raw_weights, len(hosts))
+
+        top = heapq.nlargest(size, range(len(hosts)),
+                             key=lambda i: totals[i])
+        return [weights.WeighedHost(hosts[i], totals[i]) for i in top]
@@ -0,0 +1,58 @@
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Pluggable weighers for the preemptible instances (victims) of a host.
+
+Unlike the host weighers, these weigh the preemptible instances that may be
+terminated to make room for a normal instance. Higher weights win, that is,
+the instances with the highest weights are the preferred ones to terminate.
+"""
+
+from nova import weights
+
+
+class WeighedVictim(weights.WeighedObject):
+    def __repr__(self):
+        return "WeighedVictim [instance: %s, weight: %s]" % (
+            self.obj.uuid, self.weight)
+
+
+class BaseVictimWeigher(weights.BaseWeigher):
+    """Base class for preemptible instances weighers.
+
+    The weight_properties passed to the weighers is a dict with the host
+    state ("host_state") and the request spec ("spec_obj").
+    """
+
+    def weigh_objects(self, weighed_obj_list, weight_properties):
+        # NOTE(aloga): the weights are relative to the instances of a host,
+        # so we must not keep the minimum and maximum values between calls.
+        self.minval = self.__class__.minval
+        self.maxval = self.__class__.maxval
+        return super(BaseVictimWeigher, self).weigh_objects(weighed_obj_list,
+                                                            weight_properties)
+
+
+class VictimWeightHandler(weights.BaseWeightHandler):
+    object_class = WeighedVictim
+
+    def __init__(self):
+        super(VictimWeightHandler, self).__init__(BaseVictimWeigher)
+
+
+def all_victim_weighers():
+    """Return a list of the victim weigher classes found in this directory."""
+    return VictimWeightHandler().get_all_classes()
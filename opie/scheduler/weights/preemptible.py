@@ -14,13 +14,20 @@
 #    under the License.
 """
 Preemptible instances weighers.
+
+The weighers compute the weights of all the hosts at once.
 """
 
+import abc
+
 from oslo_config import cfg
 from oslo_utils import timeutils
+import six
 
 from nova.scheduler import weights
 
+from opie.scheduler import host_manager
+
 preemptible_weight_opts = [
     cfg.FloatOpt('preemptible_count_weight_multiplier',
                  default=1000.0,
@@ -37,46 +44,74 @@ CONF = cfg.CONF
 CONF.register_opts(preemptible_weight_opts)
 
 
-class PreemptibleCountWeigher(weights.BaseHostWeigher):
+@six.add_metaclass(abc.ABCMeta)
+class BasePreemptibleWeigher(weights.BaseHostWeigher):
+    """Base class for weighers that weigh all the hosts at once."""
     maxval = 0
 
+    @abc.abstractmethod
+    def _weigh_hosts(self, host_states, weight_properties):
+        """Return a list with the weights of the given hosts."""
+
+    def _weigh_object(self, host_state, weight_properties):
+        return self._weigh_hosts([host_state], weight_properties)[0]
+
+    def weigh_objects(self, weighed_obj_list, weight_properties):
+        if not weighed_obj_list:
+            return []
+
+        weights = self._weigh_hosts([obj.obj for obj in weighed_obj_list],
+                                    weight_properties)
+
+        # Record the min and max values, as in BaseWeigher.weigh_objects
+        if self.minval is None:
+            self.minval = weights[0]
+        if self.maxval is None:
+            self.maxval = weights[0]
+        self.minval = min(self.minval, min(weights))
+        self.maxval = max(self.maxval, max(weights))
+
+        return weights
+
+
+class PreemptibleCountWeigher(BasePreemptibleWeigher):
     def weight_multiplier(self):
         """Weight multiplier."""
         return CONF.preemptible_count_weight_multiplier
 
-    def _weigh_object(self, host_state, weight_properties):
+    def _weigh_hosts(self, host_states, weight_properties):
         """Higher weights win.
 
         We do not want a host with preemtible instances selected if there are
         hosts without them.
         """
-        count = 0
-        for instance in host_state.instances.values():
-            if instance.system_metadata.get("preemptible"):
-                count += 1
-        return - count
+        weights = []
+        for host_state in host_states:
+            count = getattr(host_state, "num_preemptible_instances", None)
+            if count is None:
+                count = len(host_manager.get_preemptible_instances(host_state))
+            weights.append(- count)
+        return weights
 
 
-class PreemptibleDurationWeigher(weights.BaseHostWeigher):
-    maxval = 0
-
+class PreemptibleDurationWeigher(BasePreemptibleWeigher):
     def weight_multiplier(self):
         """Weight multiplier."""
         return CONF.preemptible_duration_weight_multiplier
 
-    def _weigh_object(self, host_state, weight_properties):
+    def _weigh_hosts(self, host_states, weight_properties):
         """Higher weights win.
 
         We do not want a host with preemtible instances selected if there are
         hosts without them.
         """
-        remainder = 0
-        for instance in host_state.instances.values():
-            if instance.system_metadata.get("preemptible"):
-                now = timeutils.utcnow()
-                now = now.replace(tzinfo=None)
-                ct = instance.created_at.replace(tzinfo=None)
-                duration = (now - ct).total_seconds()
-                remainder += duration % 3600
-
-        return - remainder
+        now = host_manager.to_timestamp(timeutils.utcnow())
+
+        weights = []
+        for host_state in host_states:
+            remainder = 0
+            for instance in host_manager.get_preemptible_instances(
+                    host_state):
+                remainder += (now - instance.created_at) % 3600
+            weights.append(- remainder)
+        return weights
@@ -0,0 +1,153 @@
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Weighers for the preemptible instances that may be terminated in a host.
+
+The weighers do not look at the instances themselves, but at a VictimFeatures
+object that is computed once for each instance.
+"""
+
+import collections
+
+from oslo_config import cfg
+from oslo_utils import timeutils
+
+from opie.scheduler import host_manager
+from opie.scheduler import weights
+
+victim_weight_opts = [
+    cfg.FloatOpt('victim_size_weight_multiplier',
+                 default=1.0,
+                 help='Multiplier used for weighing preemptible instances '
+                      'based on their size, relative to the host size. The '
+                      'smaller instances are preferred.'),
+    cfg.FloatOpt('victim_billing_period_weight_multiplier',
+                 default=1.0,
+                 help='Multiplier used for weighing preemptible instances '
+                      'based on the time elapsed since the start of their '
+                      'current billing period. The instances that have just '
+                      'started a new period are preferred.'),
+    cfg.IntOpt('victim_billing_period',
+               default=3600,
+               min=1,
+               help='Length, in seconds, of the billing period of the '
+                    'preemptible instances.'),
+    cfg.FloatOpt('victim_project_weight_multiplier',
+                 default=1.0,
+                 help='Multiplier used for weighing preemptible instances '
+                      'based on the number of preemptible instances of the '
+                      'same project running on the host. The instances of '
+                      'the projects with more instances are preferred.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(victim_weight_opts, group="preemptible_instances_scheduler")
+
+
+class VictimFeatures(object):
+    """Features of a preemptible instance used for weighing it.
+
+    :param instance: the InstanceSummary of the preemptible instance.
+    :param project_instances: number of preemptible instances of the same
+                              project in the host.
+    """
+
+    __slots__ = ('instance', 'uuid', 'memory_mb', 'disk_mb', 'vcpus',
+                 'created_at', 'project_id', 'project_instances')
+
+    def __init__(self, instance, project_instances=1):
+        self.instance = instance
+        self.uuid = instance.uuid
+        self.memory_mb = instance.memory_mb
+        self.disk_mb = instance.disk_mb
+        self.vcpus = instance.vcpus
+        self.created_at = instance.created_at
+        self.project_id = instance.project_id
+        self.project_instances = project_instances
+
+    @property
+    def resources(self):
+        return (self.memory_mb, self.disk_mb, self.vcpus)
+
+    def __repr__(self):
+        return "<VictimFeatures %s>" % self.uuid
+
+
+def get_victim_features(host_state):
+    """Return the VictimFeatures of the preemptible instances of a host."""
+    preemptibles = host_manager.get_preemptible_instances(host_state)
+    projects = collections.Counter(i.project_id for i in preemptibles)
+    return [VictimFeatures(i, projects[i.project_id]) for i in preemptibles]
+
+
+class VictimSizeWeigher(weights.BaseVictimWeigher):
+    maxval = 0
+
+    def weight_multiplier(self):
+        """Weight multiplier."""
+        return CONF.preemptible_instances_scheduler.\
+            victim_size_weight_multiplier
+
+    def _weigh_object(self, victim, weight_properties):
+        """Higher weights win, so smaller instances are preferred."""
+        host_state = weight_properties["host_state"]
+        size = 0.0
+        for used, total in ((victim.memory_mb, host_state.total_usable_ram_mb),
+                            (victim.disk_mb,
+                             host_state.total_usable_disk_gb * 1024),
+                            (victim.vcpus, host_state.vcpus_total)):
+            if total:
+                size += float(used) / total
+        return - size
+
+
+class VictimBillingPeriodWeigher(weights.BaseVictimWeigher):
+    maxval = 0
+
+    def weight_multiplier(self):
+        """Weight multiplier."""
+        return CONF.preemptible_instances_scheduler.\
+            victim_billing_period_weight_multiplier
+
+    def weigh_objects(self, weighed_obj_list, weight_properties):
+        self._now = host_manager.to_timestamp(timeutils.utcnow())
+        return super(VictimBillingPeriodWeigher, self).weigh_objects(
+            weighed_obj_list, weight_properties)
+
+    def _weigh_object(self, victim, weight_properties):
+        """Higher weights win.
+
+        The instances that have just started a new billing period are the
+        ones that have wasted less time of the (already paid) period.
+        """
+        period = CONF.preemptible_instances_scheduler.victim_billing_period
+        return - ((self._now - victim.created_at) % period)
+
+
+class VictimProjectWeigher(weights.BaseVictimWeigher):
+    minval = 0
+
+    def weight_multiplier(self):
+        """Weight multiplier."""
+        return CONF.preemptible_instances_scheduler.\
+            victim_project_weight_multiplier
+
+    def _weigh_object(self, victim, weight_properties):
+        """Higher weights win.
+
+        Prefer the instances of the projects that have more preemptible
+        instances in the host, so that preemption is spread among projects.
+        """
+        return victim.project_instances
@@ -0,0 +1,80 @@
+# Copyright 2016 Spanish National Research Council - CSIC
+# Copyright 2016 INDIGO-DataCloud
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from opie.scheduler import filters
+from opie.scheduler.filters import reclaimable_filter
+from opie.scheduler import host_manager
+
+import nova.objects
+from nova import test as nova_test
+
+
+class ReclaimableFiltersTestCase(nova_test.NoDBTestCase):
+    def setUp(self):
+        super(ReclaimableFiltersTestCase, self).setUp()
+        self.host = host_manager.HostState('host1', 'node1')
+        self.host.total_usable_ram_mb = 2048
+        self.host.free_ram_mb = 0
+        self.host.ram_allocation_ratio = 1.0
+        self.host.total_usable_disk_gb = 2
+        self.host.free_disk_mb = 0
+        self.host.disk_allocation_ratio = 1.0
+        self.host.vcpus_total = 2
+        self.host.vcpus_used = 2
+        self.host.cpu_allocation_ratio = 1.0
+        # Half of the host is used by preemptible instances
+        self.host.instances = {
+            "uuid": host_manager.InstanceSummary("uuid", 1024, 1024, 1, True,
+                                                 0)}
+
+    @staticmethod
+    def _spec(preemptible):
+        return nova.objects.RequestSpec(
+            flavor=nova.objects.Flavor(memory_mb=1024, root_gb=1,
+                                       ephemeral_gb=0, swap=0, vcpus=1),
+            scheduler_hints={"preemptible": [str(preemptible)]})
+
+    def _test_filter(self, filter_cls, limit):
+        filt = filter_cls()
+        self.assertTrue(filt.host_passes(self.host, self._spec(False)))
+        self.assertIn(limit, self.host.limits)
+        self.assertFalse(filt.host_passes(self.host, self._spec(True)))
+        # The host state is not modified
+        self.assertEqual(0, self.host.free_ram_mb)
+        self.assertEqual(0, self.host.free_disk_mb)
+        self.assertEqual(2, self.host.vcpus_used)
+
+    def test_ram_filter(self):
+        self._test_filter(reclaimable_filter.ReclaimableRamFilter,
+                          'memory_mb')
+
+    def test_disk_filter(self):
+        self._test_filter(reclaimable_filter.ReclaimableDiskFilter,
+                          'disk_gb')
+
+    def test_core_filter(self):
+        self._test_filter(reclaimable_filter.ReclaimableCoreFilter, 'vcpu')
+
+    def test_not_enough_reclaimable(self):
+        spec = self._spec(False)
+        spec.flavor.memory_mb = 2048
+        filt = reclaimable_filter.ReclaimableRamFilter()
+        self.assertFalse(filt.host_passes(self.host, spec))
+
+    def test_all_filters(self):
+        classes = filters.all_filters()
+        self.assertIn(reclaimable_filter.ReclaimableRamFilter, classes)
+        self.assertIn(reclaimable_filter.ReclaimableDiskFilter, classes)
+        self.assertIn(reclaimable_filter.ReclaimableCoreFilter, classes)
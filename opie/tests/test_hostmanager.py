@@ -12,11 +12,15 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import datetime
+
 from opie.scheduler import host_manager
 
+import eventlet
 import mock
 from nova.compute import task_states
 from nova.compute import vm_states
+from nova import exception
 import nova.objects
 from nova.objects import base as obj_base
 from nova.scheduler import host_manager as nova_host_manager
@@ -28,6 +32,7 @@ from nova.tests.unit.scheduler import fakes
 from nova.tests.unit.scheduler import test_host_manager \
         as nova_test_host_manager
 from nova.tests import uuidsentinel as uuids
+from oslo_utils import timeutils
 
 
 class OpieHostManagerTestCase(nova_test_host_manager.HostManagerTestCase):
@@ -166,6 +171,187 @@ class OpieHostManagerTestCase(nova_test_host_manager.HostManagerTestCase):
         self.assertEqual(host_states_map[('host4', 'node4')].free_disk_mb,
                          8388608)
 
+    @mock.patch('nova.objects.ServiceList.get_by_binary')
+    @mock.patch('nova.objects.ComputeNodeList.get_all')
+    @mock.patch('nova.objects.InstanceList.get_by_host')
+    def test_get_host_state_snapshot(self, mock_get_by_host, mock_get_all,
+                                     mock_get_by_binary):
+        mock_get_by_host.return_value = nova.objects.InstanceList()
+        mock_get_all.return_value = fakes.COMPUTE_NODES
+        mock_get_by_binary.return_value = fakes.SERVICES
+        context = 'fake_context'
+
+        full, partial = self.host_manager.get_host_state_snapshot(context)
+
+        # A single sweep over the db for both views
+        self.assertEqual(1, mock_get_by_binary.call_count)
+        self.assertEqual(1, mock_get_all.call_count)
+        self.assertEqual(4, mock_get_by_host.call_count)
+
+        self.assertEqual(4, len(full))
+        self.assertEqual([(h.host, h.nodename) for h in full],
+                         [(h.host, h.nodename) for h in partial])
+        for h_full, h_partial in zip(full, partial):
+            self.assertIsInstance(h_partial, host_manager.HostStatePartial)
+            self.assertIsNot(h_full, h_partial)
+            self.assertIs(h_full, h_partial._full)
+            self.assertEqual(h_full.free_ram_mb, h_partial.free_ram_mb)
+            self.assertIs(h_full.service, h_partial.service)
+
+    @mock.patch('nova.objects.ServiceList.get_by_binary')
+    @mock.patch('nova.objects.ComputeNodeList.get_all')
+    @mock.patch('nova.objects.InstanceList.get_by_host')
+    def test_get_host_state_snapshot_no_partial(self, mock_get_by_host,
+                                                mock_get_all,
+                                                mock_get_by_binary):
+        mock_get_by_host.return_value = nova.objects.InstanceList()
+        mock_get_all.return_value = fakes.COMPUTE_NODES
+        mock_get_by_binary.return_value = fakes.SERVICES
+        context = 'fake_context'
+
+        full, partial = self.host_manager.get_host_state_snapshot(
+            context, partial=False)
+
+        self.assertEqual(4, len(full))
+        self.assertIsNone(partial)
+        self.assertEqual({}, self.host_manager.host_state_map_partial)
+
+    @mock.patch('nova.objects.ServiceList.get_by_binary')
+    @mock.patch('nova.objects.ComputeNodeList.get_all')
+    @mock.patch('nova.objects.InstanceList.get_by_host')
+    def test_get_host_state_snapshot_no_cache(self, mock_get_by_host,
+                                              mock_get_all,
+                                              mock_get_by_binary):
+        mock_get_by_host.return_value = nova.objects.InstanceList()
+        mock_get_all.return_value = fakes.COMPUTE_NODES
+        mock_get_by_binary.return_value = fakes.SERVICES
+        context = 'fake_context'
+
+        self.host_manager.get_host_state_snapshot(context)
+        self.host_manager.get_host_state_snapshot(context)
+
+        self.assertEqual(2, mock_get_all.call_count)
+        self.assertEqual(2, self.host_manager.generation)
+
+    @mock.patch('nova.objects.ServiceList.get_by_binary')
+    @mock.patch('nova.objects.ComputeNodeList.get_all')
+    @mock.patch('nova.objects.InstanceList.get_by_host')
+    def test_get_host_state_snapshot_cached(self, mock_get_by_host,
+                                            mock_get_all, mock_get_by_binary):
+        self.flags(host_state_cache_ttl=60,
+                   group="preemptible_instances_scheduler")
+        mock_get_by_host.return_value = nova.objects.InstanceList()
+        mock_get_all.return_value = fakes.COMPUTE_NODES
+        mock_get_by_binary.return_value = fakes.SERVICES
+        context = 'fake_context'
+
+        full, partial = self.host_manager.get_host_state_snapshot(context)
+        full[0].free_ram_mb -= 100
+        full2, partial2 = self.host_manager.get_host_state_snapshot(context)
+
+        self.assertEqual(1, mock_get_all.call_count)
+        self.assertEqual(4, mock_get_by_host.call_count)
+        self.assertEqual(full, full2)
+        self.assertEqual(partial, partial2)
+        # The local bookkeeping is kept
+        self.assertEqual(full[0].free_ram_mb, full2[0].free_ram_mb)
+
+    @mock.patch('nova.objects.ServiceList.get_by_binary')
+    @mock.patch('nova.objects.ComputeNodeList.get_all')
+    @mock.patch('nova.objects.InstanceList.get_by_host')
+    def test_get_host_state_snapshot_cache_expired(self, mock_get_by_host,
+                                                   mock_get_all,
+                                                   mock_get_by_binary):
+        self.flags(host_state_cache_ttl=60,
+                   group="preemptible_instances_scheduler")
+        mock_get_by_host.return_value = nova.objects.InstanceList()
+        mock_get_all.return_value = fakes.COMPUTE_NODES
+        mock_get_by_binary.return_value = fakes.SERVICES
+        context = 'fake_context'
+
+        self.host_manager.get_host_state_snapshot(context)
+        with mock.patch.object(self.host_manager._cache_watch, 'expired',
+                               return_value=True):
+            self.host_manager.get_host_state_snapshot(context)
+
+        self.assertEqual(2, mock_get_all.call_count)
+
+    @mock.patch('nova.objects.ServiceList.get_by_binary')
+    @mock.patch('nova.objects.ComputeNodeList.get_all')
+    @mock.patch('nova.objects.InstanceList.get_by_host')
+    def test_get_host_state_snapshot_cache_generation(self, mock_get_by_host,
+                                                      mock_get_all,
+                                                      mock_get_by_binary):
+        self.flags(host_state_cache_ttl=60,
+                   group="preemptible_instances_scheduler")
+        mock_get_by_host.return_value = nova.objects.InstanceList()
+        mock_get_all.return_value = fakes.COMPUTE_NODES
+        mock_get_by_binary.return_value = fakes.SERVICES
+        context = 'fake_context'
+
+        # The partial map is not refreshed for preemptible requests, so it
+        # cannot be served from the cache for the next normal request.
+        self.host_manager.get_host_state_snapshot(context, partial=False)
+        self.host_manager.get_host_state_snapshot(context, partial=True)
+        self.assertEqual(2, mock_get_all.call_count)
+
+        # Both maps are now up to date
+        self.host_manager.get_host_state_snapshot(context, partial=False)
+        self.host_manager.get_host_state_snapshot(context, partial=True)
+        self.assertEqual(2, mock_get_all.call_count)
+        self.assertEqual(2, self.host_manager.generation)
+
+    @mock.patch('nova.objects.Service.get_by_compute_host')
+    @mock.patch('nova.objects.ComputeNode.get_by_host_and_nodename')
+    @mock.patch('nova.objects.ServiceList.get_by_binary')
+    @mock.patch('nova.objects.ComputeNodeList.get_all')
+    @mock.patch('nova.objects.InstanceList.get_by_host')
+    def test_get_host_state_snapshot_invalidate_host(self, mock_get_by_host,
+                                                     mock_get_all,
+                                                     mock_get_by_binary,
+                                                     mock_get_node,
+                                                     mock_get_service):
+        self.flags(host_state_cache_ttl=60,
+                   group="preemptible_instances_scheduler")
+        mock_get_by_host.return_value = nova.objects.InstanceList()
+        mock_get_all.return_value = fakes.COMPUTE_NODES
+        mock_get_by_binary.return_value = fakes.SERVICES
+        mock_get_node.return_value = fakes.COMPUTE_NODES[0]
+        mock_get_service.return_value = fakes.SERVICES[0]
+        context = 'fake_context'
+
+        full, partial = self.host_manager.get_host_state_snapshot(context)
+        full[0].free_ram_mb -= 100
+        partial[0].free_ram_mb -= 100
+        self.host_manager.invalidate(full[0])
+        full, partial = self.host_manager.get_host_state_snapshot(context)
+
+        self.assertEqual(1, mock_get_all.call_count)
+        mock_get_node.assert_called_once_with(context, 'host1', 'node1')
+        self.assertEqual(5, mock_get_by_host.call_count)
+        self.assertEqual(512, full[0].free_ram_mb)
+        self.assertEqual(512, partial[0].free_ram_mb)
+        self.assertEqual(2, self.host_manager.generation)
+
+    @mock.patch('nova.objects.ServiceList.get_by_binary')
+    @mock.patch('nova.objects.ComputeNodeList.get_all')
+    @mock.patch('nova.objects.InstanceList.get_by_host')
+    def test_get_host_state_snapshot_invalidate_all(self, mock_get_by_host,
+                                                    mock_get_all,
+                                                    mock_get_by_binary):
+        self.flags(host_state_cache_ttl=60,
+                   group="preemptible_instances_scheduler")
+        mock_get_by_host.return_value = nova.objects.InstanceList()
+        mock_get_all.return_value = fakes.COMPUTE_NODES
+        mock_get_by_binary.return_value = fakes.SERVICES
+        context = 'fake_context'
+
+        self.host_manager.get_host_state_snapshot(context)
+        self.host_manager.invalidate()
+        self.host_manager.get_host_state_snapshot(context)
+
+        self.assertEqual(2, mock_get_all.call_count)
+
 
 class OpieHostManagerChangedNodesTestCase(nova_test_host_manager.
                                             HostManagerChangedNodesTestCase):
@@ -246,6 +432,450 @@ class OpieHostManagerChangedNodesTestCase(nova_test_host_manager.
         self.assertEqual(len(host_states_map), 0)
 
 
+class OpieHostManagerDeltaRefreshTestCase(nova_test.NoDBTestCase):
+    """Test case for the delta refresh of the opie HostManager."""
+
+    @mock.patch.object(host_manager.HostManager, '_init_instance_info')
+    @mock.patch.object(host_manager.HostManager, '_init_aggregates')
+    def setUp(self, mock_init_agg, mock_init_inst):
+        super(OpieHostManagerDeltaRefreshTestCase, self).setUp()
+        self.flags(delta_refresh=True,
+                   group="preemptible_instances_scheduler")
+        self.host_manager = host_manager.HostManager()
+        self.updated_at = datetime.datetime(2016, 1, 1, 12, 0, 0)
+        self.nodes = []
+        for node in fakes.COMPUTE_NODES[:4]:
+            node = node.obj_clone()
+            node.updated_at = self.updated_at
+            self.nodes.append(node)
+
+    @mock.patch('opie.scheduler.db.get_compute_node_ids')
+    @mock.patch('opie.scheduler.db.get_compute_nodes_changed_since')
+    @mock.patch('nova.objects.ServiceList.get_by_binary')
+    @mock.patch('nova.objects.InstanceList.get_by_host')
+    def test_delta_refresh(self, mock_get_by_host, mock_get_by_binary,
+                           mock_get_changed, mock_get_ids):
+        mock_get_by_host.return_value = nova.objects.InstanceList()
+        mock_get_by_binary.return_value = fakes.SERVICES
+        mock_get_changed.return_value = self.nodes
+        mock_get_ids.return_value = set([1, 2, 3, 4])
+        context = 'fake_context'
+
+        full, partial = self.host_manager.get_host_state_snapshot(context)
+        mock_get_changed.assert_called_once_with(context, None)
+        self.assertEqual(4, len(full))
+        self.assertEqual(4, len(partial))
+        self.assertEqual(4, mock_get_by_host.call_count)
+
+        # Only node2 has changed
+        node = self.nodes[1].obj_clone()
+        node.updated_at = self.updated_at + datetime.timedelta(minutes=1)
+        node.free_ram_mb = 0
+        mock_get_changed.return_value = [node]
+        full, partial = self.host_manager.get_host_state_snapshot(context)
+
+        mock_get_changed.assert_called_with(
+            context, self.updated_at - host_manager.DELTA_REFRESH_MARGIN)
+        self.assertEqual(5, mock_get_by_host.call_count)
+        self.assertEqual(['node1', 'node2', 'node3', 'node4'],
+                         [h.nodename for h in full])
+        self.assertEqual(0, full[1].free_ram_mb)
+        self.assertEqual(0, partial[1].free_ram_mb)
+        self.assertEqual(512, full[0].free_ram_mb)
+
+        # Only checked once per dead_node_check_interval
+        self.assertEqual(1, mock_get_ids.call_count)
+
+    @mock.patch('opie.scheduler.db.get_compute_node_ids')
+    @mock.patch('opie.scheduler.db.get_compute_nodes_changed_since')
+    @mock.patch('nova.objects.ServiceList.get_by_binary')
+    @mock.patch('nova.objects.InstanceList.get_by_host')
+    def test_delta_refresh_dead_node(self, mock_get_by_host,
+                                     mock_get_by_binary, mock_get_changed,
+                                     mock_get_ids):
+        self.flags(dead_node_check_interval=0,
+                   group="preemptible_instances_scheduler")
+        mock_get_by_host.return_value = nova.objects.InstanceList()
+        mock_get_by_binary.return_value = fakes.SERVICES
+        mock_get_changed.return_value = self.nodes
+        mock_get_ids.return_value = set([1, 2, 3, 4])
+        context = 'fake_context'
+
+        self.host_manager.get_host_state_snapshot(context)
+
+        mock_get_changed.return_value = []
+        mock_get_ids.return_value = set([1, 2, 3])
+        full, partial = self.host_manager.get_host_state_snapshot(context)
+
+        self.assertEqual(['node1', 'node2', 'node3'],
+                         [h.nodename for h in full])
+        self.assertNotIn(('host4', 'node4'), self.host_manager.host_state_map)
+        self.assertNotIn(('host4', 'node4'),
+                         self.host_manager.host_state_map_partial)
+
+    @mock.patch('opie.scheduler.db.get_compute_node_ids')
+    @mock.patch('opie.scheduler.db.get_compute_nodes_changed_since')
+    @mock.patch('nova.objects.ServiceList.get_by_binary')
+    @mock.patch('nova.objects.InstanceList.get_by_host')
+    def test_delta_refresh_updates_services(self, mock_get_by_host,
+                                            mock_get_by_binary,
+                                            mock_get_changed, mock_get_ids):
+        mock_get_by_host.return_value = nova.objects.InstanceList()
+        mock_get_by_binary.return_value = fakes.SERVICES
+        mock_get_changed.return_value = self.nodes
+        mock_get_ids.return_value = set([1, 2, 3, 4])
+        context = 'fake_context'
+
+        self.host_manager.get_host_state_snapshot(context)
+
+        services = [s.obj_clone() for s in fakes.SERVICES]
+        for service in services:
+            service.disabled = True
+        mock_get_by_binary.return_value = services
+        mock_get_changed.return_value = []
+        full, partial = self.host_manager.get_host_state_snapshot(context)
+
+        self.assertTrue(all(h.service['disabled'] for h in full))
+        self.assertTrue(all(h.service['disabled'] for h in partial))
+
+    @mock.patch('nova.objects.ComputeNode.get_by_host_and_nodename')
+    @mock.patch('opie.scheduler.db.get_compute_node_ids')
+    @mock.patch('opie.scheduler.db.get_compute_nodes_changed_since')
+    @mock.patch('nova.objects.ServiceList.get_by_binary')
+    @mock.patch('nova.objects.InstanceList.get_by_host')
+    def test_delta_refresh_invalidated_host(self, mock_get_by_host,
+                                            mock_get_by_binary,
+                                            mock_get_changed, mock_get_ids,
+                                            mock_get_node):
+        mock_get_by_host.return_value = nova.objects.InstanceList()
+        mock_get_by_binary.return_value = fakes.SERVICES
+        mock_get_changed.return_value = self.nodes
+        mock_get_ids.return_value = set([1, 2, 3, 4])
+        mock_get_node.return_value = self.nodes[0]
+        context = 'fake_context'
+
+        full, partial = self.host_manager.get_host_state_snapshot(context)
+        full[0].free_ram_mb -= 100
+        partial[0].free_ram_mb -= 100
+        self.host_manager.invalidate(full[0])
+
+        # The compute node of the invalidated host has not changed
+        mock_get_changed.return_value = []
+        full, partial = self.host_manager.get_host_state_snapshot(context)
+
+        mock_get_node.assert_called_once_with(context, 'host1', 'node1')
+        self.assertEqual(512, full[0].free_ram_mb)
+        self.assertEqual(512, partial[0].free_ram_mb)
+        self.assertEqual(set(), self.host_manager._stale_hosts)
+
+        # It is not read again once refreshed
+        self.host_manager.get_host_state_snapshot(context)
+        self.assertEqual(1, mock_get_node.call_count)
+
+
+class OpieHostManagerCoalesceRefreshesTestCase(nova_test.NoDBTestCase):
+    """Test case for the coalescing of concurrent refreshes."""
+
+    @mock.patch.object(host_manager.HostManager, '_init_instance_info')
+    @mock.patch.object(host_manager.HostManager, '_init_aggregates')
+    def setUp(self, mock_init_agg, mock_init_inst):
+        super(OpieHostManagerCoalesceRefreshesTestCase, self).setUp()
+        self.flags(coalesce_refreshes=True,
+                   group="preemptible_instances_scheduler")
+        self.host_manager = host_manager.HostManager()
+        self.refreshes = []
+
+    def _fake_refresh(self, context, partial=False):
+        self.refreshes.append(partial)
+        seen_nodes = [("host%d" % len(self.refreshes), "node")]
+        # Yield to the other green threads, as a database query would
+        eventlet.sleep(0.01)
+        return seen_nodes
+
+    def _run_concurrently(self, *partials):
+        pool = eventlet.GreenPool()
+        threads = [pool.spawn(self.host_manager._get_seen_nodes,
+                              'fake_context', partial=partial)
+                   for partial in partials]
+        return [thread.wait() for thread in threads]
+
+    def test_coalesce_refreshes(self):
+        with mock.patch.object(self.host_manager, '_refresh_host_states',
+                               side_effect=self._fake_refresh):
+            results = self._run_concurrently(True, True, False, True)
+
+        self.assertEqual([True], self.refreshes)
+        self.assertEqual([[("host1", "node")]] * 4, results)
+        self.assertIsNone(self.host_manager._inflight_refresh)
+
+    def test_coalesce_refreshes_partial_not_covered(self):
+        with mock.patch.object(self.host_manager, '_refresh_host_states',
+                               side_effect=self._fake_refresh):
+            results = self._run_concurrently(False, True, False)
+
+        self.assertEqual([False, True], self.refreshes)
+        self.assertEqual([("host1", "node")], results[0])
+        self.assertEqual([("host2", "node")], results[1])
+
+    def test_coalesce_refreshes_disabled(self):
+        self.flags(coalesce_refreshes=False,
+                   group="preemptible_instances_scheduler")
+        with mock.patch.object(self.host_manager, '_refresh_host_states',
+                               side_effect=self._fake_refresh):
+            self._run_concurrently(True, True)
+
+        self.assertEqual([True, True], self.refreshes)
+
+    def test_coalesce_refreshes_error(self):
+        def _fail(context, partial=False):
+            eventlet.sleep(0.01)
+            raise exception.NotFound()
+
+        with mock.patch.object(self.host_manager, '_refresh_host_states',
+                               side_effect=_fail):
+            pool = eventlet.GreenPool()
+            threads = [pool.spawn(self.host_manager._get_seen_nodes,
+                                  'fake_context', partial=True)
+                       for _ in range(2)]
+            for thread in threads:
+                self.assertRaises(exception.NotFound, thread.wait)
+        self.assertIsNone(self.host_manager._inflight_refresh)
+
+
+class OpieHostManagerReservationsTestCase(nova_test.NoDBTestCase):
+    """Test case for the preemption reservations in the HostManager."""
+
+    @mock.patch.object(host_manager.HostManager, '_init_instance_info')
+    @mock.patch.object(host_manager.HostManager, '_init_aggregates')
+    def setUp(self, mock_init_agg, mock_init_inst):
+        super(OpieHostManagerReservationsTestCase, self).setUp()
+        self.flags(preemption_reservation_ttl=300,
+                   group="preemptible_instances_scheduler")
+        self.host_manager = host_manager.HostManager()
+        self.compute = fakes.COMPUTE_NODES[0].obj_clone()
+        self.service = fakes.SERVICES[0]
+        self.instances = {}
+        for uuid, memory_mb in ((uuids.victim, 256), (uuids.other, 128)):
+            instance = fake_instance.fake_instance_obj(
+                'fake', uuid=uuid, memory_mb=memory_mb, root_gb=0,
+                ephemeral_gb=0, vcpus=1)
+            instance.system_metadata = {"preemptible": True}
+            self.instances[uuid] = instance
+        self.host_manager.preemption_ledger.reserve(
+            ("host1", "node1"), [uuids.victim], (256, 0, 1),
+            instances=[uuids.new])
+
+    def _update(self, inst_dict):
+        state_key = self.host_manager._update_host_states(
+            'fake_context', self.compute, self.service, False, inst_dict)
+        return self.host_manager.host_state_map[state_key]
+
+    def test_reserved_victims_excluded(self):
+        host = self._update(self.instances)
+
+        self.assertEqual([uuids.other], list(host.instances))
+        self.assertEqual(128, host.preemptible_ram_mb)
+        # The victim is still running, its resources are used
+        self.assertEqual(512, host.free_ram_mb)
+
+    def test_reserved_resources_consumed(self):
+        instances = {uuids.other: self.instances[uuids.other]}
+        host = self._update(instances)
+
+        # The victim is gone, the new instance is not built yet
+        self.assertEqual(512 - 256, host.free_ram_mb)
+        self.assertEqual(1, host.num_instances)
+
+        # The compute node did not report since, so its data is not applied
+        # and the reservation is not consumed again
+        host = self._update(instances)
+        self.assertEqual(512 - 256, host.free_ram_mb)
+
+    def test_reservation_released_when_built(self):
+        new = fake_instance.fake_instance_obj(
+            'fake', uuid=uuids.new, memory_mb=256, root_gb=0,
+            ephemeral_gb=0, vcpus=1)
+        instances = {uuids.other: self.instances[uuids.other],
+                     uuids.new: new}
+        host = self._update(instances)
+
+        # The compute node already accounts for the new instance, its
+        # resources must not be consumed twice
+        self.assertEqual(512, host.free_ram_mb)
+        self.assertEqual(
+            [], self.host_manager.preemption_ledger.get_reservations(
+                ("host1", "node1")))
+
+        self.compute.updated_at = timeutils.utcnow()
+        host = self._update(instances)
+        self.assertEqual(512, host.free_ram_mb)
+
+    def test_reservations_expired(self):
+        self.host_manager.preemption_ledger.discard(("host1", "node1"))
+        host = self._update(self.instances)
+
+        self.assertEqual(set([uuids.victim, uuids.other]),
+                         set(host.instances))
+        self.assertEqual(512, host.free_ram_mb)
+
+
+class OpieHostManagerAggregatesTestCase(nova_test.NoDBTestCase):
+    """Test case for the aggregates cache of the opie HostManager."""
+
+    @mock.patch.object(host_manager.HostManager, '_init_instance_info')
+    @mock.patch.object(host_manager.HostManager, '_init_aggregates')
+    def setUp(self, mock_init_agg, mock_init_inst):
+        super(OpieHostManagerAggregatesTestCase, self).setUp()
+        self.host_manager = host_manager.HostManager()
+        self.agg1 = nova.objects.Aggregate(id=1, hosts=['host1', 'host2'])
+        self.agg2 = nova.objects.Aggregate(id=2, hosts=['host3'])
+        self.host_manager.update_aggregates([self.agg1, self.agg2])
+
+    def test_aggregates_info_cached(self):
+        info = self.host_manager._get_aggregates_info('host1')
+        self.assertEqual([self.agg1], info)
+        self.assertIs(info, self.host_manager._get_aggregates_info('host1'))
+        self.assertEqual([], self.host_manager._get_aggregates_info('host4'))
+
+    def test_update_aggregate_affected_hosts(self):
+        info = {host: self.host_manager._get_aggregates_info(host)
+                for host in ('host1', 'host2', 'host3')}
+        generation = self.host_manager.aggregates_generation
+
+        agg1 = nova.objects.Aggregate(id=1, hosts=['host1', 'host4'])
+        self.host_manager.update_aggregates(agg1)
+
+        self.assertEqual(generation + 1,
+                         self.host_manager.aggregates_generation)
+        self.assertEqual([agg1],
+                         self.host_manager._get_aggregates_info('host1'))
+        self.assertEqual([], self.host_manager._get_aggregates_info('host2'))
+        self.assertEqual([agg1],
+                         self.host_manager._get_aggregates_info('host4'))
+        self.assertIs(info['host3'],
+                      self.host_manager._get_aggregates_info('host3'))
+
+    def test_delete_aggregate_affected_hosts(self):
+        info = self.host_manager._get_aggregates_info('host3')
+        self.host_manager._get_aggregates_info('host1')
+
+        self.host_manager.delete_aggregate(self.agg1)
+
+        self.assertEqual([], self.host_manager._get_aggregates_info('host1'))
+        self.assertIs(info, self.host_manager._get_aggregates_info('host3'))
+
+    @mock.patch('opie.scheduler.db.get_compute_node_ids')
+    @mock.patch('opie.scheduler.db.get_compute_nodes_changed_since')
+    @mock.patch('nova.objects.ServiceList.get_by_binary')
+    @mock.patch('nova.objects.InstanceList.get_by_host')
+    def test_delta_refresh_aggregates(self, mock_get_by_host,
+                                      mock_get_by_binary, mock_get_changed,
+                                      mock_get_ids):
+        self.flags(delta_refresh=True,
+                   group="preemptible_instances_scheduler")
+        mock_get_by_host.return_value = nova.objects.InstanceList()
+        mock_get_by_binary.return_value = fakes.SERVICES
+        mock_get_changed.return_value = fakes.COMPUTE_NODES[:4]
+        mock_get_ids.return_value = set([1, 2, 3, 4])
+        context = 'fake_context'
+
+        full, partial = self.host_manager.get_host_state_snapshot(context)
+        self.assertEqual([self.agg1], full[0].aggregates)
+
+        mock_get_changed.return_value = []
+        with mock.patch.object(self.host_manager,
+                               '_get_aggregates_info') as mock_info:
+            self.host_manager.get_host_state_snapshot(context)
+        self.assertFalse(mock_info.called)
+
+        self.host_manager.delete_aggregate(self.agg1)
+        full, partial = self.host_manager.get_host_state_snapshot(context)
+        self.assertEqual([], full[0].aggregates)
+        self.assertEqual([], partial[1].aggregates)
+        self.assertEqual([self.agg2], full[2].aggregates)
+
+
+class OpieHostManagerBulkInstanceLoadTestCase(nova_test.NoDBTestCase):
+    """Test case for the bulk instance load of the opie HostManager."""
+
+    @mock.patch.object(host_manager.HostManager, '_init_instance_info')
+    @mock.patch.object(host_manager.HostManager, '_init_aggregates')
+    def setUp(self, mock_init_agg, mock_init_inst):
+        super(OpieHostManagerBulkInstanceLoadTestCase, self).setUp()
+        self.flags(bulk_instance_load=True,
+                   group="preemptible_instances_scheduler")
+        self.host_manager = host_manager.HostManager()
+
+    @staticmethod
+    def _row(uuid, host, preemptible=None):
+        return mock.Mock(uuid=uuid, host=host, memory_mb=512, root_gb=1,
+                         ephemeral_gb=1, vcpus=1,
+                         created_at=datetime.datetime(2016, 1, 1),
+                         project_id="fake", instance_type_id=1,
+                         preemptible=preemptible)
+
+    @mock.patch('opie.scheduler.db.get_instance_summaries_by_host')
+    @mock.patch('nova.objects.ServiceList.get_by_binary')
+    @mock.patch('nova.objects.ComputeNodeList.get_all')
+    @mock.patch('nova.objects.InstanceList.get_by_host')
+    def test_bulk_instance_load(self, mock_get_by_host, mock_get_all,
+                                mock_get_by_binary, mock_get_summaries):
+        mock_get_all.return_value = fakes.COMPUTE_NODES[:4]
+        mock_get_by_binary.return_value = fakes.SERVICES
+        mock_get_summaries.return_value = [
+            self._row(uuids.instance1, "host1", preemptible="True"),
+            self._row(uuids.instance2, "host1"),
+            self._row(uuids.instance3, "host3", preemptible="True"),
+        ]
+        context = 'fake_context'
+
+        full, partial = self.host_manager.get_host_state_snapshot(context)
+
+        self.assertFalse(mock_get_by_host.called)
+        mock_get_summaries.assert_called_once_with(context, mock.ANY)
+        self.assertEqual(set(["host1", "host2", "host3", "host4"]),
+                         set(mock_get_summaries.call_args[0][1]))
+
+        hosts = {h.host: h for h in full}
+        self.assertEqual(set([uuids.instance1, uuids.instance2]),
+                         set(hosts["host1"].instances))
+        self.assertEqual([uuids.instance1],
+                         list(hosts["host1"].preemptible_instances))
+        self.assertEqual([uuids.instance2],
+                         list(hosts["host1"].normal_instances))
+        self.assertEqual(512, hosts["host1"].preemptible_ram_mb)
+        self.assertEqual(2048, hosts["host1"].preemptible_disk_mb)
+        self.assertEqual({}, hosts["host2"].instances)
+        self.assertEqual([uuids.instance3],
+                         list(hosts["host3"].preemptible_instances))
+
+    @mock.patch('opie.scheduler.db.get_instance_summaries_by_host')
+    @mock.patch('nova.objects.ServiceList.get_by_binary')
+    @mock.patch('nova.objects.ComputeNodeList.get_all')
+    @mock.patch('nova.objects.InstanceList.get_by_host')
+    def test_bulk_instance_load_tracked_hosts(self, mock_get_by_host,
+                                              mock_get_all,
+                                              mock_get_by_binary,
+                                              mock_get_summaries):
+        mock_get_all.return_value = fakes.COMPUTE_NODES[:4]
+        mock_get_by_binary.return_value = fakes.SERVICES
+        mock_get_summaries.return_value = []
+        inst = fake_instance.fake_instance_obj('fake', uuid=uuids.instance1,
+                                               host="host1")
+        self.host_manager._instance_info = {
+            "host1": {"instances": {inst.uuid: inst}, "updated": True},
+        }
+        context = 'fake_context'
+
+        full, partial = self.host_manager.get_host_state_snapshot(context)
+
+        self.assertFalse(mock_get_by_host.called)
+        self.assertEqual(set(["host2", "host3", "host4"]),
+                         set(mock_get_summaries.call_args[0][1]))
+        hosts = {h.host: h for h in full}
+        self.assertEqual([uuids.instance1], list(hosts["host1"].instances))
+
+
 class OpieHostStateTestCase(nova_test.NoDBTestCase):
     """Test case for Opie HostStatePartial class."""
 
@@ -277,7 +907,8 @@ class OpieHostStateTestCase(nova_test.NoDBTestCase):
                                   vcpus=0),
             numa_topology=fake_numa_topology,
             pci_requests=nova.objects.InstancePCIRequests(requests=[]))
-        host = host_manager.HostStatePartial("fakehost", "fakenode")
+        full = host_manager.HostState("fakehost", "fakenode")
+        host = host_manager.HostStatePartial(full)
 
         self.assertIsNone(host.updated)
         host.consume_from_request(spec_obj)
@@ -310,64 +941,13 @@ class OpieHostStateTestCase(nova_test.NoDBTestCase):
         self.assertEqual(second_host_numa_topology, host.numa_topology)
         self.assertIsNotNone(host.updated)
 
-    @mock.patch('nova.utils.synchronized',
-                side_effect=lambda a: lambda f: lambda *args: f(*args))
-    @mock.patch('nova.virt.hardware.get_host_numa_usage_from_instance')
-    @mock.patch('nova.objects.Instance')
-    @mock.patch('nova.virt.hardware.numa_fit_instance_to_host')
-    @mock.patch('nova.virt.hardware.host_topology_and_format_from_host')
-    def test_stat_unconsumption_from_instance(self, host_topo_mock,
-                                            numa_fit_mock,
-                                            instance_init_mock,
-                                            numa_usage_mock,
-                                            sync_mock):
-        fake_numa_topology = nova.objects.InstanceNUMATopology(
-            cells=[nova.objects.InstanceNUMACell()])
-        fake_host_numa_topology = mock.Mock()
-        fake_instance = nova.objects.Instance(numa_topology=fake_numa_topology)
-        host_topo_mock.return_value = (fake_host_numa_topology, True)
-        numa_usage_mock.return_value = fake_host_numa_topology
-        numa_fit_mock.return_value = fake_numa_topology
-        instance_init_mock.return_value = fake_instance
-        spec_obj = nova.objects.RequestSpec(
-            instance_uuid=uuids.instance,
-            flavor=nova.objects.Flavor(root_gb=0, ephemeral_gb=0, memory_mb=0,
-                                  vcpus=0),
-            numa_topology=fake_numa_topology,
-            pci_requests=nova.objects.InstancePCIRequests(requests=[]))
-        host = host_manager.HostStatePartial("fakehost", "fakenode")
-
-        self.assertIsNone(host.updated)
-        host.consume_from_request(spec_obj)
-        self.assertIsNotNone(host.updated)
-        self.assertEqual(1, host.num_instances)
-
-        second_numa_topology = nova.objects.InstanceNUMATopology(
-            cells=[nova.objects.InstanceNUMACell()])
-        spec_obj = nova.objects.RequestSpec(
-            instance_uuid=uuids.instance,
-            flavor=nova.objects.Flavor(root_gb=1, ephemeral_gb=1, memory_mb=3,
-                                  vcpus=4),
-            numa_topology=second_numa_topology,
-            pci_requests=nova.objects.InstancePCIRequests(requests=[]))
-        second_host_numa_topology = mock.Mock()
-        numa_usage_mock.return_value = second_host_numa_topology
-        numa_fit_mock.return_value = second_numa_topology
-
-        host.consume_from_request(spec_obj)
-        self.assertEqual(2, host.num_instances)
-        self.assertEqual(2, host.num_io_ops)
-
-        host._unconsume_from_request(spec_obj)
-        self.assertEqual(1, host.num_instances)
-        self.assertEqual(2, host.num_io_ops)
-        self.assertEqual(0, host.free_disk_mb)
-        self.assertEqual(0, host.free_ram_mb)
-        self.assertEqual(0, host.vcpus_used)
-        self.assertIsNotNone(host.updated)
-
-    def test_stat_unconsumption_from_instance_list(self):
+        # The full state is left untouched
+        self.assertEqual(0, full.num_instances)
+        self.assertEqual(0, full.num_io_ops)
+        self.assertIsNone(full.numa_topology)
+        self.assertIsNone(full.updated)
 
+    def _get_instances(self):
         instances = {}
         inst = fake_instance.fake_instance_obj(
             "fake context", root_gb=0, ephemeral_gb=0, memory_mb=0, vcpus=0,
@@ -386,28 +966,229 @@ class OpieHostStateTestCase(nova_test.NoDBTestCase):
             uuid='fake-uuid-preemptible'
         )
         inst.system_metadata = {"preemptible": True}
+        inst.created_at = datetime.datetime(2016, 1, 1)
         instances[inst.uuid] = inst
+        return instances
 
-        host = host_manager.HostStatePartial("fakehost", "fakenode")
+    def _get_full_state(self):
+        full = host_manager.HostState("fakehost", "fakenode")
+        full.vcpus_used = 4
+        full.num_instances = 2
+        full.instances = self._get_instances()
+        return full
 
-        self.assertIsNone(host.updated)
-        # Instances consume resources in the scheduling loop
-        for instance in instances.values():
-            host.consume_from_request(instance)
+    def test_overlay(self):
+        full = self._get_full_state()
+        host = host_manager.HostStatePartial(full)
 
-        host.instances = instances
+        self.assertIs(host, full.partial)
+        self.assertEqual(3, host.free_ram_mb)
+        self.assertEqual(2048, host.free_disk_mb)
+        self.assertEqual(0, host.vcpus_used)
         self.assertEqual(1, host.num_instances)
-        self.assertEqual(0, host.num_io_ops)
-        self.assertEqual(0, host.free_disk_mb)
+        self.assertEqual(("fakehost", "fakenode"), (host.host, host.nodename))
+        self.assertIs(full.instances, host.instances)
+        self.assertIn('fake-uuid-preemptible', host.preemptible_instances)
+        self.assertIn('fake-uuid-normal', host.normal_instances)
+        self.assertEqual(0, full.free_ram_mb)
+        self.assertEqual(4, full.vcpus_used)
+        self.assertRaises(AttributeError, setattr, host, "instances", {})
+
+    def test_overlay_lazy(self):
+        full = self._get_full_state()
+        host = host_manager.HostStatePartial(full)
+        self.assertNotIn("free_ram_mb", host.__dict__)
+
+        full.free_ram_mb = 100
+        self.assertEqual(103, host.free_ram_mb)
+        self.assertIn("free_ram_mb", host.__dict__)
+
+    def test_overlay_copy_on_write(self):
+        full = self._get_full_state()
+        host = host_manager.HostStatePartial(full)
+
+        host.free_ram_mb -= 3
+        host.num_io_ops += 1
         self.assertEqual(0, host.free_ram_mb)
+        self.assertEqual(1, host.num_io_ops)
+        self.assertEqual(0, full.num_io_ops)
+
+    @mock.patch.object(nova_host_manager.HostState, 'consume_from_request')
+    def test_overlay_materialized_before_full_changes(self, mock_consume):
+        full = self._get_full_state()
+        host = host_manager.HostStatePartial(full)
+
+        full.consume_from_request(mock.sentinel.spec_obj)
+        mock_consume.assert_called_once_with(mock.sentinel.spec_obj)
+        full.free_ram_mb -= 100
+        full.remove_preemptible_instances(['fake-uuid-preemptible'])
+        self.assertEqual(3, host.free_ram_mb)
         self.assertEqual(0, host.vcpus_used)
-        self.assertIsNotNone(host.updated)
-        self.assertIn('fake-uuid-normal', host.normal_instances)
-        self.assertIn('fake-uuid-normal', host.instances)
-        self.assertIn('fake-uuid-preemptible', host.preemptible_instances)
-        self.assertIn('fake-uuid-preemptible', host.instances)
 
-        # Setting the instances a second time should leave the resources as
-        # they were
+    def test_overlay_reset_on_update(self):
+        full = self._get_full_state()
+        host = host_manager.HostStatePartial(full)
+        host.free_ram_mb = 0
+        host.limits["memory_mb"] = 1024
+
+        full.update(aggregates=[mock.sentinel.aggregate])
+        self.assertEqual(3, host.free_ram_mb)
+        self.assertEqual([mock.sentinel.aggregate], host.aggregates)
+        self.assertEqual({"memory_mb": 1024}, host.limits)
+        self.assertEqual({}, full.limits)
+
+
+class OpieHostStateTotalsTestCase(nova_test.NoDBTestCase):
+    """Test case for the preemptible totals of the Opie HostState class."""
+
+    def _get_instance(self, uuid, preemptible, memory_mb=512, created_at=None):
+        inst = fake_instance.fake_instance_obj(
+            "fake context", root_gb=1, ephemeral_gb=1, memory_mb=memory_mb,
+            vcpus=2, project_id='12345', vm_state=vm_states.ACTIVE,
+            os_type='Linux', uuid=uuid)
+        inst.system_metadata = {"preemptible": True} if preemptible else {}
+        inst.created_at = created_at or datetime.datetime(2016, 1, 1)
+        return inst
+
+    def test_totals(self):
+        instances = {
+            "normal": self._get_instance("normal", False, memory_mb=1024),
+            "preemptible1": self._get_instance(
+                "preemptible1", True, created_at=datetime.datetime(
+                    2016, 1, 1, 0, 0, 0)),
+            "preemptible2": self._get_instance(
+                "preemptible2", True, created_at=datetime.datetime(
+                    2016, 1, 1, 0, 30, 0)),
+        }
+        host = host_manager.HostState("fakehost", "fakenode")
+        host.instances = instances
+
+        self.assertEqual(2, host.num_preemptible_instances)
+        self.assertEqual(1024, host.preemptible_ram_mb)
+        self.assertEqual(4 * 1024, host.preemptible_disk_mb)
+        self.assertEqual(4, host.preemptible_vcpus)
+        self.assertIn("normal", host.normal_instances)
+
+        # Setting the instances a second time should not change the totals
+        host.instances = instances
+        self.assertEqual(2, host.num_preemptible_instances)
+        self.assertEqual(1024, host.preemptible_ram_mb)
+
+        host.remove_preemptible_instances(["preemptible1", "normal"])
+        self.assertEqual(1, host.num_preemptible_instances)
+        self.assertEqual(512, host.preemptible_ram_mb)
+        self.assertEqual(2 * 1024, host.preemptible_disk_mb)
+        self.assertEqual(2, host.preemptible_vcpus)
+        self.assertEqual(["preemptible2"],
+                         list(host.preemptible_instances.keys()))
+
+    def test_instance_summaries(self):
+        instance = self._get_instance("preemptible", True)
+        instance.instance_type_id = 42
+        host = host_manager.HostState("fakehost", "fakenode")
+        host.instances = {"preemptible": instance}
+
+        summary = host.instances["preemptible"]
+        self.assertIsInstance(summary, host_manager.InstanceSummary)
+        self.assertIs(summary, host.preemptible_instances["preemptible"])
+        self.assertEqual((512, 2 * 1024, 2), summary.resources)
+        self.assertTrue(summary.preemptible)
+        self.assertEqual(
+            host_manager.to_timestamp(datetime.datetime(2016, 1, 1)),
+            summary.created_at)
+        self.assertEqual("12345", summary.project_id)
+        self.assertEqual(42, summary.instance_type_id)
+        self.assertEqual("preemptible", summary["uuid"])
+        self.assertRaises(KeyError, lambda: summary["system_metadata"])
+        self.assertFalse(hasattr(summary, "__dict__"))
+
+        # The summaries are kept when the instances are set again
+        host.instances = {"preemptible": instance}
+        self.assertIs(summary, host.instances["preemptible"])
+
+    def test_instances_diff(self):
+        instances = {
+            "normal": self._get_instance("normal", False),
+            "preemptible1": self._get_instance("preemptible1", True),
+            "preemptible2": self._get_instance("preemptible2", True),
+        }
+        host = host_manager.HostState("fakehost", "fakenode")
+        partial = host_manager.HostStatePartial(host)
+        host.instances = instances
+        summaries = dict(host.instances)
+
+        # Nothing changed, the summaries are kept
+        host.instances = dict(instances)
+        for uuid, summary in summaries.items():
+            self.assertIs(summary, host.instances[uuid])
+        self.assertEqual(2, host.num_preemptible_instances)
+
+        # preemptible1 and normal are gone, preemptible2 was resized and
+        # there is a new preemptible instance
+        resized = self._get_instance("preemptible2", True, memory_mb=2048)
+        host.instances = {
+            "preemptible2": resized,
+            "preemptible3": self._get_instance("preemptible3", True),
+        }
+        self.assertEqual(set(["preemptible2", "preemptible3"]),
+                         set(host.instances))
+        self.assertEqual(set(["preemptible2", "preemptible3"]),
+                         set(host.preemptible_instances))
+        self.assertEqual({}, host.normal_instances)
+        self.assertEqual(2, host.num_preemptible_instances)
+        self.assertEqual(2048 + 512, host.preemptible_ram_mb)
+        self.assertEqual(2 * 2 * 1024, host.preemptible_disk_mb)
+        self.assertEqual(4, host.preemptible_vcpus)
+        self.assertEqual(2048 + 512, partial.free_ram_mb)
+
+        # An instance selected for termination is not accounted twice
+        host.remove_preemptible_instances(["preemptible3"])
+        host.instances = {"preemptible2": resized}
+        self.assertEqual(1, host.num_preemptible_instances)
+        self.assertEqual(2048, host.preemptible_ram_mb)
+
+    def test_instances_failed_termination(self):
+        instances = {
+            "normal": self._get_instance("normal", False),
+            "preemptible1": self._get_instance("preemptible1", True),
+            "preemptible2": self._get_instance("preemptible2", True),
+        }
+        host = host_manager.HostState("fakehost", "fakenode")
         host.instances = instances
+        summary = host.instances["preemptible1"]
+
+        host.remove_preemptible_instances(["preemptible1"])
+        self.assertEqual(1, host.num_preemptible_instances)
+
+        # The deletion failed, so the instance is still there
+        host.instances = dict(instances)
+        self.assertIs(summary, host.instances["preemptible1"])
+        self.assertIs(summary, host.preemptible_instances["preemptible1"])
+        self.assertEqual(2, host.num_preemptible_instances)
+        self.assertEqual(1024, host.preemptible_ram_mb)
+
+        # And it is not accounted twice afterwards
+        host.instances = dict(instances)
+        self.assertEqual(2, host.num_preemptible_instances)
+
+    @mock.patch('nova.utils.synchronized',
+                side_effect=lambda a: lambda f: lambda *args: f(*args))
+    def test_remove_preemptible_instances_unconsume(self, sync_mock):
+        host = host_manager.HostState("fakehost", "fakenode")
+        host.vcpus_used = 6
+        host.num_instances = 3
+        host.instances = {
+            "normal": self._get_instance("normal", False),
+            "preemptible1": self._get_instance("preemptible1", True),
+            "preemptible2": self._get_instance("preemptible2", True),
+        }
+
+        host.remove_preemptible_instances(["preemptible1", "preemptible2"])
+        # A single lock acquisition for all the instances
+        sync_mock.assert_called_once_with(("fakehost", "fakenode"))
+        self.assertEqual(1024, host.free_ram_mb)
+        self.assertEqual(4 * 1024, host.free_disk_mb)
+        self.assertEqual(2, host.vcpus_used)
         self.assertEqual(1, host.num_instances)
+        self.assertIsNotNone(host.updated)
+        self.assertEqual(0, host.num_preemptible_instances)
@@ -0,0 +1,111 @@
+# Copyright 2016 Spanish National Research Council - CSIC
+# Copyright 2016 INDIGO-DataCloud
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from opie.scheduler import ledger
+
+import mock
+from nova import test as nova_test
+from oslo_utils import timeutils
+
+
+class PreemptionLedgerTestCase(nova_test.NoDBTestCase):
+    def setUp(self):
+        super(PreemptionLedgerTestCase, self).setUp()
+        self.ledger = ledger.PreemptionLedger(60)
+        self.host1 = ("host1", "node1")
+        self.host2 = ("host2", "node2")
+
+    @mock.patch.object(timeutils, 'now', return_value=1000)
+    def test_reserve(self, mock_now):
+        self.ledger.reserve(self.host1, ["uuid1", "uuid2"], (512, 1024, 1))
+        self.ledger.reserve(self.host1, ["uuid3"], (512, 1024, 1))
+        self.ledger.reserve(self.host2, ["uuid4"], (512, 1024, 1))
+
+        self.assertEqual(set(["uuid1", "uuid2", "uuid3"]),
+                         self.ledger.get_victims(self.host1))
+        self.assertEqual(set(["uuid4"]), self.ledger.get_victims(self.host2))
+        self.assertEqual([(512, 1024, 1), (512, 1024, 1)],
+                         [r.resources for r in
+                          self.ledger.get_reservations(self.host1)])
+
+    @mock.patch.object(timeutils, 'now')
+    def test_reservations_expire(self, mock_now):
+        mock_now.return_value = 1000
+        self.ledger.reserve(self.host1, ["uuid1"], (512, 1024, 1))
+        mock_now.return_value = 1030
+        self.ledger.reserve(self.host1, ["uuid2"], (512, 1024, 1))
+
+        mock_now.return_value = 1060
+        self.assertEqual(set(["uuid2"]), self.ledger.get_victims(self.host1))
+        mock_now.return_value = 1090
+        self.assertEqual(set(), self.ledger.get_victims(self.host1))
+        self.assertEqual({}, self.ledger._reservations)
+
+    def test_reserve_disabled(self):
+        self.ledger = ledger.PreemptionLedger(0)
+        self.ledger.reserve(self.host1, ["uuid1"], (512, 1024, 1))
+        self.assertEqual([], self.ledger.get_reservations(self.host1))
+
+    @mock.patch.object(timeutils, 'now', return_value=1000)
+    def test_reserve_ttl(self, mock_now):
+        self.ledger = ledger.PreemptionLedger(0)
+        self.ledger.reserve(self.host1, ["uuid1"], (512, 1024, 1), ttl=20)
+        self.ledger.reserve(self.host1, ["uuid2"], (512, 1024, 1), ttl=0)
+        reservations = self.ledger.get_reservations(self.host1)
+        self.assertEqual([frozenset(["uuid1"])],
+                         [r.victims for r in reservations])
+        self.assertEqual(1020, reservations[0].expires)
+
+    def test_reserve_no_victims(self):
+        self.ledger.reserve(self.host1, [], (512, 1024, 1))
+        self.assertEqual([], self.ledger.get_reservations(self.host1))
+
+    def test_release(self):
+        self.ledger.reserve(self.host1, ["uuid1"], (512, 1024, 1))
+        self.ledger.reserve(self.host1, ["uuid2"], (512, 1024, 1))
+        first = self.ledger.get_reservations(self.host1)[0]
+        self.ledger.release(self.host1, [first])
+        self.assertEqual(set(["uuid2"]), self.ledger.get_victims(self.host1))
+        self.ledger.release(self.host1,
+                            self.ledger.get_reservations(self.host1))
+        self.assertEqual({}, self.ledger._reservations)
+
+    def test_discard(self):
+        self.ledger.reserve(self.host1, ["uuid1"], (512, 1024, 1))
+        self.ledger.reserve(self.host2, ["uuid2"], (512, 1024, 1))
+        self.ledger.discard(self.host1)
+        self.assertEqual(set(), self.ledger.get_victims(self.host1))
+        self.assertEqual(set(["uuid2"]), self.ledger.get_victims(self.host2))
+
+    def test_lock_name(self):
+        self.assertEqual("opie-preemption-host1-node1",
+                         ledger.PreemptionLedger.lock_name(self.host1))
+
+
+class ReservationTestCase(nova_test.NoDBTestCase):
+    def test_is_built(self):
+        reservation = ledger.Reservation(["victim"], (512, 1024, 1), 0,
+                                         instances=["new"])
+        self.assertFalse(reservation.is_built({"other": None}))
+        self.assertTrue(reservation.is_built({"other": None, "new": None}))
+
+    def test_is_built_unknown_instances(self):
+        reservation = ledger.Reservation(["victim"], (1024, 2048, 2), 0,
+                                         instances=["new1"], placements=2,
+                                         baseline=["victim", "other"])
+        self.assertFalse(reservation.is_built(
+            {"victim": None, "other": None, "new1": None}))
+        self.assertTrue(reservation.is_built(
+            {"other": None, "new1": None, "new2": None}))
@@ -0,0 +1,205 @@
+# Copyright 2016 Spanish National Research Council - CSIC
+# Copyright 2016 INDIGO-DataCloud
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+
+from opie.scheduler import metrics
+
+import fixtures
+import mock
+from nova import test as nova_test
+
+
+class FakeSink(object):
+    def __init__(self):
+        self.observed = []
+        self.incremented = []
+        self.gauges = []
+        self.flushed = 0
+
+    def observe(self, name, value, tags):
+        self.observed.append((name, tags))
+
+    def increment(self, name, value, tags):
+        self.incremented.append((name, value, tags))
+
+    def gauge(self, name, value, tags):
+        self.gauges.append((name, value, tags))
+
+    def flush(self, histograms, counters, gauges):
+        self.flushed += 1
+
+
+class HistogramTestCase(nova_test.NoDBTestCase):
+    def test_observe(self):
+        histogram = metrics.Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual(4, histogram.count)
+        self.assertAlmostEqual(2.65, histogram.sum)
+        self.assertEqual([(0.1, 2), (1.0, 3), (float("inf"), 4)],
+                         histogram.cumulative_counts())
+
+
+class MetricsRegistryTestCase(nova_test.NoDBTestCase):
+    def setUp(self):
+        super(MetricsRegistryTestCase, self).setUp()
+        self.sink = FakeSink()
+        self.registry = metrics.MetricsRegistry(self.sink, flush_interval=60)
+
+    def test_timer(self):
+        with self.registry.timer("filtering", request="normal"):
+            pass
+        timer = self.registry.timer("select_destinations", request="normal")
+        timer.stop(victims=2)
+
+        self.assertEqual(
+            [("filtering", (("request", "normal"),)),
+             ("select_destinations", (("request", "normal"),
+                                      ("victims", "2")))],
+            self.sink.observed)
+        key = ("filtering", (("request", "normal"),))
+        self.assertEqual(1, self.registry.histograms[key].count)
+
+    def test_increment(self):
+        self.registry.increment("retries_avoided", request="normal")
+        self.registry.increment("retries_avoided", 2, request="normal")
+
+        self.assertEqual(
+            [("retries_avoided", 1, (("request", "normal"),)),
+             ("retries_avoided", 2, (("request", "normal"),))],
+            self.sink.incremented)
+        key = ("retries_avoided", (("request", "normal"),))
+        self.assertEqual(3, self.registry.counters[key])
+        self.assertEqual({}, self.registry.histograms)
+
+    def test_gauge(self):
+        self.registry.gauge("reaper_queue_depth", 3)
+        self.registry.gauge("reaper_queue_depth", 1)
+
+        self.assertEqual([("reaper_queue_depth", 3, ()),
+                          ("reaper_queue_depth", 1, ())],
+                         self.sink.gauges)
+        self.assertEqual(1, self.registry.gauges["reaper_queue_depth", ()])
+
+    def test_flush_interval(self):
+        self.registry.flush()
+        self.registry.flush()
+        self.assertEqual(1, self.sink.flushed)
+
+    def test_flush_error(self):
+        self.sink.flush = mock.Mock(side_effect=IOError)
+        self.registry.flush()
+
+    def test_null_registry(self):
+        registry = metrics.NullRegistry()
+        with registry.timer("filtering", request="normal") as timer:
+            timer.stop(victims=1)
+        registry.increment("retries_avoided", request="normal")
+        registry.gauge("reaper_queue_depth", 1)
+        registry.flush()
+
+
+class GetRegistryTestCase(nova_test.NoDBTestCase):
+    def setUp(self):
+        super(GetRegistryTestCase, self).setUp()
+        patcher = mock.patch.object(metrics, "_REGISTRY", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_disabled(self):
+        self.assertIs(metrics.NULL_REGISTRY, metrics.get_registry())
+
+    def test_textfile(self):
+        self.flags(metrics_enabled=True,
+                   group="preemptible_instances_scheduler")
+        registry = metrics.get_registry()
+        self.assertIsInstance(registry.sink, metrics.TextfileSink)
+        self.assertIs(registry, metrics.get_registry())
+
+    def test_statsd(self):
+        self.flags(metrics_enabled=True, metrics_sink="statsd",
+                   group="preemptible_instances_scheduler")
+        registry = metrics.get_registry()
+        self.assertIsInstance(registry.sink, metrics.StatsdSink)
+
+
+class SinksTestCase(nova_test.NoDBTestCase):
+    def _get_histograms(self):
+        histogram = metrics.Histogram(buckets=(0.1,))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        return {("filtering", (("request", "normal"),)): histogram}
+
+    def test_textfile_format(self):
+        sink = metrics.TextfileSink("/nonexistent", "opie")
+        expected = (
+            '# TYPE opie_filtering_seconds histogram\n'
+            'opie_filtering_seconds_bucket{request="normal",le="0.1"} 1\n'
+            'opie_filtering_seconds_bucket{request="normal",le="+Inf"} 2\n'
+            'opie_filtering_seconds_sum{request="normal"} 0.55\n'
+            'opie_filtering_seconds_count{request="normal"} 2\n')
+        self.assertEqual(expected, sink.format(self._get_histograms()))
+
+    def test_textfile_format_counters(self):
+        sink = metrics.TextfileSink("/nonexistent", "opie")
+        counters = {("retries_avoided", (("request", "normal"),)): 3,
+                    ("retries_avoided", (("request", "preemptible"),)): 1}
+        expected = (
+            '# TYPE opie_retries_avoided_total counter\n'
+            'opie_retries_avoided_total{request="normal"} 3\n'
+            'opie_retries_avoided_total{request="preemptible"} 1\n')
+        self.assertEqual(expected, sink.format({}, counters))
+
+    def test_textfile_format_gauges(self):
+        sink = metrics.TextfileSink("/nonexistent", "opie")
+        gauges = {("reaper_queue_depth", ()): 2}
+        expected = ('# TYPE opie_reaper_queue_depth gauge\n'
+                    'opie_reaper_queue_depth 2\n')
+        self.assertEqual(expected, sink.format({}, gauges=gauges))
+
+    def test_textfile_flush(self):
+        tmpdir = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(tmpdir, "opie.prom")
+        sink = metrics.TextfileSink(path, "opie")
+        counters = {("retries_avoided", ()): 1}
+        gauges = {("reaper_queue_depth", ()): 2}
+        sink.flush(self._get_histograms(), counters, gauges)
+        with open(path) as f:
+            self.assertEqual(
+                sink.format(self._get_histograms(), counters, gauges),
+                f.read())
+        self.assertEqual(["opie.prom"], os.listdir(tmpdir))
+
+    @mock.patch("socket.socket")
+    def test_statsd(self, mock_socket):
+        sink = metrics.StatsdSink("127.0.0.1", 8125, "opie")
+        sink.observe("filtering", 0.0125, (("request", "normal"),))
+        mock_socket.return_value.sendto.assert_called_once_with(
+            b"opie.filtering.request_normal:12.500|ms", ("127.0.0.1", 8125))
+
+    @mock.patch("socket.socket")
+    def test_statsd_increment(self, mock_socket):
+        sink = metrics.StatsdSink("127.0.0.1", 8125, "opie")
+        sink.increment("retries_avoided", 2, (("request", "normal"),))
+        mock_socket.return_value.sendto.assert_called_once_with(
+            b"opie.retries_avoided.request_normal:2|c", ("127.0.0.1", 8125))
+
+    @mock.patch("socket.socket")
+    def test_statsd_gauge(self, mock_socket):
+        sink = metrics.StatsdSink("127.0.0.1", 8125, "opie")
+        sink.gauge("reaper_queue_depth", 3, ())
+        mock_socket.return_value.sendto.assert_called_once_with(
+            b"opie.reaper_queue_depth:3|g", ("127.0.0.1", 8125))
@@ -0,0 +1,85 @@
+# Copyright 2016 Spanish National Research Council - CSIC
+# Copyright 2016 INDIGO-DataCloud
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import itertools
+import random
+
+from opie.scheduler import preemption
+
+from nova import test as nova_test
+
+
+class SelectVictimsTestCase(nova_test.NoDBTestCase):
+    def _candidates(self, resources):
+        return [preemption.Candidate(idx, res, 1 + sum(res) / 1000.)
+                for idx, res in enumerate(resources)]
+
+    def test_nothing_needed(self):
+        candidates = self._candidates([(1, 1, 1)])
+        self.assertEqual([], preemption.select_victims(candidates,
+                                                       (0, -10, 0)))
+
+    def test_not_enough(self):
+        candidates = self._candidates([(100, 0, 1), (100, 0, 1)])
+        self.assertIsNone(preemption.select_victims(candidates, (300, 0, 1)))
+
+    def test_smallest_single(self):
+        candidates = self._candidates([(400, 0, 1), (100, 0, 1),
+                                       (200, 0, 1)])
+        victims = preemption.select_victims(candidates, (150, 0, 0))
+        self.assertEqual([2], [c.key for c in victims])
+
+    def test_multiple_dimensions(self):
+        candidates = self._candidates([(500, 0, 0), (0, 0, 4), (300, 0, 2)])
+        victims = preemption.select_victims(candidates, (200, 0, 2))
+        self.assertEqual([2], [c.key for c in victims])
+
+    def test_several_victims(self):
+        candidates = self._candidates([(100, 0, 1), (100, 0, 1),
+                                       (100, 0, 1), (50, 0, 1)])
+        victims = preemption.select_victims(candidates, (250, 0, 0))
+        self.assertEqual([0, 1, 2], sorted(c.key for c in victims))
+
+    def test_optimal(self):
+        rand = random.Random(42)
+        for _ in range(50):
+            candidates = self._candidates([
+                (rand.choice([512, 1024, 2048]), rand.choice([10, 20]),
+                 rand.choice([1, 2, 4]))
+                for _ in range(rand.randint(1, 8))])
+            needed = (rand.randint(0, 4096), rand.randint(0, 40),
+                      rand.randint(0, 6))
+
+            best = None
+            for size in range(len(candidates) + 1):
+                for comb in itertools.combinations(candidates, size):
+                    if not all(sum(c.resources[d] for c in comb) >= needed[d]
+                               for d in range(3)):
+                        continue
+                    cost = sum(c.cost for c in comb)
+                    if best is None or cost < best:
+                        best = cost
+
+            victims = preemption.select_victims(candidates, needed)
+            if best is None:
+                self.assertIsNone(victims)
+            else:
+                self.assertAlmostEqual(best, sum(c.cost for c in victims))
+
+    def test_max_nodes(self):
+        candidates = self._candidates([(100, 0, 1)] * 300)
+        victims = preemption.select_victims(candidates, (1000, 0, 0),
+                                            max_nodes=10)
+        self.assertEqual(10, len(victims))
@@ -0,0 +1,159 @@
+# Copyright 2016 Spanish National Research Council - CSIC
+# Copyright 2016 INDIGO-DataCloud
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from opie.scheduler import metrics
+from opie.scheduler import reaper
+
+import mock
+from nova import exception
+from nova import test as nova_test
+from nova.tests.unit import fake_instance
+from nova.tests import uuidsentinel as uuids
+
+
+class FakeComputeAPI(object):
+    """Local stand-in for nova.compute.API."""
+
+    def __init__(self, failures=None):
+        # Number of times that the deletion of an instance will fail
+        self.failures = dict(failures or {})
+        self.deleted = []
+
+    def delete(self, context, instance):
+        if self.failures.get(instance.uuid):
+            self.failures[instance.uuid] -= 1
+            raise exception.InstanceNotFound(instance_id=instance.uuid)
+        self.deleted.append(instance.uuid)
+
+
+class PreemptionReaperTestCase(nova_test.NoDBTestCase):
+    def setUp(self):
+        super(PreemptionReaperTestCase, self).setUp()
+
+        def _get_by_filters(context, filters, expected_attrs=None):
+            return [fake_instance.fake_instance_obj(context, uuid=uuid)
+                    for uuid in filters["uuid"]]
+
+        patcher = mock.patch('nova.objects.InstanceList.get_by_filters',
+                             side_effect=_get_by_filters)
+        self.mock_get_by_filters = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get_reaper(self, compute_api, **kwargs):
+        kwargs.setdefault("retry_interval", 0)
+        r = reaper.PreemptionReaper(compute_api, **kwargs)
+        self.addCleanup(r.stop)
+        return r
+
+    def test_terminate_instances(self):
+        compute_api = FakeComputeAPI({uuids.instance1: 1})
+        failed = reaper.terminate_instances(
+            compute_api, "context", [uuids.instance1, uuids.instance2], 2)
+        self.assertEqual([uuids.instance1], failed)
+        self.assertEqual([uuids.instance2], compute_api.deleted)
+        self.assertEqual(1, self.mock_get_by_filters.call_count)
+
+    def test_enqueue(self):
+        compute_api = FakeComputeAPI()
+        r = self._get_reaper(compute_api)
+
+        self.assertTrue(r.enqueue("context", [uuids.instance1]))
+        self.assertTrue(r.enqueue("context", [uuids.instance2]))
+        r.wait()
+
+        self.assertEqual([uuids.instance1, uuids.instance2],
+                         compute_api.deleted)
+        stats = r.stats()
+        self.assertEqual(0, stats["queue_depth"])
+        self.assertEqual(2, stats["completed"])
+        self.assertEqual(0, stats["failed"])
+        self.assertEqual(2, len(r.latencies))
+
+    def test_metrics(self):
+        compute_api = FakeComputeAPI({uuids.instance2: 5})
+        registry = metrics.MetricsRegistry(mock.Mock())
+        r = self._get_reaper(compute_api, max_retries=0, registry=registry)
+
+        r.enqueue("context", [uuids.instance1])
+        r.enqueue("context", [uuids.instance2])
+        r.wait()
+
+        self.assertEqual(0, registry.gauges["reaper_queue_depth", ()])
+        deleted = registry.histograms["reaper_latency",
+                                      (("outcome", "deleted"),)]
+        failed = registry.histograms["reaper_latency",
+                                     (("outcome", "failed"),)]
+        self.assertEqual(1, deleted.count)
+        self.assertEqual(1, failed.count)
+        self.assertTrue(registry.sink.flush.called)
+
+    def test_retry(self):
+        compute_api = FakeComputeAPI({uuids.instance1: 2})
+        r = self._get_reaper(compute_api, max_retries=3)
+
+        r.enqueue("context", [uuids.instance1, uuids.instance2])
+        r.wait()
+
+        self.assertEqual([uuids.instance2, uuids.instance1],
+                         compute_api.deleted)
+        stats = r.stats()
+        self.assertEqual(1, stats["completed"])
+        self.assertEqual(2, stats["retried"])
+        self.assertEqual(0, stats["failed"])
+
+    def test_retry_exhausted(self):
+        compute_api = FakeComputeAPI({uuids.instance1: 5})
+        r = self._get_reaper(compute_api, max_retries=1)
+
+        r.enqueue("context", [uuids.instance1])
+        r.wait()
+
+        self.assertEqual([], compute_api.deleted)
+        stats = r.stats()
+        self.assertEqual(1, stats["completed"])
+        self.assertEqual(1, stats["retried"])
+        self.assertEqual(1, stats["failed"])
+
+    def test_enqueue_full(self):
+        compute_api = FakeComputeAPI()
+        r = self._get_reaper(compute_api, queue_size=1, enqueue_timeout=0)
+        # Do not let the worker consume the queue
+        r._worker = mock.Mock()
+
+        self.assertTrue(r.enqueue("context", [uuids.instance1]))
+        self.assertEqual(1, r.queue_depth)
+        self.assertFalse(r.enqueue("context", [uuids.instance2]))
+        self.assertEqual([uuids.instance2], compute_api.deleted)
+        self.assertEqual(1, r.queue_depth)
+
+    def test_wait_for_deletion(self):
+        self.mock_get_by_filters.side_effect = [
+            [fake_instance.fake_instance_obj("context",
+                                             uuid=uuids.instance1)],
+            [],
+        ]
+        pending = reaper.wait_for_deletion(
+            "context", [uuids.instance1, uuids.instance2], 10, interval=0.01)
+        self.assertEqual(set(), pending)
+        self.assertEqual(2, self.mock_get_by_filters.call_count)
+        # Only the instances still there are polled again
+        self.mock_get_by_filters.assert_called_with(
+            "context", {"uuid": [uuids.instance1], "deleted": False})
+
+    def test_wait_for_deletion_timeout(self):
+        pending = reaper.wait_for_deletion(
+            "context", [uuids.instance1, uuids.instance2], 0)
+        self.assertEqual(set([uuids.instance1, uuids.instance2]), pending)
+        self.assertEqual(1, self.mock_get_by_filters.call_count)
@@ -0,0 +1,69 @@
+# Copyright 2016 Spanish National Research Council - CSIC
+# Copyright 2016 INDIGO-DataCloud
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import random
+
+from opie.scheduler import sampling
+
+from nova import test as nova_test
+
+
+class HostSamplerTestCase(nova_test.NoDBTestCase):
+    def setUp(self):
+        super(HostSamplerTestCase, self).setUp()
+        self.hosts = list(range(100))
+        self.rand = random.Random(0)
+
+    @staticmethod
+    def _favoured(host):
+        # A fifth of the hosts
+        return host % 5 == 0
+
+    def test_sample(self):
+        sampler = sampling.HostSampler(self.hosts, rand=self.rand)
+        self.assertEqual(100, len(sampler))
+        sample = sampler.sample(10)
+        self.assertEqual(10, len(sample))
+        self.assertEqual(10, len(set(sample)))
+        self.assertTrue(set(sample).issubset(self.hosts))
+
+    def test_sample_all(self):
+        sampler = sampling.HostSampler(self.hosts, self._favoured, 4.0,
+                                       rand=self.rand)
+        self.assertEqual(self.hosts, sampler.sample(100))
+        self.assertEqual(self.hosts, sampler.sample(1000))
+
+    def test_sample_bias(self):
+        sampler = sampling.HostSampler(self.hosts, self._favoured, 4.0,
+                                       rand=self.rand)
+        sample = sampler.sample(20)
+        self.assertEqual(20, len(set(sample)))
+        # 20 favoured hosts weigh as many as the other 80
+        self.assertEqual(10, len([h for h in sample if self._favoured(h)]))
+
+    def test_sample_no_bias(self):
+        sampler = sampling.HostSampler(self.hosts, self._favoured, 1.0,
+                                       rand=self.rand)
+        sample = sampler.sample(50)
+        self.assertEqual(50, len(set(sample)))
+
+    def test_sample_few_favoured(self):
+        hosts = [0, 5, 1, 2, 3, 4, 6, 7, 8, 9, 11, 12]
+        sampler = sampling.HostSampler(hosts, self._favoured, 10.0,
+                                       rand=self.rand)
+        sample = sampler.sample(8)
+        self.assertEqual(8, len(set(sample)))
+        self.assertIn(0, sample)
+        self.assertIn(5, sample)
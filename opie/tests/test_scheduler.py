@@ -13,12 +13,16 @@
 # under the License.
 
 from opie.scheduler import filter_scheduler
+from opie.scheduler import host_manager
+from opie.scheduler import metrics
+from opie.scheduler.weights import victims
 
 import mock
 from nova.compute import task_states
 from nova.compute import vm_states
 from nova import exception
 import nova.objects
+from nova.scheduler import filters
 from nova.scheduler import weights
 from nova.tests.unit import fake_instance
 from nova.tests.unit.scheduler import fakes
@@ -144,22 +148,60 @@ class OpieFilterSchedulerTestCase(test_scheduler.SchedulerTestCase):
                                    "ram_allocation_ratio": 1.5})
         self.assertFalse(self.driver.detect_overcommit(obj))
 
-    def test_terminate_preemptible_instances(self):
+    @mock.patch('nova.objects.InstanceList.get_by_filters')
+    def test_terminate_preemptible_instances(self, mock_get_by_filters):
         ctxt = mock.Mock()
         ctxt.elevated.return_value = "elevated"
-        instances = [{"uuid": 1}, {"uuid": 2}]
-        calls_get = [mock.call("elevated", i["uuid"], want_objects=True)
-                     for i in instances]
+        instances = [fake_instance.fake_instance_obj("fake context",
+                                                     uuid=uuid)
+                     for uuid in (uuids.preemptible1, uuids.preemptible2)]
+        mock_get_by_filters.return_value = instances
         calls_delete = [mock.call("elevated", i) for i in instances]
 
         with mock.patch.object(self.driver.compute_api,
-                               "get") as mock_get:
-            with mock.patch.object(self.driver.compute_api,
-                                   "delete") as mock_delete:
-                mock_get.side_effect = instances
-                self.driver.terminate_preemptible_instances(ctxt, instances)
-                self.assertEqual(calls_get, mock_get.call_args_list)
-                self.assertEqual(calls_delete, mock_delete.call_args_list)
+                               "delete") as mock_delete:
+            self.driver.terminate_preemptible_instances(ctxt, instances)
+            mock_get_by_filters.assert_called_once_with(
+                "elevated",
+                {"uuid": [uuids.preemptible1, uuids.preemptible2],
+                 "deleted": False},
+                expected_attrs=mock.ANY)
+            self.assertEqual(calls_delete, mock_delete.call_args_list)
+
+    @mock.patch('nova.objects.InstanceList.get_by_filters')
+    def test_terminate_preemptible_instances_error(self,
+                                                   mock_get_by_filters):
+        ctxt = mock.Mock()
+        ctxt.elevated.return_value = "elevated"
+        instances = [fake_instance.fake_instance_obj("fake context",
+                                                     uuid=uuid)
+                     for uuid in (uuids.preemptible1, uuids.preemptible2,
+                                  uuids.preemptible3)]
+        # The last instance has already gone away
+        mock_get_by_filters.return_value = instances[:2]
+
+        with mock.patch.object(self.driver.compute_api,
+                               "delete") as mock_delete:
+            mock_delete.side_effect = [exception.InstanceNotFound(
+                instance_id=uuids.preemptible1), None]
+            self.driver.terminate_preemptible_instances(ctxt, instances)
+            self.assertEqual(2, mock_delete.call_count)
+
+    @mock.patch('opie.scheduler.reaper.terminate_instances')
+    def test_terminate_preemptible_instances_async(self, mock_terminate):
+        self.flags(async_termination=True,
+                   group="preemptible_instances_scheduler")
+        ctxt = mock.Mock()
+        ctxt.elevated.return_value = "elevated"
+        instances = [{"uuid": uuids.preemptible1},
+                     {"uuid": uuids.preemptible2}]
+
+        with mock.patch.object(self.driver.reaper,
+                               "enqueue") as mock_enqueue:
+            self.driver.terminate_preemptible_instances(ctxt, instances)
+            mock_enqueue.assert_called_once_with(
+                "elevated", [uuids.preemptible1, uuids.preemptible2])
+        self.assertFalse(mock_terminate.called)
 
     @mock.patch('nova.objects.ServiceList.get_by_binary',
                 return_value=fakes.SERVICES)
@@ -400,13 +442,14 @@ class OpieFilterSchedulerTestCase(test_scheduler.SchedulerTestCase):
     @mock.patch('opie.scheduler.filter_scheduler.FilterScheduler._schedule')
     def test_select_destinations_kill_preemptible(self, mock_schedule,
                                                   mock_terminate):
-        host = fakes.FakeHostState("host", "node",
-                                   {"free_ram_mb": -1000,
-                                    "total_usable_ram_mb": 1000,
-                                    "ram_allocation_ratio": 1.5})
+        self.flags(preemption_reservation_ttl=300,
+                   group="preemptible_instances_scheduler")
+        host = self._get_host_state({"free_ram_mb": -1000,
+                                     "total_usable_ram_mb": 1000,
+                                     "ram_allocation_ratio": 1.5})
         instances = {
             'uuid-preemptible': fake_instance.fake_instance_obj(
-                "fake context", root_gb=1, ephemeral_gb=1, memory_mb=3,
+                "fake context", root_gb=1, ephemeral_gb=1, memory_mb=1024,
                 vcpus=4, project_id='12345', vm_state=vm_states.ACTIVE,
                 task_state=task_states.RESIZE_PREP, os_type='Linux',
                 uuid='uuid-preemptible'),
@@ -414,7 +457,7 @@ class OpieFilterSchedulerTestCase(test_scheduler.SchedulerTestCase):
                 "fake context", root_gb=1, ephemeral_gb=1, memory_mb=3,
                 vcpus=4, project_id='12345', vm_state=vm_states.ACTIVE,
                 task_state=task_states.RESIZE_PREP, os_type='Linux',
-                uuid='uuid-preemptible')
+                uuid='uuid-normal')
         }
         instances['uuid-normal'].system_metadata = {"preemptible": False}
         instances['uuid-preemptible'].system_metadata = {"preemptible": True}
@@ -439,3 +482,454 @@ class OpieFilterSchedulerTestCase(test_scheduler.SchedulerTestCase):
         dests = self.driver.select_destinations(self.context, spec_obj)
         self.assertEqual(host.host, dests[0]["host"])
         self.assertEqual(host.nodename, dests[0]["nodename"])
+        self.assertEqual({}, host.preemptible_instances)
+        self.assertEqual(0, host.num_preemptible_instances)
+        self.assertEqual(0, host.preemptible_ram_mb)
+        ledger = self.driver.host_manager.preemption_ledger
+        reservations = ledger.get_reservations(("host", "node"))
+        self.assertEqual(1, len(reservations))
+        self.assertEqual(set(['uuid-preemptible']), reservations[0].victims)
+        self.assertEqual((512, 512 * 1024, 1), reservations[0].resources)
+        self.assertEqual(set([uuids.instance]), reservations[0].instances)
+        self.assertEqual(1, reservations[0].placements)
+
+    @mock.patch('opie.scheduler.filter_scheduler.FilterScheduler.'
+                'terminate_preemptible_instances', return_value=[])
+    @mock.patch('opie.scheduler.filter_scheduler.FilterScheduler._schedule')
+    def test_select_destinations_kill_preemptible_multiple(self,
+                                                           mock_schedule,
+                                                           mock_terminate):
+        self.flags(preemption_reservation_ttl=300,
+                   group="preemptible_instances_scheduler")
+        host = self._get_host_with_preemptibles([1024, 1024])
+        # Both instances of the request are placed on the same host
+        mock_schedule.return_value = [weights.WeighedHost(host, 1),
+                                      weights.WeighedHost(host, 1)]
+        spec_obj = nova.objects.RequestSpec(
+            flavor=nova.objects.Flavor(memory_mb=512,
+                                       root_gb=1,
+                                       ephemeral_gb=0,
+                                       vcpus=1),
+            project_id=1,
+            os_type='Linux',
+            instance_uuid=uuids.instance,
+            num_instances=2,
+            pci_requests=None,
+            numa_topology=None,
+            instance_group=None,
+            scheduler_hints={"preemptible": [False]})
+        self.driver.select_destinations(self.context, spec_obj)
+
+        ledger = self.driver.host_manager.preemption_ledger
+        reservations = ledger.get_reservations(("host", "node"))
+        self.assertEqual(1, len(reservations))
+        self.assertEqual((1024, 2 * 1024, 2), reservations[0].resources)
+        self.assertEqual(2, reservations[0].placements)
+        self.assertEqual(set([uuids.instance]), reservations[0].instances)
+        self.assertEqual(set(['uuid-preemptible-0', 'uuid-preemptible-1']),
+                         reservations[0].baseline)
+
+    @mock.patch('opie.scheduler.reaper.wait_for_deletion')
+    @mock.patch('opie.scheduler.filter_scheduler.FilterScheduler.'
+                'terminate_preemptible_instances', return_value=[])
+    @mock.patch('opie.scheduler.filter_scheduler.FilterScheduler._schedule')
+    def test_select_destinations_two_phase(self, mock_schedule,
+                                           mock_terminate, mock_wait):
+        self.flags(two_phase_preemption=True,
+                   preemption_drain_timeout=20,
+                   group="preemptible_instances_scheduler")
+        observed = []
+        sink = mock.Mock()
+        sink.observe.side_effect = lambda name, value, tags: observed.append(
+            (name, value, tags))
+        registry = metrics.MetricsRegistry(sink)
+        self.driver.metrics = registry
+        host = self._get_host_with_preemptibles([1024])
+        mock_schedule.return_value = [weights.WeighedHost(host, 1)]
+        mock_wait.return_value = set()
+
+        spec_obj = nova.objects.RequestSpec(
+            flavor=nova.objects.Flavor(memory_mb=512,
+                                       root_gb=512,
+                                       ephemeral_gb=0,
+                                       vcpus=1),
+            project_id=1,
+            os_type='Linux',
+            instance_uuid=uuids.instance,
+            num_instances=1,
+            pci_requests=None,
+            numa_topology=None,
+            instance_group=None,
+            scheduler_hints={"preemptible": [False]})
+        dests = self.driver.select_destinations(self.context, spec_obj)
+
+        self.assertEqual(host.host, dests[0]["host"])
+        mock_wait.assert_called_once_with(
+            mock.ANY, set(['uuid-preemptible-0']), 20, 1.0)
+        self.assertIn(("victim_drain", mock.ANY,
+                       (("outcome", "drained"), ("request", "normal"))),
+                      observed)
+        sink.increment.assert_called_once_with(
+            "retries_avoided", 1, (("request", "normal"),))
+        self.assertEqual(
+            1, registry.counters["retries_avoided", (("request", "normal"),)])
+
+    @mock.patch('opie.scheduler.ledger.timeutils.now', return_value=1000)
+    @mock.patch('opie.scheduler.reaper.wait_for_deletion',
+                return_value=set())
+    @mock.patch('opie.scheduler.filter_scheduler.FilterScheduler.'
+                'terminate_preemptible_instances', return_value=[])
+    @mock.patch('opie.scheduler.filter_scheduler.FilterScheduler._schedule')
+    def test_select_destinations_two_phase_reserves(self, mock_schedule,
+                                                    mock_terminate,
+                                                    mock_wait, mock_now):
+        # The reservations are not enabled (the default TTL), but the
+        # capacity is reserved while the victims drain anyway
+        self.flags(two_phase_preemption=True,
+                   preemption_drain_timeout=20,
+                   group="preemptible_instances_scheduler")
+        host = self._get_host_with_preemptibles([1024])
+        mock_schedule.return_value = [weights.WeighedHost(host, 1)]
+
+        spec_obj = nova.objects.RequestSpec(
+            flavor=nova.objects.Flavor(memory_mb=512,
+                                       root_gb=512,
+                                       ephemeral_gb=0,
+                                       vcpus=1),
+            project_id=1,
+            os_type='Linux',
+            instance_uuid=uuids.instance,
+            num_instances=1,
+            pci_requests=None,
+            numa_topology=None,
+            instance_group=None,
+            scheduler_hints={"preemptible": [False]})
+        self.driver.select_destinations(self.context, spec_obj)
+
+        ledger = self.driver.host_manager.preemption_ledger
+        self.assertEqual(0, ledger.ttl)
+        reservations = ledger.get_reservations((host.host, host.nodename))
+        self.assertEqual(1, len(reservations))
+        self.assertEqual(frozenset(['uuid-preemptible-0']),
+                         reservations[0].victims)
+        self.assertEqual((512, 512 * 1024, 1), reservations[0].resources)
+        self.assertEqual(1020, reservations[0].expires)
+
+    @staticmethod
+    def _get_host_state(values):
+        host = host_manager.HostState("host", "node")
+        for key, value in values.items():
+            setattr(host, key, value)
+        return host
+
+    def _get_host_with_preemptibles(self, sizes, host_values=None):
+        values = {"free_ram_mb": -1000,
+                  "total_usable_ram_mb": 1000,
+                  "ram_allocation_ratio": 1.5}
+        values.update(host_values or {})
+        host = self._get_host_state(values)
+        instances = {}
+        for idx, memory_mb in enumerate(sizes):
+            uuid = 'uuid-preemptible-%d' % idx
+            instances[uuid] = fake_instance.fake_instance_obj(
+                "fake context", root_gb=0, ephemeral_gb=0,
+                memory_mb=memory_mb, vcpus=1, project_id='12345',
+                vm_state=vm_states.ACTIVE, os_type='Linux', uuid=uuid)
+            instances[uuid].system_metadata = {"preemptible": True}
+        host.instances = instances
+        return host
+
+    def test_select_preemptibles_from_host_smallest(self):
+        # We need to free 500MB, so the 512MB instance is enough
+        host = self._get_host_with_preemptibles([4096, 512, 2048])
+        victims = self.driver.select_preemptibles_from_host(host, None)
+        self.assertEqual(['uuid-preemptible-1'], [i.uuid for i in victims])
+
+    def test_select_preemptibles_from_host_several(self):
+        # We need to free 1500MB, so one instance is not enough
+        host = self._get_host_with_preemptibles(
+            [256, 1024, 512, 128], {"free_ram_mb": -2000})
+        victims = self.driver.select_preemptibles_from_host(host, None)
+        self.assertEqual(['uuid-preemptible-1', 'uuid-preemptible-2'],
+                         sorted(i.uuid for i in victims))
+
+    def test_select_preemptibles_from_host_not_enough(self):
+        host = self._get_host_with_preemptibles([128, 128])
+        self.assertRaises(exception.NoValidHost,
+                          self.driver.select_preemptibles_from_host,
+                          host, None)
+
+    def test_select_preemptibles_from_host_fake_host_state(self):
+        # Host states without the preemptible totals are also supported
+        host = self._get_host_with_preemptibles([4096, 512, 2048])
+        fake_host = fakes.FakeHostState("host", "node",
+                                        {"free_ram_mb": -1000,
+                                         "total_usable_ram_mb": 1000,
+                                         "ram_allocation_ratio": 1.5})
+        fake_host.instances = host.instances
+        victims = self.driver.select_preemptibles_from_host(fake_host, None)
+        self.assertEqual(['uuid-preemptible-1'], [i.uuid for i in victims])
+
+    def test_select_preemptibles_from_host_ranked(self):
+        # All of the instances free enough memory, so the best ranked one
+        # (i.e. the one of the project with more instances) is selected
+        host = self._get_host_with_preemptibles([512, 512, 512])
+        host.instances['uuid-preemptible-0'].project_id = 'other'
+        victims = self.driver.select_preemptibles_from_host(host, None)
+        self.assertEqual(1, len(victims))
+        self.assertNotEqual('uuid-preemptible-0', victims[0].uuid)
+
+    def test_get_weighed_preemptibles(self):
+        self.flags(weight_classes=['opie.scheduler.weights.victims.'
+                                   'VictimSizeWeigher'],
+                   group='preemptible_instances_scheduler')
+        driver = self.driver_cls()
+        host = self._get_host_with_preemptibles([1024, 256, 512])
+        weighed = driver.get_weighed_preemptibles(
+            host, victims.get_victim_features(host), None)
+        self.assertEqual(['uuid-preemptible-1', 'uuid-preemptible-2',
+                          'uuid-preemptible-0'],
+                         [w.obj.uuid for w in weighed])
+
+    @mock.patch('opie.scheduler.filter_scheduler.FilterScheduler._schedule')
+    def test_select_destinations_metrics(self, mock_schedule):
+        observed = []
+        sink = mock.Mock()
+        sink.observe.side_effect = lambda name, value, tags: observed.append(
+            (name, tags))
+        self.driver.metrics = metrics.MetricsRegistry(sink)
+
+        host = self._get_host_state({"free_ram_mb": 1000,
+                                     "total_usable_ram_mb": 1000})
+        mock_schedule.return_value = [weights.WeighedHost(host, 1)]
+        spec_obj = nova.objects.RequestSpec(
+            flavor=nova.objects.Flavor(memory_mb=512,
+                                       root_gb=512,
+                                       ephemeral_gb=0,
+                                       vcpus=1),
+            project_id=1,
+            os_type='Linux',
+            instance_uuid=uuids.instance,
+            num_instances=1,
+            pci_requests=None,
+            numa_topology=None,
+            instance_group=None,
+            scheduler_hints={"preemptible": [False]})
+        self.driver.select_destinations(self.context, spec_obj)
+
+        self.assertEqual(
+            [("overcommit", (("request", "normal"),)),
+             ("select_destinations", (("outcome", "success"),
+                                      ("request", "normal"),
+                                      ("victims", "0")))],
+            observed)
+        self.assertTrue(sink.flush.called)
+
+    @mock.patch('opie.scheduler.filter_scheduler.FilterScheduler._schedule',
+                return_value=[])
+    def test_select_destinations_metrics_no_valid_host(self, mock_schedule):
+        observed = []
+        sink = mock.Mock()
+        sink.observe.side_effect = lambda name, value, tags: observed.append(
+            (name, tags))
+        self.driver.metrics = metrics.MetricsRegistry(sink)
+        spec_obj = nova.objects.RequestSpec(
+            flavor=nova.objects.Flavor(memory_mb=512,
+                                       root_gb=512,
+                                       ephemeral_gb=0,
+                                       vcpus=1),
+            project_id=1,
+            os_type='Linux',
+            instance_uuid=uuids.instance,
+            num_instances=1,
+            pci_requests=None,
+            numa_topology=None,
+            instance_group=None,
+            scheduler_hints={"preemptible": [False]})
+
+        self.assertRaises(exception.NoValidHost,
+                          self.driver.select_destinations,
+                          self.context, spec_obj)
+
+        self.assertEqual(
+            [("select_destinations", (("outcome", "no_valid_host"),
+                                      ("request", "normal"),
+                                      ("victims", "0")))],
+            observed)
+        self.assertTrue(sink.flush.called)
+
+    @mock.patch('nova.scheduler.weights.HostWeightHandler.get_weighed_objects')
+    @mock.patch('opie.scheduler.host_manager.HostManager.get_filtered_hosts',
+                side_effect=nova_test_filter_scheduler.fake_get_filtered_hosts)
+    @mock.patch('opie.scheduler.host_manager.HostManager.'
+                'get_host_state_snapshot')
+    def test_schedule_single_host_list(self, mock_snapshot,
+                                       mock_get_filtered_hosts,
+                                       mock_get_weighed_objects):
+        self.flags(single_host_list=True,
+                   group="preemptible_instances_scheduler")
+        host = mock.Mock(host="host1", nodename="node1")
+        mock_snapshot.return_value = ([host], None)
+        mock_get_weighed_objects.side_effect = (
+            lambda functions, hosts, options: [weights.WeighedHost(hosts[0],
+                                                                   1.0)])
+        spec_obj = nova.objects.RequestSpec(
+            flavor=nova.objects.Flavor(memory_mb=512,
+                                       root_gb=512,
+                                       ephemeral_gb=0,
+                                       vcpus=1),
+            project_id=1,
+            num_instances=2,
+            instance_group=None,
+            scheduler_hints={"preemptible": [False]})
+
+        weighed_hosts = self.driver._schedule(self.context, spec_obj)
+
+        mock_snapshot.assert_called_once_with(mock.ANY, partial=False)
+        self.assertEqual([host, host], [w.obj for w in weighed_hosts])
+        self.assertEqual([mock.call(spec_obj), mock.call(spec_obj)],
+                         host.consume_from_request.call_args_list)
+
+    @mock.patch('nova.scheduler.weights.HostWeightHandler.get_weighed_objects')
+    @mock.patch('opie.scheduler.host_manager.HostManager.get_filtered_hosts')
+    @mock.patch('opie.scheduler.host_manager.HostManager.'
+                'get_host_state_snapshot')
+    def test_schedule_sampling(self, mock_snapshot, mock_get_filtered_hosts,
+                               mock_get_weighed_objects):
+        self.flags(sampling_size=1, group="preemptible_instances_scheduler")
+        full = [mock.Mock(host="host%d" % i, nodename="node%d" % i,
+                          num_preemptible_instances=i)
+                for i in range(3)]
+        partial = [mock.Mock(host="host%d" % i, nodename="node%d" % i)
+                   for i in range(3)]
+        mock_snapshot.return_value = (full, partial)
+        # The first sample does not pass the filters, the second one does
+        mock_get_filtered_hosts.side_effect = (
+            lambda hosts, spec_obj, index: hosts[1:])
+        mock_get_weighed_objects.side_effect = (
+            lambda functions, hosts, options: [weights.WeighedHost(hosts[0],
+                                                                   1.0)])
+        spec_obj = nova.objects.RequestSpec(
+            flavor=nova.objects.Flavor(memory_mb=512,
+                                       root_gb=512,
+                                       ephemeral_gb=0,
+                                       vcpus=1),
+            project_id=1,
+            num_instances=2,
+            instance_group=None,
+            scheduler_hints={"preemptible": [False]})
+
+        weighed_hosts = self.driver._schedule(self.context, spec_obj)
+
+        self.assertEqual(2, len(weighed_hosts))
+        self.assertEqual([1, 2, 1, 2],
+                         [len(c[0][0]) for c in
+                          mock_get_filtered_hosts.call_args_list])
+        # Every instance is sampled from all the hosts
+        for c in mock_get_filtered_hosts.call_args_list:
+            self.assertTrue(set(c[0][0]).issubset(partial))
+
+    @mock.patch('opie.scheduler.sampling.random.sample',
+                side_effect=lambda population, k: population[::-1][:k])
+    @mock.patch('nova.scheduler.weights.HostWeightHandler.get_weighed_objects')
+    @mock.patch('opie.scheduler.host_manager.HostManager.get_filtered_hosts')
+    @mock.patch('opie.scheduler.host_manager.HostManager.'
+                'get_host_state_snapshot')
+    def test_schedule_sampling_once_per_request_filter(
+            self, mock_snapshot, mock_get_filtered_hosts,
+            mock_get_weighed_objects, mock_sample):
+        class OnlyHost0Filter(filters.BaseHostFilter):
+            run_filter_once_per_request = True
+
+            def host_passes(self, host_state, spec_obj):
+                return host_state.host == "host0"
+
+        self.flags(sampling_size=1, group="preemptible_instances_scheduler")
+        hosts = [mock.Mock(host="host%d" % i, nodename="node%d" % i,
+                           num_preemptible_instances=0)
+                 for i in range(2)]
+        mock_snapshot.return_value = (hosts, None)
+        handler = filters.HostFilterHandler()
+        mock_get_filtered_hosts.side_effect = (
+            lambda hosts, spec_obj, index=0: handler.get_filtered_objects(
+                [OnlyHost0Filter()], hosts, spec_obj, index))
+        mock_get_weighed_objects.side_effect = (
+            lambda functions, hosts, options: [weights.WeighedHost(hosts[0],
+                                                                   1.0)])
+        spec_obj = nova.objects.RequestSpec(
+            flavor=nova.objects.Flavor(memory_mb=512,
+                                       root_gb=512,
+                                       ephemeral_gb=0,
+                                       vcpus=1),
+            project_id=1,
+            instance_uuid=uuids.instance,
+            num_instances=2,
+            instance_group=None,
+            scheduler_hints={"preemptible": [True]})
+
+        weighed_hosts = self.driver._schedule(self.context, spec_obj)
+
+        # The first sample of each instance (host1) is filtered out, even if
+        # the filter only runs once per request
+        self.assertEqual([hosts[0], hosts[0]],
+                         [w.obj for w in weighed_hosts])
+        self.assertEqual([[hosts[1]], hosts] * 2,
+                         [c[0][0] for c in
+                          mock_get_filtered_hosts.call_args_list])
+
+    def test_get_sampler(self):
+        self.flags(sampling_reclaimable_bias=3.0,
+                   group="preemptible_instances_scheduler")
+        full = [mock.Mock(host="host%d" % i, nodename="node%d" % i,
+                          num_preemptible_instances=i % 2)
+                for i in range(4)]
+        partial = [mock.Mock(host="host%d" % i, nodename="node%d" % i,
+                             num_preemptible_instances=0)
+                   for i in range(4)]
+        full_by_key = {(h.host, h.nodename): h for h in full}
+
+        sampler = self.driver._get_sampler(partial, False, full_by_key)
+        self.assertEqual(3.0, sampler.bias)
+        self.assertEqual([partial[1], partial[3]], sampler._favoured)
+
+        sampler = self.driver._get_sampler(full, True)
+        self.assertEqual([], sampler._favoured)
+        self.assertEqual(full, sampler._others)
+
+    @mock.patch('nova.scheduler.weights.HostWeightHandler.get_weighed_objects')
+    @mock.patch('opie.scheduler.host_manager.HostManager.get_filtered_hosts')
+    @mock.patch('opie.scheduler.host_manager.HostManager.'
+                'get_host_state_snapshot')
+    def test_schedule_partial_index(self, mock_snapshot,
+                                    mock_get_filtered_hosts,
+                                    mock_get_weighed_objects):
+        full = [mock.Mock(host="host%d" % i, nodename="node%d" % i)
+                for i in range(3)]
+        partial = [mock.Mock(host="host%d" % i, nodename="node%d" % i)
+                   for i in range(3)]
+        mock_snapshot.return_value = (full, partial)
+        # Only the last two hosts pass the filters, then only the last one
+        mock_get_filtered_hosts.side_effect = [partial[1:], partial[2:]]
+        mock_get_weighed_objects.side_effect = (
+            lambda functions, hosts, options: [weights.WeighedHost(hosts[-1],
+                                                                   1.0)])
+        spec_obj = nova.objects.RequestSpec(
+            flavor=nova.objects.Flavor(memory_mb=512,
+                                       root_gb=512,
+                                       ephemeral_gb=0,
+                                       vcpus=1),
+            project_id=1,
+            num_instances=2,
+            instance_group=None,
+            scheduler_hints={"preemptible": [False]})
+
+        weighed_hosts = self.driver._schedule(self.context, spec_obj)
+
+        mock_snapshot.assert_called_once_with(mock.ANY, partial=True)
+        self.assertEqual([full[1:], full[2:]],
+                         [c[0][1] for c in
+                          mock_get_weighed_objects.call_args_list])
+        self.assertEqual([full[2], full[2]], [w.obj for w in weighed_hosts])
+        self.assertEqual(2, full[2].consume_from_request.call_count)
+        self.assertEqual(2, partial[2].consume_from_request.call_count)
+        self.assertFalse(partial[1].consume_from_request.called)
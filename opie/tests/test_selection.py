@@ -0,0 +1,77 @@
+# Copyright 2016 Spanish National Research Council - CSIC
+# Copyright 2016 INDIGO-DataCloud
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import random
+
+from opie.scheduler import selection
+from opie.scheduler.weights import preemptible
+
+from nova.scheduler import weights
+from nova.scheduler.weights import ram
+from nova import test as nova_test
+from nova.tests.unit import fake_instance
+from nova.tests.unit.scheduler import fakes
+
+
+class TopHostsSelectorTestCase(nova_test.NoDBTestCase):
+    def _get_weighers(self):
+        return [ram.RAMWeigher(), preemptible.PreemptibleCountWeigher()]
+
+    def _get_all_hosts(self):
+        rand = random.Random(0)
+        host_states = []
+        for idx in range(30):
+            host = fakes.FakeHostState(
+                'host%d' % idx, 'node%d' % idx,
+                # Use few values, so that there are ties
+                {"free_ram_mb": rand.choice([512, 1024, 2048])})
+            instances = {}
+            for i in range(rand.randint(0, 3)):
+                uuid = 'uuid-%d-%d' % (idx, i)
+                instances[uuid] = fake_instance.fake_instance_obj(
+                    "fake context", uuid=uuid)
+                instances[uuid].system_metadata = {"preemptible": True}
+            host.instances = instances
+            host_states.append(host)
+        return host_states
+
+    def _assert_same(self, expected, weighed_hosts):
+        self.assertEqual([(h.obj.host, h.weight) for h in expected],
+                         [(h.obj.host, h.weight) for h in weighed_hosts])
+
+    def test_same_as_sorting(self):
+        hosts = self._get_all_hosts()
+        handler = weights.HostWeightHandler()
+        nova_weighers = self._get_weighers()
+        selector = selection.TopHostsSelector(self._get_weighers())
+
+        for _ in range(10):
+            expected = handler.get_weighed_objects(nova_weighers, hosts, {})
+            weighed_hosts = selector.get_top_weighed_hosts(hosts, {}, 5)
+            self._assert_same(expected[:5], weighed_hosts)
+
+            # Consume from the chosen host, and drop one of the others as if
+            # it had been filtered out.
+            chosen = weighed_hosts[0].obj
+            chosen.free_ram_mb -= 512
+            selector.invalidate(chosen)
+            hosts = [h for h in hosts if h is not weighed_hosts[-1].obj]
+
+    def test_one_host(self):
+        hosts = self._get_all_hosts()[:1]
+        selector = selection.TopHostsSelector(self._get_weighers())
+        weighed_hosts = selector.get_top_weighed_hosts(hosts, {}, 5)
+        self.assertEqual(1, len(weighed_hosts))
+        self.assertEqual(0.0, weighed_hosts[0].weight)
@@ -0,0 +1,132 @@
+# Copyright 2016 Spanish National Research Council - CSIC
+# Copyright 2016 INDIGO-DataCloud
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+
+from opie.scheduler import weights
+from opie.scheduler.weights import victims
+
+import mock
+from nova import test as nova_test
+from nova.tests.unit import fake_instance
+from nova.tests.unit.scheduler import fakes
+from oslo_utils import timeutils
+
+
+class VictimWeighersTestCase(nova_test.NoDBTestCase):
+    def setUp(self):
+        super(VictimWeighersTestCase, self).setUp()
+        self.weight_handler = weights.VictimWeightHandler()
+        self.now = datetime.datetime(2016, 1, 1, 12, 0, 0)
+        self.host = fakes.FakeHostState('host1', 'node1',
+                                        {"total_usable_ram_mb": 4096,
+                                         "total_usable_disk_gb": 0,
+                                         "vcpus_total": 4})
+
+    def _add_preemptible(self, uuid, memory_mb=512, vcpus=1, minutes=0,
+                         project_id='project'):
+        instance = fake_instance.fake_instance_obj(
+            "fake context", uuid=uuid, memory_mb=memory_mb, vcpus=vcpus,
+            root_gb=0, ephemeral_gb=0, project_id=project_id,
+            created_at=self.now - datetime.timedelta(minutes=minutes))
+        instance.system_metadata = {"preemptible": True}
+        instances = dict(self.host.instances)
+        instances[uuid] = instance
+        self.host.instances = instances
+
+    @mock.patch.object(timeutils, 'utcnow')
+    def _get_weighed_victims(self, weighers, mock_utcnow):
+        mock_utcnow.return_value = self.now
+        features = victims.get_victim_features(self.host)
+        weight_properties = {"host_state": self.host, "spec_obj": None}
+        return self.weight_handler.get_weighed_objects(weighers, features,
+                                                       weight_properties)
+
+    def test_all_victim_weighers(self):
+        classes = weights.all_victim_weighers()
+        self.assertIn(victims.VictimSizeWeigher, classes)
+        self.assertIn(victims.VictimBillingPeriodWeigher, classes)
+        self.assertIn(victims.VictimProjectWeigher, classes)
+
+    def test_victim_features(self):
+        self._add_preemptible('uuid-1', memory_mb=1024, vcpus=2,
+                              project_id='p1')
+        self._add_preemptible('uuid-2', project_id='p1')
+        self._add_preemptible('uuid-3', project_id='p2')
+        features = {f.uuid: f for f in victims.get_victim_features(self.host)}
+        self.assertEqual((1024, 0, 2), features['uuid-1'].resources)
+        self.assertEqual(2, features['uuid-1'].project_instances)
+        self.assertEqual(2, features['uuid-2'].project_instances)
+        self.assertEqual(1, features['uuid-3'].project_instances)
+
+    def test_size_weigher(self):
+        self._add_preemptible('uuid-big', memory_mb=2048, vcpus=2)
+        self._add_preemptible('uuid-small', memory_mb=512, vcpus=1)
+        self._add_preemptible('uuid-medium', memory_mb=1024, vcpus=1)
+        weighed = self._get_weighed_victims([victims.VictimSizeWeigher()])
+        self.assertEqual(['uuid-small', 'uuid-medium', 'uuid-big'],
+                         [w.obj.uuid for w in weighed])
+
+    def test_billing_period_weigher(self):
+        # The instance that started a new period 5 minutes ago wins
+        self._add_preemptible('uuid-50', minutes=50)
+        self._add_preemptible('uuid-65', minutes=65)
+        self._add_preemptible('uuid-30', minutes=30)
+        weighed = self._get_weighed_victims(
+            [victims.VictimBillingPeriodWeigher()])
+        self.assertEqual(['uuid-65', 'uuid-30', 'uuid-50'],
+                         [w.obj.uuid for w in weighed])
+
+    def test_billing_period_weigher_custom_period(self):
+        self.flags(victim_billing_period=600,
+                   group="preemptible_instances_scheduler")
+        self._add_preemptible('uuid-9', minutes=9)
+        self._add_preemptible('uuid-11', minutes=11)
+        weighed = self._get_weighed_victims(
+            [victims.VictimBillingPeriodWeigher()])
+        self.assertEqual(['uuid-11', 'uuid-9'],
+                         [w.obj.uuid for w in weighed])
+
+    def test_project_weigher(self):
+        self._add_preemptible('uuid-p1', project_id='p1')
+        self._add_preemptible('uuid-p2-1', project_id='p2')
+        self._add_preemptible('uuid-p2-2', project_id='p2')
+        weighed = self._get_weighed_victims([victims.VictimProjectWeigher()])
+        self.assertEqual('uuid-p1', weighed[-1].obj.uuid)
+        self.assertEqual(1.0, weighed[0].weight)
+
+    def test_multiplier(self):
+        self.flags(victim_size_weight_multiplier=-1.0,
+                   group="preemptible_instances_scheduler")
+        self._add_preemptible('uuid-big', memory_mb=2048)
+        self._add_preemptible('uuid-small', memory_mb=512)
+        weighed = self._get_weighed_victims([victims.VictimSizeWeigher()])
+        self.assertEqual('uuid-big', weighed[0].obj.uuid)
+
+    def test_weights_not_kept_between_hosts(self):
+        weigher = victims.VictimSizeWeigher()
+        self._add_preemptible('uuid-big', memory_mb=4096, vcpus=4)
+        self._add_preemptible('uuid-small', memory_mb=512)
+        self._get_weighed_victims([weigher])
+
+        self.host = fakes.FakeHostState('host2', 'node2',
+                                        {"total_usable_ram_mb": 4096,
+                                         "total_usable_disk_gb": 0,
+                                         "vcpus_total": 4})
+        self._add_preemptible('uuid-a', memory_mb=512)
+        self._add_preemptible('uuid-b', memory_mb=1024)
+        weighed = self._get_weighed_victims([weigher])
+        self.assertEqual(['uuid-a', 'uuid-b'], [w.obj.uuid for w in weighed])
+        self.assertEqual(0.0, weighed[-1].weight)
@@ -14,6 +14,7 @@
 # under the License.
 
 import datetime
+import random
 
 from opie.scheduler.weights import preemptible
 
@@ -253,3 +254,65 @@ class PreemptibleDurationWeigherTestCase(nova_test.NoDBTestCase):
 
         for host in weighed_hosts:
             self.assertEqual(0.0, host.weight)
+
+
+class PreemptibleBatchWeighingTestCase(nova_test.NoDBTestCase):
+    """Check that weighing all the hosts at once gives the same results."""
+
+    def setUp(self):
+        super(PreemptibleBatchWeighingTestCase, self).setUp()
+        self.now = datetime.datetime(2015, 11, 5, 11, 00)
+        timeutils.set_time_override(self.now)
+        self.addCleanup(timeutils.clear_time_override)
+
+    def _get_all_hosts(self):
+        rand = random.Random(0)
+        host_states = []
+        for idx in range(50):
+            host = fakes.FakeHostState('host%d' % idx, 'node%d' % idx, {})
+            instances = {}
+            for i in range(rand.randint(0, 10)):
+                uuid = 'uuid-%d-%d' % (idx, i)
+                instances[uuid] = fake_instance.fake_instance_obj(
+                    "fake context", uuid=uuid)
+                if rand.random() < 0.5:
+                    instances[uuid].system_metadata = {"preemptible": True}
+                else:
+                    instances[uuid].system_metadata = {}
+                instances[uuid].created_at = self.now - datetime.timedelta(
+                    seconds=rand.randint(0, 5 * 3600))
+            host.instances = instances
+            host_states.append(host)
+        return host_states
+
+    def _legacy_count(self, host_state):
+        return - len([i for i in host_state.instances.values()
+                      if i.system_metadata.get("preemptible")])
+
+    def _legacy_duration(self, host_state):
+        remainder = 0
+        for instance in host_state.instances.values():
+            if instance.system_metadata.get("preemptible"):
+                ct = instance.created_at.replace(tzinfo=None)
+                duration = (self.now - ct).total_seconds()
+                remainder += duration % 3600
+        return - remainder
+
+    def _check(self, weigher, legacy):
+        hosts = self._get_all_hosts()
+        objs = [weights.WeighedHost(h, 0.0) for h in hosts]
+        expected = [legacy(h) for h in hosts]
+
+        self.assertEqual(expected, weigher.weigh_objects(objs, {}))
+        self.assertEqual(min(expected), weigher.minval)
+        self.assertEqual(0, weigher.maxval)
+
+    def test_base_is_abstract(self):
+        self.assertRaises(TypeError, preemptible.BasePreemptibleWeigher)
+
+    def test_count(self):
+        self._check(preemptible.PreemptibleCountWeigher(), self._legacy_count)
+
+    def test_duration(self):
+        self._check(preemptible.PreemptibleDurationWeigher(),
+                    self._legacy_duration)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmark the memory used by the instances kept in the host states.
+
+It compares the host states keeping the Instance objects (as opie did before)
+against the host states keeping an InstanceSummary of each instance. The
+memory is measured with tracemalloc, so Python 3 is needed.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import gc
+import random
+import tracemalloc
+
+from oslo_utils import timeutils
+
+from nova import objects
+from nova.scheduler import host_manager as nova_host_manager
+
+from opie.scheduler import host_manager
+
+FLAVORS = [
+    # name, ram_mb, root_gb, vcpus
+    ("m1.tiny", 512, 1, 1),
+    ("m1.small", 2048, 20, 1),
+    ("m1.medium", 4096, 40, 2),
+    ("m1.large", 8192, 80, 4),
+]
+
+
+class LegacyHostState(nova_host_manager.HostState):
+    """HostState keeping the Instance objects, as opie did before."""
+
+    def __init__(self, *args, **kwargs):
+        self.normal_instances = {}
+        self.preemptible_instances = {}
+        self._instances = {}
+        super(LegacyHostState, self).__init__(*args, **kwargs)
+
+    @property
+    def instances(self):
+        return self._instances
+
+    @instances.setter
+    def instances(self, instances):
+        for instance in instances.values():
+            if instance.uuid in self._instances:
+                continue
+            if host_manager.is_preemptible_instance(instance):
+                self.preemptible_instances[instance.uuid] = instance
+            else:
+                self.normal_instances[instance.uuid] = instance
+        self._instances = instances
+
+
+def _instance(rand, host, idx, ratio, now):
+    type_id = rand.randrange(len(FLAVORS))
+    name, memory_mb, root_gb, vcpus = FLAVORS[type_id]
+    flavor = objects.Flavor(name=name, memory_mb=memory_mb, root_gb=root_gb,
+                            ephemeral_gb=0, vcpus=vcpus, swap=0,
+                            extra_specs={})
+    system_metadata = {"image_base_image_ref": "image-%d" % (idx % 10),
+                       "image_min_disk": str(root_gb),
+                       "image_min_ram": "0"}
+    if rand.random() < ratio:
+        system_metadata["preemptible"] = True
+    return objects.Instance(
+        uuid="%s-uuid-%d" % (host, idx),
+        display_name="instance-%d" % idx,
+        hostname="instance-%d" % idx,
+        project_id="project-%d" % rand.randint(0, 99),
+        user_id="user-%d" % rand.randint(0, 999),
+        host=host,
+        node=host,
+        image_ref="image-%d" % (idx % 10),
+        instance_type_id=type_id,
+        memory_mb=memory_mb,
+        root_gb=root_gb,
+        ephemeral_gb=0,
+        vcpus=vcpus,
+        vm_state="active",
+        power_state=1,
+        created_at=now - datetime.timedelta(
+            seconds=rand.randint(0, 48 * 3600)),
+        launched_at=now,
+        flavor=flavor,
+        system_metadata=system_metadata,
+        metadata={})
+
+
+def _build(host_state_cls, args):
+    rand = random.Random(args.seed)
+    now = timeutils.utcnow()
+    per_host = args.instances // args.hosts
+    hosts = []
+    for idx in range(args.hosts):
+        name = "host%d" % idx
+        host = host_state_cls(name, name)
+        host.instances = {i.uuid: i for i in
+                          (_instance(rand, name, n, args.preemptible_ratio,
+                                     now)
+                           for n in range(per_host))}
+        hosts.append(host)
+    return hosts
+
+
+def measure(host_state_cls, args):
+    """Return the memory (in bytes) retained by the host states."""
+    gc.collect()
+    tracemalloc.start()
+    hosts = _build(host_state_cls, args)
+    gc.collect()
+    used, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del hosts
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, default=1000)
+    parser.add_argument("--instances", type=int, default=50000,
+                        help="Total number of instances in the cluster.")
+    parser.add_argument("--preemptible-ratio", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    objects.register_all()
+
+    print("%d hosts, %d instances" % (args.hosts, args.instances))
+    print("%-20s %12s %16s" % ("host states", "total (MB)",
+                               "per instance (B)"))
+    results = []
+    for name, cls in (("instance objects", LegacyHostState),
+                      ("instance summaries", host_manager.HostState)):
+        used = measure(cls, args)
+        results.append(used)
+        print("%-20s %12.1f %16.0f" % (name, used / 1024.0 ** 2,
+                                       float(used) / args.instances))
+    print("saving: %.1f%%" % (100.0 * (results[0] - results[1]) / results[0]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmark concurrent refreshes of the host states.
+
+A number of green threads (as the concurrent select_destinations RPC calls
+do in the scheduler service) get the host states at the same time, from a
+fake database (see simulator.py) that yields for a given latency on each
+query. It compares refreshing the host states for each caller against
+coalescing the concurrent refreshes (the coalesce_refreshes option), and
+reports the number of refreshes and database calls and the latency of the
+callers.
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import eventlet
+from oslo_config import cfg
+
+from nova import context as nova_context
+
+from opie.scheduler import host_manager
+
+import simulator
+
+CONF = cfg.CONF
+
+
+def _slow(func, latency):
+    def _wrapper(*args, **kwargs):
+        eventlet.sleep(latency)
+        return func(*args, **kwargs)
+    return _wrapper
+
+
+def _caller(manager, context, iterations, partial, latencies):
+    for _ in range(iterations):
+        begin = time.time()
+        manager.get_host_state_snapshot(context, partial=partial)
+        latencies.append(time.time() - begin)
+
+
+def run(cloud, args):
+    context = nova_context.get_admin_context()
+    manager = host_manager.HostManager()
+    db_calls = sum(cloud.db_calls.values())
+    refreshes = cloud.db_calls["ComputeNodeList.get_all"]
+    latencies = []
+
+    start = time.time()
+    pool = eventlet.GreenPool(args.callers)
+    for idx in range(args.callers):
+        # Mix normal (partial) and preemptible (full only) requests
+        pool.spawn(_caller, manager, context, args.iterations,
+                   idx % 2 == 0, latencies)
+    pool.waitall()
+    elapsed = time.time() - start
+
+    return {
+        "refreshes": cloud.db_calls["ComputeNodeList.get_all"] - refreshes,
+        "db_calls": sum(cloud.db_calls.values()) - db_calls,
+        "elapsed": elapsed,
+        "p50": simulator.percentile(latencies, 50),
+        "p99": simulator.percentile(latencies, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, default=500)
+    parser.add_argument("--instances", type=int, default=20,
+                        help="Maximum number of instances per host.")
+    parser.add_argument("--callers", type=int, default=50,
+                        help="Concurrent green threads getting the host "
+                             "states.")
+    parser.add_argument("--iterations", type=int, default=5,
+                        help="Host state requests per green thread.")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds that each database query takes.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # The database queries yield to the other green threads, as in the
+    # scheduler service
+    eventlet.monkey_patch()
+
+    group = "preemptible_instances_scheduler"
+    simulator.setup_nova(overrides={(group, "bulk_instance_load"): True})
+    cloud = simulator.generate_cluster(args.hosts, args.instances, 0.5,
+                                       seed=args.seed)
+    for name in ("get_services_by_binary", "get_compute_nodes",
+                 "get_compute_node_by_host_and_nodename",
+                 "get_service_by_compute_host",
+                 "get_compute_nodes_changed_since", "get_compute_node_ids",
+                 "get_instance_summaries_by_host"):
+        setattr(cloud, name, _slow(getattr(cloud, name), args.latency))
+    cloud.start()
+
+    print("%d hosts, %d callers x %d requests, %.0f ms per query" %
+          (args.hosts, args.callers, args.iterations, args.latency * 1e3))
+    print("%-10s %10s %9s %10s %9s %9s" % ("mode", "refreshes", "db calls",
+                                           "total (s)", "p50 (ms)",
+                                           "p99 (ms)"))
+    try:
+        for name, coalesce in (("separate", False), ("coalesced", True)):
+            CONF.set_override("coalesce_refreshes", coalesce, group=group)
+            results = run(cloud, args)
+            print("%-10s %10d %9d %10.2f %9.1f %9.1f" % (
+                name, results["refreshes"], results["db_calls"],
+                results["elapsed"], results["p50"] * 1e3,
+                results["p99"] * 1e3))
+    finally:
+        cloud.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmark sampling the hosts against evaluating all of them.
+
+The same stream of requests is replayed through the simulator (see
+simulator.py) on the same synthetic cluster, evaluating all the hosts for
+each instance and then a random sample of them (the sampling_size option).
+Besides the latency of select_destinations it reports the placement quality:
+the failed requests, the preemptions per request and the imbalance of the
+cluster at the end (the standard deviation of the fraction of RAM used by
+each host, that the default RAM weigher tries to keep low).
+"""
+
+from __future__ import print_function
+
+import argparse
+import math
+
+from oslo_config import cfg
+
+import simulator
+
+CONF = cfg.CONF
+
+
+def ram_imbalance(cloud):
+    used = [float(node.memory_mb_used) / node.memory_mb
+            for node in cloud.nodes.values()]
+    mean = sum(used) / len(used)
+    return math.sqrt(sum((u - mean) ** 2 for u in used) / len(used))
+
+
+def run(sampling_size, args):
+    CONF.set_override("sampling_size", sampling_size,
+                      group="preemptible_instances_scheduler")
+    cloud = simulator.generate_cluster(args.hosts, args.instances,
+                                       args.preemptible_ratio,
+                                       seed=args.seed)
+    requests = simulator.generate_requests(
+        args.requests, args.request_preemptible_ratio,
+        num_instances=args.instances_per_request, seed=args.seed)
+    sim = simulator.Simulator(cloud)
+    try:
+        results = sim.run(requests)
+    finally:
+        sim.stop()
+    results["imbalance"] = ram_imbalance(cloud)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, default=10000)
+    parser.add_argument("--instances", type=int, default=40,
+                        help="Instances per host in the initial cluster.")
+    parser.add_argument("--preemptible-ratio", type=float, default=0.5)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--request-preemptible-ratio", type=float,
+                        default=0.5)
+    parser.add_argument("--instances-per-request", type=int, default=1)
+    parser.add_argument("--sampling-sizes", type=int, nargs="+",
+                        default=[0, 2, 8, 32, 128],
+                        help="Sample sizes to compare, 0 means evaluating "
+                             "all the hosts.")
+    parser.add_argument("--reclaimable-bias", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    group = "preemptible_instances_scheduler"
+    simulator.setup_nova(
+        filters=["RetryFilter", "AvailabilityZoneFilter", "RamFilter",
+                 "DiskFilter", "CoreFilter", "ComputeFilter"],
+        overrides={(group, "bulk_instance_load"): True,
+                   (group, "sampling_reclaimable_bias"):
+                   args.reclaimable_bias})
+
+    print("%d hosts, %d requests" % (args.hosts, args.requests))
+    print("%-8s %9s %9s %7s %12s %10s" % ("sample", "p50 (ms)", "p99 (ms)",
+                                          "failed", "preemptions",
+                                          "imbalance"))
+    for size in args.sampling_sizes:
+        results = run(size, args)
+        print("%-8s %9.1f %9.1f %7d %12.2f %10.4f" % (
+            size or "all", results["latency_p50"] * 1e3,
+            results["latency_p99"] * 1e3, results["failed"],
+            results["preemptions_per_request"], results["imbalance"]))
+
+
+if __name__ == "__main__":
+    main()
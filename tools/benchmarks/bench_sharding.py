@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmark the sharded filtering and weighing of the hosts.
+
+The hosts are split in shards by a hash of their name, and the shards are
+filtered and weighed in a pool of green threads. The filtered hosts of each
+shard are merged back in their original order, and the best weighed hosts of
+each shard are merged into the overall best ones, so that the result is the
+same as filtering and weighing all the hosts at once.
+
+The hosts of a synthetic cluster (see simulator.py) are filtered and weighed
+for a stream of requests, all of them at once and then shard by shard with an
+increasing number of workers. It reports the time spent filtering and
+weighing, and checks that the selected hosts are the same as without
+sharding.
+
+The workers are green threads, as in the scheduler service. The filters and
+weighers are CPU bound, so the shards are not processed in parallel and the
+sharding only adds overhead, which is why the scheduler does not shard the
+hosts.
+"""
+
+from __future__ import print_function
+
+import argparse
+import heapq
+import itertools
+import time
+import zlib
+
+import eventlet
+from oslo_config import cfg
+
+from nova.scheduler import weights
+
+from opie.scheduler import selection
+
+import simulator
+
+CONF = cfg.CONF
+
+
+def shard_of(host_state, num_shards):
+    """Return the shard of a host, that does not change between requests."""
+    checksum = zlib.crc32(host_state.host.encode("utf-8")) & 0xffffffff
+    return checksum % num_shards
+
+
+class ShardedHostSelector(object):
+    """Filter and weigh the hosts shard by shard, in a pool of green threads.
+
+    :param host_manager: the host manager whose filters and weighers are
+                         used.
+    :param workers: the number of green threads.
+    :param num_shards: the number of shards, by default one per worker.
+    """
+
+    def __init__(self, host_manager, workers, num_shards=None):
+        self.host_manager = host_manager
+        self.num_shards = num_shards or workers
+        self._pool = eventlet.GreenPool(workers)
+
+    @staticmethod
+    def _key(host_state):
+        return (host_state.host, host_state.nodename)
+
+    def _split(self, hosts):
+        """Split the hosts in shards of (position, host state) tuples."""
+        shards = [[] for _ in range(self.num_shards)]
+        for idx, host in enumerate(hosts):
+            shards[shard_of(host, self.num_shards)].append((idx, host))
+        return [shard for shard in shards if shard]
+
+    @staticmethod
+    def _run_serially(spec_obj):
+        # The hosts are matched against the forced hosts and nodes, or the
+        # requested destination, before running the filters. Doing it for
+        # each shard would log a misleading message for the shards where
+        # they are not, and there are few hosts to filter anyway.
+        for attr in ("force_hosts", "force_nodes", "requested_destination"):
+            if spec_obj.obj_attr_is_set(attr) and getattr(spec_obj, attr):
+                return True
+        return False
+
+    def get_filtered_hosts(self, hosts, spec_obj, index=0):
+        """Filter the hosts, as HostManager.get_filtered_hosts()."""
+        hosts = list(hosts)
+        if self.num_shards < 2 or self._run_serially(spec_obj):
+            return self.host_manager.get_filtered_hosts(hosts, spec_obj,
+                                                        index=index)
+        positions = {self._key(h): idx for idx, h in enumerate(hosts)}
+
+        def _filter(shard):
+            filtered = self.host_manager.get_filtered_hosts(
+                [host for _idx, host in shard], spec_obj, index=index)
+            if filtered is None:
+                return None
+            return [(positions[self._key(h)], h) for h in filtered]
+
+        results = list(self._pool.imap(_filter, self._split(hosts)))
+        if any(result is None for result in results):
+            # A filter said to stop filtering
+            return None
+        return [host for _idx, host in heapq.merge(*results)]
+
+    def get_top_weighed_hosts(self, hosts, spec_obj, size):
+        """Return the best size hosts, as a list of WeighedHost objects.
+
+        The raw weights of each shard are computed concurrently. Once all of
+        them are known (and so the minimum and maximum weights used to
+        normalize them) each shard is normalized and its best size hosts
+        selected, and those are merged into the overall best hosts, with the
+        same ordering (including ties) as HostManager.get_weighed_hosts().
+        """
+        weighers = self.host_manager.weighers
+        if self.num_shards < 2 or len(hosts) <= 1:
+            return self.host_manager.get_weighed_hosts(hosts,
+                                                       spec_obj)[:size]
+
+        shards = self._split(hosts)
+
+        def _weigh(shard):
+            objs = [weights.WeighedHost(host, 0.0) for _idx, host in shard]
+            return [weigher.weigh_objects(objs, spec_obj)
+                    for weigher in weighers]
+
+        raw = list(self._pool.imap(_weigh, shards))
+
+        def _top(shard, shard_raw):
+            totals = selection.total_weights(weighers, shard_raw, len(shard))
+            # Ties are broken by the original position, as a stable sort
+            return heapq.nlargest(
+                size, ((totals[i], -idx, host)
+                       for i, (idx, host) in enumerate(shard)),
+                key=lambda item: item[:2])
+
+        tops = self._pool.imap(_top, shards, raw)
+        best = heapq.nlargest(size, itertools.chain.from_iterable(tops),
+                              key=lambda item: item[:2])
+        return [weights.WeighedHost(host, total)
+                for total, _idx, host in best]
+
+
+def run(host_manager, hosts, specs, workers):
+    # The weighers keep the minimum and maximum weights they have seen, so
+    # they are reset for the weights of each run to be comparable
+    for weigher in host_manager.weighers:
+        weigher.minval = weigher.__class__.minval
+        weigher.maxval = weigher.__class__.maxval
+
+    selector = ShardedHostSelector(host_manager, workers)
+    size = max(1, CONF.scheduler_host_subset_size)
+    filtering = weighing = 0.0
+    selected = []
+    for spec_obj in specs:
+        start = time.time()
+        filtered = selector.get_filtered_hosts(hosts, spec_obj) or []
+        filtering += time.time() - start
+
+        start = time.time()
+        weighed = selector.get_top_weighed_hosts(filtered, spec_obj, size)
+        weighing += time.time() - start
+        selected.append([(w.obj.host, w.obj.nodename, w.weight)
+                         for w in weighed])
+    return filtering, weighing, selected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, default=5000)
+    parser.add_argument("--instances", type=int, default=40,
+                        help="Instances per host in the initial cluster.")
+    parser.add_argument("--preemptible-ratio", type=float, default=0.5)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--request-preemptible-ratio", type=float,
+                        default=0.5)
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=[1, 2, 4, 8, 16],
+                        help="Numbers of workers to compare, 1 means "
+                             "filtering and weighing all the hosts at once. "
+                             "The selected hosts are compared with the "
+                             "first one.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    eventlet.monkey_patch()
+
+    simulator.setup_nova(
+        filters=["RetryFilter", "AvailabilityZoneFilter", "RamFilter",
+                 "DiskFilter", "CoreFilter", "ComputeFilter"],
+        overrides={("preemptible_instances_scheduler",
+                    "bulk_instance_load"): True})
+
+    cloud = simulator.generate_cluster(args.hosts, args.instances,
+                                       args.preemptible_ratio,
+                                       seed=args.seed)
+    requests = simulator.generate_requests(
+        args.requests, args.request_preemptible_ratio, seed=args.seed)
+    sim = simulator.Simulator(cloud)
+    try:
+        host_manager = sim.scheduler.host_manager
+        hosts, _partial = host_manager.get_host_state_snapshot(
+            sim.context, partial=False)
+    finally:
+        sim.stop()
+    specs = [simulator.request_spec(*request) for request in requests]
+
+    print("%d hosts, %d requests" % (args.hosts, args.requests))
+    print("%-8s %15s %14s %6s" % ("workers", "filtering (s)", "weighing (s)",
+                                  "same"))
+    serial = None
+    for workers in args.workers:
+        filtering, weighing, selected = run(host_manager, hosts, specs,
+                                            workers)
+        if serial is None:
+            serial = selected
+        print("%-8d %15.2f %14.2f %6s" % (
+            workers, filtering, weighing,
+            "yes" if selected == serial else "NO"))
+
+
+if __name__ == "__main__":
+    main()
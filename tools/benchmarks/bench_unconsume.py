@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmark giving back the resources of preemptible instances to the hosts.
+
+It compares unconsuming the instances one by one (taking the host lock and
+reading the clock for each of them, as opie did before) against the bulk
+unconsume_instances(), that does it once per host. The unconsumes run in a
+green thread, while other green threads consume resources from the same
+hosts, as concurrent requests would do, and the latency of those consumes is
+reported too.
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+
+import eventlet
+import iso8601
+from oslo_utils import timeutils
+
+from nova import utils
+
+from opie.scheduler import host_manager
+
+
+def legacy_unconsume(host, summaries):
+    for summary in summaries:
+        @utils.synchronized(host._lock_name)
+        def _locked(host, summary):
+            host.free_ram_mb += summary.memory_mb
+            host.free_disk_mb += summary.disk_mb
+            host.vcpus_used -= summary.vcpus
+            now = timeutils.utcnow()
+            host.updated = now.replace(tzinfo=iso8601.iso8601.Utc())
+            host.num_instances -= 1
+        _locked(host, summary)
+
+
+def bulk_unconsume(host, summaries):
+    host.unconsume_instances(summaries)
+
+
+def _hosts(num_hosts, num_preemptibles):
+    hosts = []
+    for idx in range(num_hosts):
+        host = host_manager.HostState("host%d" % idx, "node%d" % idx)
+        summaries = [host_manager.InstanceSummary(
+            "uuid-%d-%d" % (idx, i), 2048, 20 * 1024, 1, True, 0)
+            for i in range(num_preemptibles)]
+        hosts.append((host, summaries))
+    return hosts
+
+
+def _consumer(hosts, iterations, seed, latencies):
+    rand = random.Random(seed)
+    for _ in range(iterations):
+        host = rand.choice(hosts)[0]
+        watch = timeutils.StopWatch()
+        watch.start()
+
+        @utils.synchronized(host._lock_name)
+        def _locked(host):
+            host.free_ram_mb -= 512
+        _locked(host)
+
+        latencies.append(watch.elapsed())
+        eventlet.sleep(0)
+
+
+def _refresher(hosts, unconsume, rounds):
+    watch = timeutils.StopWatch()
+    watch.start()
+    for _ in range(rounds):
+        for host, summaries in hosts:
+            unconsume(host, summaries)
+            # A real refresh yields while waiting for the database
+            eventlet.sleep(0)
+    return watch.elapsed() / rounds
+
+
+def run(unconsume, args):
+    hosts = _hosts(args.hosts, args.preemptibles)
+    latencies = []
+    pool = eventlet.GreenPool(args.consumers + 1)
+    refresh = pool.spawn(_refresher, hosts, unconsume, args.rounds)
+    for idx in range(args.consumers):
+        pool.spawn(_consumer, hosts, args.consumer_iterations,
+                   args.seed + idx, latencies)
+    pool.waitall()
+    latencies.sort()
+    p99 = latencies[int(0.99 * (len(latencies) - 1))] if latencies else 0
+    return refresh.wait(), p99
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, default=1000)
+    parser.add_argument("--preemptibles", type=int, default=80,
+                        help="Preemptible instances per host.")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="Number of times all the hosts are unconsumed.")
+    parser.add_argument("--consumers", type=int, default=8,
+                        help="Green threads consuming from the hosts.")
+    parser.add_argument("--consumer-iterations", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # The host locks are green semaphores, as in the scheduler service
+    eventlet.monkey_patch()
+
+    print("%d hosts, %d preemptible instances per host, %d consumers" %
+          (args.hosts, args.preemptibles, args.consumers))
+    print("%-8s %14s %15s %18s" % ("mode", "locks/refresh", "refresh (ms)",
+                                   "consume p99 (us)"))
+    for name, unconsume, locks in (
+            ("legacy", legacy_unconsume, args.hosts * args.preemptibles),
+            ("bulk", bulk_unconsume, args.hosts)):
+        elapsed, p99 = run(unconsume, args)
+        print("%-8s %14d %15.1f %18.1f" % (name, locks, elapsed * 1e3,
+                                           p99 * 1e6))
+
+
+if __name__ == "__main__":
+    main()
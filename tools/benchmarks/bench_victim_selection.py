@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmark the selection of preemptible instances to terminate.
+
+It compares the victim selection in opie.scheduler.preemption against the
+previous behaviour (terminating an arbitrary preemptible instance), reporting
+the time per selection, how often the selected instances did not free enough
+resources and the amount of resources that were freed in excess.
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import timeit
+
+from opie.scheduler import preemption
+
+FLAVORS = [
+    # ram_mb, disk_mb, vcpus
+    (512, 1024, 1),
+    (2048, 20 * 1024, 1),
+    (4096, 40 * 1024, 2),
+    (8192, 80 * 1024, 4),
+    (16384, 160 * 1024, 8),
+]
+
+
+def _host(rand, num_instances):
+    candidates = []
+    for idx in range(num_instances):
+        resources = rand.choice(FLAVORS)
+        cost = 1 + sum(float(r) / t for r, t in
+                       zip(resources, (256 * 1024, 2048 * 1024, 64)))
+        candidates.append(preemption.Candidate(idx, resources, cost))
+    needed = rand.choice(FLAVORS)
+    return candidates, needed
+
+
+def _pop(candidates, needed):
+    return [candidates[-1]]
+
+
+def _freed(victims):
+    return [sum(r) for r in zip(*[v.resources for v in victims])]
+
+
+def run(selector, hosts, repeat):
+    underfreed = 0
+    excess = 0
+    killed = 0
+    for candidates, needed in hosts:
+        victims = selector(candidates, needed)
+        freed = _freed(victims)
+        if any(f < n for f, n in zip(freed, needed)):
+            underfreed += 1
+        else:
+            excess += freed[0] - needed[0]
+        killed += len(victims)
+
+    timer = timeit.Timer(lambda: [selector(c, n) for c, n in hosts])
+    elapsed = min(timer.repeat(repeat=repeat, number=1)) / len(hosts)
+    return elapsed, underfreed, excess / float(len(hosts)), killed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, default=200,
+                        help="Number of overcommitted hosts.")
+    parser.add_argument("--instances", type=int, nargs="+",
+                        default=[10, 100, 500],
+                        help="Preemptible instances per host.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    selectors = [("pop", _pop), ("select_victims", preemption.select_victims)]
+
+    print("%-10s %-15s %12s %11s %16s %8s" %
+          ("instances", "selector", "usec/host", "underfreed",
+           "excess ram (MB)", "killed"))
+    for num_instances in args.instances:
+        rand = random.Random(args.seed)
+        hosts = [_host(rand, num_instances) for _ in range(args.hosts)]
+        for name, selector in selectors:
+            elapsed, underfreed, excess, killed = run(selector, hosts,
+                                                      args.repeat)
+            print("%-10d %-15s %12.1f %11d %16.1f %8d" %
+                  (num_instances, name, elapsed * 1e6, underfreed, excess,
+                   killed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmark the preemptible weighers.
+
+It compares the time needed to weigh all the hosts with the previous per-host
+implementation of the weighers and with the batch implementation.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import random
+import timeit
+
+from oslo_utils import timeutils
+
+from nova.scheduler import weights
+
+from opie.scheduler import host_manager
+from opie.scheduler.weights import preemptible
+
+
+class FakeInstance(object):
+    def __init__(self, uuid, is_preemptible, created_at):
+        self.uuid = uuid
+        self.system_metadata = {"preemptible": True} if is_preemptible else {}
+        self.created_at = created_at
+        self.memory_mb = 2048
+        self.root_gb = 20
+        self.ephemeral_gb = 0
+        self.vcpus = 1
+
+
+def _hosts(num_hosts, instances_per_host, ratio, seed):
+    rand = random.Random(seed)
+    now = timeutils.utcnow()
+    hosts = []
+    for idx in range(num_hosts):
+        host = host_manager.HostState("host%d" % idx, "node%d" % idx)
+        instances = {}
+        for i in range(instances_per_host):
+            uuid = "uuid-%d-%d" % (idx, i)
+            created_at = now - datetime.timedelta(
+                seconds=rand.randint(0, 48 * 3600))
+            instances[uuid] = FakeInstance(uuid, rand.random() < ratio,
+                                           created_at)
+        host.instances = instances
+        hosts.append(host)
+    return hosts
+
+
+def legacy_count(host_state):
+    count = 0
+    for instance in host_state.instances.values():
+        if instance.system_metadata.get("preemptible"):
+            count += 1
+    return - count
+
+
+def legacy_duration(host_state):
+    remainder = 0
+    for instance in host_state.instances.values():
+        if instance.system_metadata.get("preemptible"):
+            now = timeutils.utcnow()
+            now = now.replace(tzinfo=None)
+            ct = instance.created_at.replace(tzinfo=None)
+            duration = (now - ct).total_seconds()
+            remainder += duration % 3600
+    return - remainder
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, nargs="+",
+                        default=[1000, 5000, 10000])
+    parser.add_argument("--instances", type=int, default=20,
+                        help="Instances per host.")
+    parser.add_argument("--preemptible-ratio", type=float, default=0.5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print("%-8s %-10s %12s %12s" %
+          ("hosts", "weigher", "legacy (ms)", "batch (ms)"))
+    for num_hosts in args.hosts:
+        hosts = _hosts(num_hosts, args.instances, args.preemptible_ratio,
+                       args.seed)
+        objs = [weights.WeighedHost(h, 0.0) for h in hosts]
+
+        for name, weigher_cls, legacy in (
+                ("count", preemptible.PreemptibleCountWeigher, legacy_count),
+                ("duration", preemptible.PreemptibleDurationWeigher,
+                 legacy_duration)):
+            weigher = weigher_cls()
+
+            def _legacy():
+                return [legacy(h) for h in hosts]
+
+            def _batch():
+                return weigher.weigh_objects(objs, {})
+
+            results = []
+            for func in (_legacy, _batch):
+                timer = timeit.Timer(func)
+                results.append(min(timer.repeat(repeat=args.repeat,
+                                                number=1)) * 1000)
+            print("%-8d %-10s %12.2f %12.2f" %
+                  ((num_hosts, name) + tuple(results)))
+
+
+if __name__ == "__main__":
+    main()
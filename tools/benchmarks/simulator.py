@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+# Copyright 2016 Spanish National Research Council (CSIC)
+# Copyright 2016 INDIGO-DataCloud
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Offline scheduling simulator.
+
+It generates a synthetic cluster, keeps it in an in-memory fake of the Nova
+database and replays a stream of requests through the real opie
+FilterScheduler and HostManager. The scheduled instances are created (and the
+terminated preemptible ones deleted) in the fake database, so that each
+request sees the effect of the previous ones. No services (database, message
+queue or compute nodes) are needed, only opie and nova installed.
+
+It reports the throughput, the p50 and p99 latency of select_destinations,
+the number of preemptions per request and the number of database calls per
+request.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import datetime
+import random
+import time
+
+import mock
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_messaging import conffixture as messaging_conffixture
+from oslo_utils import timeutils
+
+from nova import config as nova_config
+from nova import context as nova_context
+from nova import exception
+from nova import objects
+from nova import rpc
+
+from opie.scheduler import db as opie_db
+from opie.scheduler import filter_scheduler
+
+CONF = cfg.CONF
+
+FLAVORS = [
+    # name, memory_mb, root_gb, vcpus
+    ("m1.tiny", 512, 1, 1),
+    ("m1.small", 2048, 20, 1),
+    ("m1.medium", 4096, 40, 2),
+    ("m1.large", 8192, 80, 4),
+    ("m1.xlarge", 16384, 160, 8),
+]
+
+InstanceRow = collections.namedtuple(
+    "InstanceRow", ["uuid", "host", "memory_mb", "root_gb", "ephemeral_gb",
+                    "vcpus", "created_at", "project_id", "instance_type_id",
+                    "preemptible"])
+
+HOST_MEMORY_MB = 256 * 1024
+HOST_LOCAL_GB = 4096
+HOST_VCPUS = 64
+
+
+def setup_nova(filters=None, weighers=None, overrides=None):
+    """Configure nova so that the scheduler runs without any service."""
+    nova_config.parse_args(["simulator"], configure_db=False,
+                           init_rpc=False)
+    objects.register_all()
+    # Use the in-memory oslo.messaging driver, there is no message queue
+    messaging_conf = messaging_conffixture.ConfFixture(CONF)
+    messaging_conf.setUp()
+    messaging_conf.transport_driver = "fake"
+    CONF.set_override("scheduler_host_manager", "opie_host_manager")
+    CONF.set_override("ram_allocation_ratio", 1.0)
+    CONF.set_override("disk_allocation_ratio", 1.0)
+    CONF.set_override("cpu_allocation_ratio", 1.0)
+    CONF.set_override("scheduler_available_filters",
+                      ["nova.scheduler.filters.all_filters",
+                       "opie.scheduler.filters.all_filters"])
+    if filters:
+        CONF.set_override("scheduler_default_filters", filters)
+    if weighers:
+        CONF.set_override("scheduler_weight_classes", weighers)
+    for (group, name), value in (overrides or {}).items():
+        CONF.set_override(name, value, group=group)
+    rpc.init(CONF)
+
+
+def _flavor(name, memory_mb, root_gb, vcpus):
+    return objects.Flavor(name=name, memory_mb=memory_mb, root_gb=root_gb,
+                          ephemeral_gb=0, swap=0, vcpus=vcpus,
+                          extra_specs={})
+
+
+class FakeCloud(object):
+    """In-memory fake of the Nova database, counting the calls to it."""
+
+    def __init__(self):
+        self.services = collections.OrderedDict()
+        self.nodes = collections.OrderedDict()
+        self.instances = {}
+        self.hosts_by_uuid = {}
+        self.db_calls = collections.Counter()
+        self._patchers = []
+        self._uuids = 0
+
+    def add_host(self, host, memory_mb=HOST_MEMORY_MB,
+                 local_gb=HOST_LOCAL_GB, vcpus=HOST_VCPUS):
+        now = timeutils.utcnow()
+        idx = len(self.nodes) + 1
+        self.services[host] = objects.Service(
+            id=idx, host=host, binary="nova-compute", topic="compute",
+            disabled=False, disabled_reason=None, forced_down=False,
+            report_count=1, version=objects.service.SERVICE_VERSION,
+            created_at=now, updated_at=now, last_seen_up=now)
+        self.nodes[host] = objects.ComputeNode(
+            id=idx, uuid="node-uuid-%d" % idx, service_id=idx, host=host,
+            hypervisor_hostname=host, hypervisor_type="QEMU",
+            hypervisor_version=2005000, host_ip="10.0.0.%d" % (idx % 255),
+            memory_mb=memory_mb, memory_mb_used=0, free_ram_mb=memory_mb,
+            local_gb=local_gb, local_gb_used=0, free_disk_gb=local_gb,
+            disk_available_least=local_gb, vcpus=vcpus, vcpus_used=0,
+            running_vms=0, current_workload=0, cpu_info="", stats={},
+            metrics="[]", numa_topology=None, pci_device_pools=None,
+            supported_hv_specs=[], cpu_allocation_ratio=1.0,
+            ram_allocation_ratio=1.0, disk_allocation_ratio=1.0,
+            created_at=now, updated_at=now)
+        self.instances[host] = {}
+
+    def _consume(self, host, instance, sign):
+        node = self.nodes[host]
+        disk_gb = instance.root_gb + instance.ephemeral_gb
+        node.memory_mb_used += sign * instance.memory_mb
+        node.free_ram_mb -= sign * instance.memory_mb
+        node.local_gb_used += sign * disk_gb
+        node.free_disk_gb -= sign * disk_gb
+        node.disk_available_least -= sign * disk_gb
+        node.vcpus_used += sign * instance.vcpus
+        node.running_vms += sign
+        node.updated_at = timeutils.utcnow()
+
+    def add_instance(self, host, flavor, preemptible, created_at=None):
+        self._uuids += 1
+        uuid = "00000000-0000-0000-0000-%012d" % self._uuids
+        instance = objects.Instance(
+            uuid=uuid, host=host, node=host, project_id="project",
+            user_id="user", memory_mb=flavor.memory_mb,
+            root_gb=flavor.root_gb, ephemeral_gb=flavor.ephemeral_gb,
+            vcpus=flavor.vcpus, instance_type_id=1, vm_state="active",
+            task_state=None, created_at=created_at or timeutils.utcnow(),
+            system_metadata={"preemptible": "True"} if preemptible else {})
+        self.instances[host][uuid] = instance
+        self.hosts_by_uuid[uuid] = host
+        self._consume(host, instance, 1)
+        return instance
+
+    def delete_instance(self, uuid):
+        host = self.hosts_by_uuid.pop(uuid)
+        instance = self.instances[host].pop(uuid)
+        self._consume(host, instance, -1)
+
+    @property
+    def num_instances(self):
+        return len(self.hosts_by_uuid)
+
+    # Fake database API
+
+    def get_services_by_binary(self, context, binary, include_disabled=False):
+        self.db_calls["ServiceList.get_by_binary"] += 1
+        now = timeutils.utcnow()
+        for service in self.services.values():
+            service.last_seen_up = now
+        return objects.ServiceList(objects=list(self.services.values()))
+
+    def get_compute_nodes(self, context):
+        self.db_calls["ComputeNodeList.get_all"] += 1
+        return objects.ComputeNodeList(objects=list(self.nodes.values()))
+
+    def get_compute_node_by_host_and_nodename(self, context, host, nodename):
+        self.db_calls["ComputeNode.get_by_host_and_nodename"] += 1
+        node = self.nodes.get(host)
+        if node is None or node.hypervisor_hostname != nodename:
+            raise exception.ComputeHostNotFound(host=host)
+        return node
+
+    def get_service_by_compute_host(self, context, host):
+        self.db_calls["Service.get_by_compute_host"] += 1
+        service = self.services.get(host)
+        if service is None:
+            raise exception.ComputeHostNotFound(host=host)
+        service.last_seen_up = timeutils.utcnow()
+        return service
+
+    def get_instances_by_host(self, context, host, expected_attrs=None,
+                              use_slave=False):
+        self.db_calls["InstanceList.get_by_host"] += 1
+        return objects.InstanceList(
+            objects=list(self.instances.get(host, {}).values()))
+
+    def get_instances_by_filters(self, context, filters, *args, **kwargs):
+        self.db_calls["InstanceList.get_by_filters"] += 1
+        instances = []
+        if "uuid" in filters:
+            for uuid in filters["uuid"]:
+                host = self.hosts_by_uuid.get(uuid)
+                if host is not None:
+                    instances.append(self.instances[host][uuid])
+        elif "host" in filters:
+            hosts = filters["host"]
+            if not isinstance(hosts, list):
+                hosts = [hosts]
+            for host in hosts:
+                instances.extend(self.instances.get(host, {}).values())
+        return objects.InstanceList(objects=instances)
+
+    def get_instance_summaries_by_host(self, context, hosts):
+        self.db_calls["get_instance_summaries_by_host"] += 1
+        return [InstanceRow(i.uuid, host, i.memory_mb, i.root_gb,
+                            i.ephemeral_gb, i.vcpus, i.created_at,
+                            i.project_id, i.instance_type_id,
+                            i.system_metadata.get("preemptible"))
+                for host in hosts
+                for i in self.instances.get(host, {}).values()]
+
+    def get_compute_nodes_changed_since(self, context, since):
+        self.db_calls["get_compute_nodes_changed_since"] += 1
+        nodes = [node for node in self.nodes.values()
+                 if since is None or
+                 node.updated_at.replace(tzinfo=None) >= since]
+        return objects.ComputeNodeList(objects=nodes)
+
+    def get_compute_node_ids(self, context):
+        self.db_calls["get_compute_node_ids"] += 1
+        return set(node.id for node in self.nodes.values())
+
+    def get_aggregates(self, context):
+        self.db_calls["AggregateList.get_all"] += 1
+        return objects.AggregateList(objects=[])
+
+    def start(self):
+        """Replace the database calls made by the scheduler with fakes."""
+        fakes = [
+            (objects.ServiceList, "get_by_binary",
+             self.get_services_by_binary),
+            (objects.ComputeNodeList, "get_all", self.get_compute_nodes),
+            (objects.ComputeNode, "get_by_host_and_nodename",
+             self.get_compute_node_by_host_and_nodename),
+            (objects.Service, "get_by_compute_host",
+             self.get_service_by_compute_host),
+            (objects.InstanceList, "get_by_host", self.get_instances_by_host),
+            (objects.InstanceList, "get_by_filters",
+             self.get_instances_by_filters),
+            (objects.AggregateList, "get_all", self.get_aggregates),
+            (opie_db, "get_compute_nodes_changed_since",
+             self.get_compute_nodes_changed_since),
+            (opie_db, "get_compute_node_ids", self.get_compute_node_ids),
+            (opie_db, "get_instance_summaries_by_host",
+             self.get_instance_summaries_by_host),
+        ]
+        for cls, name, fake in fakes:
+            patcher = mock.patch.object(cls, name, side_effect=fake)
+            patcher.start()
+            self._patchers.append(patcher)
+
+    def stop(self):
+        for patcher in self._patchers:
+            patcher.stop()
+        self._patchers = []
+
+
+class FakeComputeAPI(object):
+    """Delete the instances from the fake database."""
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+        self.deleted = 0
+
+    def delete(self, context, instance):
+        self.cloud.delete_instance(instance.uuid)
+        self.deleted += 1
+
+
+def generate_cluster(num_hosts, instances_per_host, preemptible_ratio,
+                     seed=0):
+    """Return a FakeCloud with num_hosts hosts, partially filled.
+
+    Each host gets (at most) instances_per_host instances of random flavors,
+    a preemptible_ratio fraction of them preemptible, created during the last
+    two days.
+    """
+    rand = random.Random(seed)
+    now = timeutils.utcnow()
+    flavors = [_flavor(*f) for f in FLAVORS]
+    cloud = FakeCloud()
+    for idx in range(num_hosts):
+        host = "host%05d" % idx
+        cloud.add_host(host)
+        node = cloud.nodes[host]
+        for _ in range(instances_per_host):
+            flavor = rand.choice(flavors)
+            if (flavor.memory_mb > node.free_ram_mb or
+                    flavor.vcpus > node.vcpus - node.vcpus_used or
+                    flavor.root_gb > node.free_disk_gb):
+                break
+            created_at = now - datetime.timedelta(
+                seconds=rand.randint(0, 48 * 3600))
+            cloud.add_instance(host, flavor,
+                               rand.random() < preemptible_ratio,
+                               created_at=created_at)
+    return cloud
+
+
+def generate_requests(num_requests, preemptible_ratio, num_instances=1,
+                      seed=0):
+    """Return a list of (flavor, preemptible) requests."""
+    rand = random.Random(seed)
+    flavors = [_flavor(*f) for f in FLAVORS]
+    return [(rand.choice(flavors), rand.random() < preemptible_ratio,
+             num_instances)
+            for _ in range(num_requests)]
+
+
+def request_spec(flavor, preemptible, num_instances):
+    """Return the RequestSpec of a request."""
+    return objects.RequestSpec(
+        instance_uuid="ffffffff-ffff-ffff-ffff-ffffffffffff",
+        project_id="project", flavor=flavor,
+        image=objects.ImageMeta.from_dict({"properties": {}}),
+        num_instances=num_instances, availability_zone=None,
+        ignore_hosts=None, force_hosts=None, force_nodes=None,
+        retry=None, instance_group=None, pci_requests=None,
+        numa_topology=None, scheduler_hints={
+            "preemptible": [str(preemptible)]})
+
+
+def percentile(values, pct):
+    """Return the pct percentile of a list of values (nearest rank)."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(pct / 100.0 * (len(values) - 1)))]
+
+
+class Simulator(object):
+    """Replay requests through the opie scheduler on a FakeCloud.
+
+    setup_nova() must be called before creating a Simulator.
+    """
+
+    def __init__(self, cloud, scheduler_cls=None):
+        if scheduler_cls is None:
+            scheduler_cls = filter_scheduler.FilterScheduler
+
+        self.cloud = cloud
+        self.context = nova_context.get_admin_context()
+        self.cloud.start()
+        self.scheduler = scheduler_cls()
+        self.compute_api = FakeComputeAPI(cloud)
+        self.scheduler.compute_api = self.compute_api
+        self.scheduler.reaper.compute_api = self.compute_api
+
+    def stop(self):
+        self.cloud.stop()
+
+    def run(self, requests):
+        """Schedule the requests, returning a dict with the results."""
+        latencies = []
+        failed = 0
+        preemptions = collections.Counter()
+        db_calls = sum(self.cloud.db_calls.values())
+        deleted = self.compute_api.deleted
+
+        start = time.time()
+        for flavor, preemptible, num_instances in requests:
+            spec_obj = request_spec(flavor, preemptible, num_instances)
+            before = self.compute_api.deleted
+            begin = time.time()
+            try:
+                dests = self.scheduler.select_destinations(self.context,
+                                                           spec_obj)
+            except exception.NoValidHost:
+                failed += 1
+                dests = []
+            latencies.append(time.time() - begin)
+            preemptions[self.compute_api.deleted - before] += 1
+
+            # Build the instances, as the compute nodes would do
+            for dest in dests:
+                self.cloud.add_instance(dest["host"], flavor, preemptible)
+        elapsed = time.time() - start
+
+        num_requests = len(requests) or 1
+        return {
+            "requests": len(requests),
+            "failed": failed,
+            "elapsed": elapsed,
+            "throughput": len(requests) / elapsed if elapsed else 0.0,
+            "latency_p50": percentile(latencies, 50),
+            "latency_p99": percentile(latencies, 99),
+            "preemptions_per_request": float(
+                self.compute_api.deleted - deleted) / num_requests,
+            "preemptions": dict(preemptions),
+            "db_calls_per_request": float(
+                sum(self.cloud.db_calls.values()) - db_calls) / num_requests,
+        }
+
+
+def print_report(results):
+    print("requests:                %d (%d failed)" % (results["requests"],
+                                                       results["failed"]))
+    print("throughput:              %.1f requests/s" % results["throughput"])
+    print("latency p50:             %.2f ms" % (results["latency_p50"] * 1000))
+    print("latency p99:             %.2f ms" % (results["latency_p99"] * 1000))
+    print("preemptions per request: %.2f" %
+          results["preemptions_per_request"])
+    print("db calls per request:    %.1f" % results["db_calls_per_request"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, default=1000)
+    parser.add_argument("--instances", type=int, default=40,
+                        help="Instances per host in the initial cluster.")
+    parser.add_argument("--preemptible-ratio", type=float, default=0.5,
+                        help="Fraction of preemptible instances in the "
+                             "initial cluster.")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--request-preemptible-ratio", type=float,
+                        default=0.5,
+                        help="Fraction of requests for preemptible "
+                             "instances.")
+    parser.add_argument("--instances-per-request", type=int, default=1)
+    parser.add_argument("--filters", nargs="+",
+                        default=["RetryFilter", "AvailabilityZoneFilter",
+                                 "RamFilter", "DiskFilter", "CoreFilter",
+                                 "ComputeFilter"])
+    parser.add_argument("--host-state-cache-ttl", type=int, default=0)
+    parser.add_argument("--delta-refresh", action="store_true")
+    parser.add_argument("--bulk-instance-load", action="store_true")
+    parser.add_argument("--single-host-list", action="store_true",
+                        help="Use a single host list for all the requests, "
+                             "replacing the RamFilter, DiskFilter and "
+                             "CoreFilter with their Reclaimable versions.")
+    parser.add_argument("--sampling-size", type=int, default=0,
+                        help="Number of hosts sampled for each instance, "
+                             "0 to evaluate all of them.")
+    parser.add_argument("--sampling-reclaimable-bias", type=float,
+                        default=2.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    filters = args.filters
+    if args.single_host_list:
+        filters = ["Reclaimable" + f
+                   if f in ("RamFilter", "DiskFilter", "CoreFilter") else f
+                   for f in filters]
+
+    group = "preemptible_instances_scheduler"
+    setup_nova(filters=filters,
+               overrides={(group, "host_state_cache_ttl"):
+                          args.host_state_cache_ttl,
+                          (group, "delta_refresh"): args.delta_refresh,
+                          (group, "bulk_instance_load"):
+                          args.bulk_instance_load,
+                          (group, "single_host_list"):
+                          args.single_host_list,
+                          (group, "sampling_size"): args.sampling_size,
+                          (group, "sampling_reclaimable_bias"):
+                          args.sampling_reclaimable_bias})
+    if args.debug:
+        logging.setup(CONF, "opie-simulator")
+
+    cloud = generate_cluster(args.hosts, args.instances,
+                             args.preemptible_ratio, seed=args.seed)
+    requests = generate_requests(args.requests,
+                                 args.request_preemptible_ratio,
+                                 num_instances=args.instances_per_request,
+                                 seed=args.seed)
+    print("cluster: %d hosts, %d instances" % (args.hosts,
+                                               cloud.num_instances))
+    simulator = Simulator(cloud)
+    try:
+        print_report(simulator.run(requests))
+    finally:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    main()